@@ -1,3 +1,4 @@
+from cache import *
 from database import *
 from util import *
 from util_check import *
@@ -0,0 +1,145 @@
+import sqlite3, logging, time, json, hashlib, threading
+
+logger = logging.getLogger(__name__)
+
+
+def open_transform_cache(**kwargs):
+    if kwargs.get('cache_file') == None:
+        return None
+
+    return TransformCache(kwargs['cache_file'], kwargs.get('cache_size', 1024),
+        kwargs.get('command_list'), kwargs.get('transform'), kwargs.get('execute_pipe', False))
+
+
+# Remembers the results of --execute/--transform across runs, keyed by the md5 of
+# the original tile data and a hash of the commands that were executed on it.
+# Can be shared by the threads of a ThreadPool, but not by several processes.
+class TransformCache(object):
+
+    def __init__(self, cache_file, max_size, command_list, transform=None, execute_pipe=False):
+        self.cache_file = cache_file
+        self.max_size   = max_size * 1024 * 1024
+        self.hits       = 0
+        self.misses     = 0
+        self.pending    = 0
+        self.evicted    = 0
+
+        m = hashlib.md5()
+        m.update(json.dumps([command_list, transform, execute_pipe]))
+        self.commands_id = m.hexdigest()
+
+        self.lock = threading.Lock()
+
+        self.con = sqlite3.connect(cache_file, check_same_thread=False)
+        self.con.text_factory = str
+        self.cur = self.con.cursor()
+
+        self.cur.execute("PRAGMA journal_mode = wal")
+        self.cur.execute("""CREATE TABLE IF NOT EXISTS transform_cache (
+            commands_id VARCHAR(32),
+            input_id VARCHAR(32),
+            tile_data BLOB,
+            size INTEGER,
+            last_used INTEGER,
+            PRIMARY KEY (commands_id, input_id))""")
+        self.cur.execute("""CREATE INDEX IF NOT EXISTS transform_cache_last_used ON transform_cache (last_used)""")
+        self.con.commit()
+
+        self.cur.execute("""SELECT SUM(size) FROM transform_cache""")
+        self.size = self.cur.fetchone()[0] or 0
+
+        logger.debug("Using transform cache %s" % (cache_file))
+
+
+    # Returns (found, tile_data), tile_data is None if the tile vanished
+    def get(self, input_id):
+        with self.lock:
+            return self.get_locked(input_id)
+
+
+    def get_locked(self, input_id):
+        self.cur.execute("""SELECT tile_data FROM transform_cache WHERE commands_id=? AND input_id=?""",
+            (self.commands_id, input_id))
+        row = self.cur.fetchone()
+
+        if row == None:
+            self.misses += 1
+            return (False, None)
+
+        self.hits += 1
+        self.cur.execute("""UPDATE transform_cache SET last_used=? WHERE commands_id=? AND input_id=?""",
+            (int(time.time()), self.commands_id, input_id))
+        self.commit_pending()
+
+        if row[0] == None:
+            return (True, None)
+        return (True, str(row[0]))
+
+
+    def put(self, input_id, tile_data):
+        with self.lock:
+            self.put_locked(input_id, tile_data)
+
+
+    def put_locked(self, input_id, tile_data):
+        # The size of a replaced entry no longer counts
+        self.cur.execute("""SELECT size FROM transform_cache WHERE commands_id=? AND input_id=?""",
+            (self.commands_id, input_id))
+        row = self.cur.fetchone()
+        if row != None:
+            self.size -= row[0]
+
+        if tile_data == None:
+            self.cur.execute("""REPLACE INTO transform_cache (commands_id, input_id, tile_data, size, last_used) VALUES (?, ?, NULL, 0, ?)""",
+                (self.commands_id, input_id, int(time.time())))
+        else:
+            self.cur.execute("""REPLACE INTO transform_cache (commands_id, input_id, tile_data, size, last_used) VALUES (?, ?, ?, ?, ?)""",
+                (self.commands_id, input_id, sqlite3.Binary(tile_data), len(tile_data), int(time.time())))
+            self.size += len(tile_data)
+        self.commit_pending()
+
+        # Evicts a bit more than necessary, so that it doesn't run again for every new entry
+        if self.size > self.max_size:
+            self.evicted += self.evict(self.max_size * 9 / 10)
+
+
+    def commit_pending(self):
+        self.pending += 1
+        if self.pending >= 250:
+            self.con.commit()
+            self.pending = 0
+
+
+    # Removes the least recently used entries until the cache fits into target_size
+    def evict(self, target_size):
+        self.cur.execute("""SELECT SUM(size) FROM transform_cache""")
+        total_size = self.cur.fetchone()[0] or 0
+        self.size = total_size
+
+        if total_size <= target_size:
+            return 0
+
+        expired_rows = []
+        for row in self.con.execute("""SELECT rowid, size FROM transform_cache ORDER BY last_used ASC"""):
+            if total_size <= target_size:
+                break
+            expired_rows.append( (row[0], ) )
+            total_size -= row[1]
+
+        self.cur.executemany("""DELETE FROM transform_cache WHERE rowid=?""", expired_rows)
+        self.con.commit()
+        self.pending = 0
+        self.size = total_size
+
+        return len(expired_rows)
+
+
+    def close(self):
+        self.con.commit()
+
+        self.evicted += self.evict(self.max_size)
+
+        logger.debug("Transform cache: %d hits, %d misses, %d entries evicted" % (self.hits, self.misses, self.evicted))
+
+        self.cur.close()
+        self.con.close()
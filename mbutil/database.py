@@ -1,28 +1,138 @@
-import psycopg2, sqlite3, oursql, pymongo, bson, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, math
+import sqlite3, sys, logging, time, os, json, zlib, hashlib, tempfile, math, binascii, StringIO
 
 logger = logging.getLogger(__name__)
 
 
-def database_connect(connect_string, auto_commit=False, journal_mode='wal', synchronous_off=False, exclusive_lock=False, check_if_exists=False):
+def database_connect(connect_string, auto_commit=False, journal_mode='wal', synchronous_off=False, exclusive_lock=False, check_if_exists=False, itersize=None):
     """Connect to a database
     """
 
     if connect_string.endswith(".mbtiles"):
-        return MBTilesSQLite(connect_string, auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists)
+        con = MBTilesSQLite(connect_string, auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists)
     elif connect_string.find("driver=postgres") >= 0 or connect_string.startswith("pg:"):
-        return MBTilesPostgres(connect_string.replace("driver=postgres", ""), auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists)
+        con = MBTilesPostgres(connect_string.replace("driver=postgres", ""), auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists)
     elif connect_string.find("driver=mysql") >= 0 or connect_string.startswith("my:"):
-        return MBTilesMySQL(connect_string.replace("driver=mysql", ""), auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists)
+        con = MBTilesMySQL(connect_string.replace("driver=mysql", ""), auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists)
     elif connect_string.find("driver=mongodb") >= 0 or connect_string.startswith("mongodb:"):
-        return MBTilesMongoDB(connect_string.replace("driver=mongodb", ""), auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists)
+        con = MBTilesMongoDB(connect_string.replace("driver=mongodb", ""), auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists)
     else:
         logger.error("Unknown database connection string")
         sys.exit(1)
 
+    if itersize:
+        con.itersize = itersize
+
+    return con
+
+
+# Formats a value for COPY ... FROM STDIN in the text format
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+# SQL for the order argument of tiles(), tiles_with_tile_id() and images_with_tile_id():
+# 'zxy' follows the map index and the directory layout of exports, 'morton' walks
+# every zoom level along a Z-order curve so that neighbouring tiles are read together.
+# bigint is a format string casting a column to a 64 bit integer.
+def morton_key_sql(column_x, column_y, bits):
+    if bits > 31:
+        raise Exception("Tiles above zoom level 31 can't be sorted in Morton order")
+
+    terms = []
+    for i in range(max(bits, 1)):
+        terms.append("(((%s >> %d) & 1) << %d)" % (column_x, i, 2 * i))
+        terms.append("(((%s >> %d) & 1) << %d)" % (column_y, i, 2 * i + 1))
+    return "(%s)" % (" | ".join(terms))
+
+
+def order_by_sql(order, prefix, max_zoom, bigint="%s"):
+    if order == None:
+        return ""
+
+    if order == "zxy":
+        return " ORDER BY %szoom_level, %stile_column, %stile_row " % (prefix, prefix, prefix)
+    elif order == "morton":
+        return " ORDER BY %szoom_level, %s " % (prefix, morton_key_sql(bigint % (prefix + "tile_column"), bigint % (prefix + "tile_row"), max_zoom))
+
+    raise Exception("Unknown tile order: %s" % (order))
+
+
+# Compact tile keys (--create --compact-keys) hold the zoom level in the bits from 58,
+# tile_column and tile_row interleaved in Morton order in the bits from 2 and
+# tile_scale - 1 in the lowest two bits, which limits them to zoom level 28 and scale 4
+COMPACT_KEYS_MAX_ZOOM = 28
+
+
+def spread_bits(value):
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8))  & 0x00FF00FF00FF00FF
+    value = (value | (value << 4))  & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2))  & 0x3333333333333333
+    value = (value | (value << 1))  & 0x5555555555555555
+    return value
+
+
+def gather_bits(value):
+    value = value & 0x5555555555555555
+    value = (value | (value >> 1))  & 0x3333333333333333
+    value = (value | (value >> 2))  & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value >> 4))  & 0x00FF00FF00FF00FF
+    value = (value | (value >> 8))  & 0x0000FFFF0000FFFF
+    value = (value | (value >> 16)) & 0x00000000FFFFFFFF
+    return value
+
+
+def tile_key(zoom_level, tile_column, tile_row, tile_scale):
+    if tile_scale == None:
+        tile_scale = 1
+
+    if zoom_level > COMPACT_KEYS_MAX_ZOOM or tile_scale < 1 or tile_scale > 4:
+        raise Exception("Compact tile keys only support zoom levels up to %d and tile scales 1-4" % (COMPACT_KEYS_MAX_ZOOM))
+
+    return (zoom_level << 58) | (spread_bits(tile_column) << 2) | (spread_bits(tile_row) << 3) | (tile_scale - 1)
+
+
+# Returns (z, x, y, scale) of a compact tile key
+def tile_key_position(key):
+    morton = (key >> 2) & ((1 << 56) - 1)
+    return (key >> 58, gather_bits(morton), gather_bits(morton >> 1), (key & 3) + 1)
+
+
+# The inverse of the interleave for the views of compact databases, readable by any SQLite
+def morton_coordinate_sql(column, offset, bits):
+    terms = []
+    for i in range(bits):
+        terms.append("(((%s >> %d) & 1) << %d)" % (column, offset + 2 * i, i))
+    return "(%s)" % (" | ".join(terms))
+
+
+# A single integer with the same ordering, for sorting grouped rows
+def sort_key_sql(order, prefix, max_zoom, bigint="%s"):
+    zoom_level  = bigint % (prefix + "zoom_level")
+    tile_column = bigint % (prefix + "tile_column")
+    tile_row    = bigint % (prefix + "tile_row")
+
+    if order == "zxy":
+        return "((%s << 58) | (%s << 29) | %s)" % (zoom_level, tile_column, tile_row)
+    elif order == "morton":
+        if max_zoom > 29:
+            raise Exception("Tiles above zoom level 29 can't be sorted in Morton order")
+        return "((%s << 58) | %s)" % (zoom_level, morton_key_sql(tile_column, tile_row, max_zoom))
+
+    raise Exception("Unknown tile order: %s" % (order))
+
 
 
 class MBTilesDatabase:
 
+    # Placeholder for bound parameters of the driver
+    placeholder = "?"
+
+    # Number of rows the tile iterators fetch from the database at once
+    itersize = 10000
+
     def __init__(self, connect_string, auto_commit=False, journal_mode='wal', synchronous_off=False, exclusive_lock=False, check_if_exists=False):
         self.connect_string = connect_string
         self.con = None
@@ -52,6 +162,14 @@ class MBTilesDatabase:
     def drop_map_tile_index(self):
         raise Exception("Not implemented.")
 
+    # Bulk loads are only supported where the writes don't depend on the unique indexes,
+    # returns True if the database is in bulk load mode
+    def begin_bulk_load(self, force=False):
+        return False
+
+    def end_bulk_load(self, replace_existing=True):
+        pass
+
     def execute(self, sql):
         self.cur.execute(sql)
 
@@ -61,6 +179,18 @@ class MBTilesDatabase:
     def has_scale(self):
         return True
 
+    def has_compact_keys(self):
+        return False
+
+    def mbtiles_setup_compact_keys(self):
+        raise Exception("Not implemented.")
+
+    def has_refcounts(self):
+        return False
+
+    def mbtiles_setup_refcounts(self):
+        raise Exception("Not implemented.")
+
     def max_timestamp(self):
         raise Exception("Not implemented.")
 
@@ -68,6 +198,18 @@ class MBTilesDatabase:
     def zoom_levels(self, scale):
         raise Exception("Not implemented.")
 
+    # The zoom level whose coordinates the Morton order must interleave completely. Zoom
+    # level 18 means no limit like everywhere else, the database might have higher ones.
+    def morton_zoom_level(self, order, max_zoom):
+        if order != "morton" or max_zoom < 18:
+            return max_zoom
+
+        self.cur.execute(self.max_zoom_level_sql())
+        return max(self.cur.fetchall()[0][0] or 0, max_zoom)
+
+    def max_zoom_level_sql(self):
+        return "SELECT max(zoom_level) FROM map"
+
     def tiles_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
         raise Exception("Not implemented.")
 
@@ -80,18 +222,25 @@ class MBTilesDatabase:
         raise Exception("Not implemented.")
 
     # Yields [z, x, y, data]
-    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
         raise Exception("Not implemented.")
 
     # Yields [z, x, y, data, tile_id]
-    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        raise Exception("Not implemented.")
+
+    # Yields [data, tile_id] for every image referenced by the selected tiles
+    def images_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        raise Exception("Not implemented.")
+
+    def images_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
         raise Exception("Not implemented.")
 
     # Yields [z, x, y, data, tile_id]
-    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
+    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
         raise Exception("Not implemented.")
 
-    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
+    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
         raise Exception("Not implemented.")
 
     def delete_tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
@@ -103,6 +252,13 @@ class MBTilesDatabase:
     def expire_tile(self, tile_z, tile_x, tile_y, scale):
         raise Exception("Not implemented.")
 
+    # tile_ranges must be an array of (tile_z, min_x, max_x, min_y, max_y)
+    def expire_tile_ranges(self, tile_ranges, scale):
+        for tile_z, min_x, max_x, min_y, max_y in tile_ranges:
+            for tile_x in range(min_x, max_x+1):
+                for tile_y in range(min_y, max_y+1):
+                    self.expire_tile(tile_z, tile_x, tile_y, scale)
+
     def delete_orphaned_images(self):
         self.cur.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT distinct(tile_id) FROM map)")
 
@@ -134,15 +290,88 @@ class MBTilesDatabase:
     def insert_tiles(self, tile_list):
         raise Exception("Not implemented.")
 
+    # Returns the number of merged tiles
+    def merge_attached_database(self, other_con, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        raise Exception("Not implemented.")
+
     def update_tile(self, old_tile_id, new_tile_id, tile_data):
         raise Exception("Not implemented.")
 
+    # tile_list must be an array of (old_tile_id, new_tile_id, tile_data)
+    def update_tiles(self, tile_list):
+        for t in tile_list:
+            self.update_tile(t[0], t[1], t[2])
+
     def metadata(self):
         raise Exception("Not implemented.")
 
     def update_metadata(self, key, value):
         raise Exception("Not implemented.")
 
+    # Returns the WHERE condition and the bound parameters for the usual tile filters.
+    # The SQL only depends on which filters are used, not on their values, so the
+    # statements can be cached by the driver and the database. Like everywhere else,
+    # zoom levels 0 and 18 mean no limit unless exact_zoom_range is set.
+    def tile_filter(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, prefix="", extra_conditions=[], exact_zoom_range=False):
+        conditions = []
+        params = []
+
+        if min_zoom > 0 or exact_zoom_range:
+            conditions.append("%szoom_level>=%s" % (prefix, self.placeholder))
+            params.append(min_zoom)
+        if max_zoom < 18 or exact_zoom_range:
+            conditions.append("%szoom_level<=%s" % (prefix, self.placeholder))
+            params.append(max_zoom)
+
+        if self.has_scale() and scale is not None:
+            conditions.append("%stile_scale=%s" % (prefix, self.placeholder))
+            params.append(scale)
+
+        if min_timestamp > 0:
+            conditions.append("%supdated_at>%s" % (prefix, self.placeholder))
+            params.append(min_timestamp)
+        if max_timestamp > 0:
+            conditions.append("%supdated_at<%s" % (prefix, self.placeholder))
+            params.append(max_timestamp)
+
+        conditions.extend(extra_conditions)
+
+        if len(conditions) == 0:
+            return ("1=1", params)
+
+        return (" AND ".join(conditions), params)
+
+    # The same for a single tile
+    def tile_position_filter(self, tile_z, tile_x, tile_y, scale, prefix=""):
+        sql = "%szoom_level=%s AND %stile_column=%s AND %stile_row=%s" % (prefix, self.placeholder, prefix, self.placeholder, prefix, self.placeholder)
+        params = [tile_z, tile_x, tile_y]
+
+        if self.has_scale() and scale is not None:
+            sql += " AND %stile_scale=%s" % (prefix, self.placeholder)
+            params.append(scale)
+
+        return (sql, params)
+
+    # All tiles of a zoom level within a rectangle of tile coordinates (inclusive)
+    def tile_range_filter(self, tile_z, min_x, max_x, min_y, max_y, scale, prefix=""):
+        sql = "%szoom_level=%s AND %stile_column>=%s AND %stile_column<=%s AND %stile_row>=%s AND %stile_row<=%s" % (prefix, self.placeholder,
+            prefix, self.placeholder, prefix, self.placeholder, prefix, self.placeholder, prefix, self.placeholder)
+        params = [tile_z, min_x, max_x, min_y, max_y]
+
+        if self.has_scale() and scale is not None:
+            sql += " AND %stile_scale=%s" % (prefix, self.placeholder)
+            params.append(scale)
+
+        return (sql, params)
+
+    # The tile_scale column for SELECTs, the given scale (or 1) for databases without it
+    def scale_column(self, scale, prefix=""):
+        if self.has_scale():
+            return (prefix + "tile_scale", [])
+        elif scale is not None:
+            return (self.placeholder, [scale])
+        return ("1", [])
+
 
 
 class MBTilesSQLite(MBTilesDatabase):
@@ -151,6 +380,9 @@ class MBTilesSQLite(MBTilesDatabase):
         self.connect_string = connect_string
         self.database_is_compacted = None
         self.database_has_scale = None
+        self.database_has_compact_keys = None
+        self.database_in_bulk_load = False
+        self.database_has_refcounts = None
 
         if check_if_exists and not os.path.isfile(connect_string):
             sys.stderr.write('The mbtiles database must exist.\n')
@@ -181,6 +413,21 @@ class MBTilesSQLite(MBTilesDatabase):
             if synchronous_off:
                 self.cur.execute("PRAGMA synchronous = OFF")
 
+            # REPLACE only fires the delete triggers of the image refcounts with this
+            self.cur.execute("PRAGMA recursive_triggers = ON")
+
+            # Used by update_tiles(), created here since pysqlite commits before
+            # a CREATE statement, which would reset any tile iterator in progress
+            self.cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS tile_id_map (
+                old_tile_id VARCHAR(256) PRIMARY KEY,
+                new_tile_id VARCHAR(256) )""")
+
+            # Used by delete_unused_images() for the same reason
+            self.cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS released_images (
+                tile_id VARCHAR(256) PRIMARY KEY )""")
+
         except Exception, e:
             logger.error("Could not connect to the SQLite database:")
             logger.error(e)
@@ -188,6 +435,10 @@ class MBTilesSQLite(MBTilesDatabase):
 
 
     def mbtiles_setup(self):
+        if self.has_compact_keys():
+            self.mbtiles_setup_compact_keys()
+            return
+
         self.cur.execute("PRAGMA page_size = 4096")
 
         self.cur.execute("""
@@ -241,15 +492,232 @@ class MBTilesSQLite(MBTilesDatabase):
             FROM map
             JOIN images
             ON map.tile_id IS NOT NULL AND images.tile_id = map.tile_id""")
+
+        self.create_unique_indexes()
+
+        if self.has_refcounts():
+            self.mbtiles_setup_refcounts()
+
+
+    # map_keys stores a single integer key per tile (see tile_key()) and the tile_id
+    # as a 16 byte digest. map is a view with the usual columns, so reading code works
+    # with both schemas, and the tile filters use the primary key of map_keys.
+    def mbtiles_setup_compact_keys(self):
+        if self.is_compacted() and not self.has_compact_keys():
+            logger.error("The database '%s' already exists without compact keys." % (self.connect_string))
+            sys.exit(1)
+
+        self.cur.execute("PRAGMA page_size = 4096")
+
         self.cur.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map
-            (zoom_level, tile_column, tile_row, tile_scale)""")
+            CREATE TABLE IF NOT EXISTS images (
+            tile_id BLOB,
+            tile_data BLOB )""")
         self.cur.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)""")
+            CREATE TABLE IF NOT EXISTS map_keys (
+            tile_key INTEGER PRIMARY KEY,
+            tile_id BLOB,
+            updated_at INTEGER )""")
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+            name VARCHAR(256),
+            value TEXT )""")
+        self.cur.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)""")
+
+        self.cur.execute("""DROP VIEW IF EXISTS tiles""")
+        self.cur.execute("""DROP VIEW IF EXISTS map""")
+
+        self.cur.execute("""
+            CREATE VIEW map AS
+            SELECT tile_key,
+            tile_key >> 58 AS zoom_level,
+            %s AS tile_column,
+            %s AS tile_row,
+            (tile_key & 3) + 1 AS tile_scale,
+            tile_id,
+            updated_at
+            FROM map_keys""" % (morton_coordinate_sql("tile_key", 2, COMPACT_KEYS_MAX_ZOOM), morton_coordinate_sql("tile_key", 3, COMPACT_KEYS_MAX_ZOOM)))
+        self.cur.execute("""
+            CREATE VIEW tiles AS
+            SELECT map.zoom_level AS zoom_level,
+            map.tile_column AS tile_column,
+            map.tile_row AS tile_row,
+            map.tile_scale AS tile_scale,
+            images.tile_data AS tile_data,
+            map.updated_at AS updated_at,
+            map.tile_key AS tile_key
+            FROM map
+            JOIN images
+            ON map.tile_id IS NOT NULL AND images.tile_id = map.tile_id""")
+
+        self.database_is_compacted = None
+        self.database_has_scale = None
+        self.database_has_compact_keys = None
+        self.database_has_refcounts = None
+
+        self.create_unique_indexes()
+
+        if self.has_refcounts():
+            self.mbtiles_setup_refcounts()
+
+
+    # Creates map_index and images_id, a bulk load (or an interrupted one) may have left
+    # duplicates behind, which are only removed if building an index runs into them.
+    # Keeps the newest row of every tile if replace_existing is set, the oldest otherwise.
+    def create_unique_indexes(self, replace_existing=True):
+        if not self.has_compact_keys():
+            try:
+                self.cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map
+                    (zoom_level, tile_column, tile_row, tile_scale)""")
+            except sqlite3.IntegrityError:
+                logger.info("Removing duplicate tiles from the map")
+                self.cur.execute("""DELETE FROM map WHERE rowid NOT IN
+                    (SELECT %s(rowid) FROM map GROUP BY zoom_level, tile_column, tile_row, tile_scale)""" % ("max" if replace_existing else "min"))
+                self.cur.execute("""
+                    CREATE UNIQUE INDEX map_index ON map
+                    (zoom_level, tile_column, tile_row, tile_scale)""")
+
+        try:
+            self.cur.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)""")
+        except sqlite3.IntegrityError:
+            logger.info("Removing duplicate images")
+            self.cur.execute("""DELETE FROM images WHERE rowid NOT IN
+                (SELECT min(rowid) FROM images GROUP BY tile_id)""")
+            self.cur.execute("""
+                CREATE UNIQUE INDEX images_id ON images (tile_id)""")
+
+
+    # Drops the unique indexes of an empty receiver (or any receiver if forced), so that
+    # REPLACE and INSERT OR IGNORE only append rows. end_bulk_load() then builds the
+    # indexes once, which sorts the rows instead of inserting into the B-trees row by row.
+    # The primary key of map_keys can't be dropped, only images_id is deferred there.
+    def begin_bulk_load(self, force=False):
+        if not self.is_compacted():
+            return False
+
+        if not force and (self.cur.execute("SELECT 1 FROM %s LIMIT 1" % (self.map_table())).fetchone() != None or
+                self.cur.execute("SELECT 1 FROM images LIMIT 1").fetchone() != None):
+            return False
+
+        logger.debug("Dropping the unique indexes for a bulk load")
+
+        self.con.commit()
+        if not self.has_compact_keys():
+            self.cur.execute("""DROP INDEX IF EXISTS map_index""")
+        self.cur.execute("""DROP INDEX IF EXISTS images_id""")
+
+        # The refcounts are counted again at the end
+        if self.has_refcounts():
+            self.drop_refcount_triggers()
+
+        self.database_in_bulk_load = True
+        return True
+
+
+    def end_bulk_load(self, replace_existing=True):
+        if not self.database_in_bulk_load:
+            return
+
+        logger.info("Building the indexes")
+
+        self.con.commit()
+        self.create_unique_indexes(replace_existing)
+        if self.has_refcounts():
+            self.mbtiles_setup_refcounts()
+        self.con.commit()
+
+        self.database_in_bulk_load = False
+
+
+    # Through the primary key or map_index, the map view of compact databases needs a full scan
+    def max_zoom_level_sql(self):
+        if self.has_compact_keys():
+            return "SELECT max(tile_key) >> 58 FROM map_keys"
+        elif not self.is_compacted():
+            return "SELECT max(zoom_level) FROM tiles"
+        return "SELECT max(zoom_level) FROM map"
+
+
+    def has_refcounts(self):
+        if self.database_has_refcounts == None:
+            self.database_has_refcounts = ("refcount" in [row[1] for row in self.cur.execute("PRAGMA table_info(images)").fetchall()])
+        return self.database_has_refcounts
+
+
+    # images.refcount counts the map rows using an image and is kept up to date by triggers
+    # on the map, so unused images are found through the (partial) images_unused index
+    # instead of comparing both tables. The counts are computed again whenever the triggers
+    # are missing. Partial indexes need SQLite >= 3.8.0.
+    def mbtiles_setup_refcounts(self):
+        if not self.is_compacted():
+            logger.error("Image refcounts can only be used with compacted databases.")
+            sys.exit(1)
+
+        if not self.has_refcounts():
+            self.cur.execute("""
+                ALTER TABLE images ADD COLUMN
+                refcount INTEGER default 0""")
+            self.database_has_refcounts = None
+
+        if self.cur.execute("SELECT count(name) FROM sqlite_master WHERE type='trigger' AND name='map_refcount_insert'").fetchone()[0] == 1:
+            return
+
+        logger.info("Counting the references to the images")
+
+        self.cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS image_refcounts (
+            tile_id VARCHAR(256) PRIMARY KEY,
+            refcount INTEGER )""")
+        self.cur.execute("""INSERT INTO image_refcounts (tile_id, refcount)
+            SELECT tile_id, count(*) FROM %s WHERE tile_id IS NOT NULL GROUP BY tile_id""" % (self.map_table()))
+        self.cur.execute("""UPDATE images SET refcount=coalesce(
+            (SELECT image_refcounts.refcount FROM image_refcounts WHERE image_refcounts.tile_id=images.tile_id), 0)""")
+        self.cur.execute("""DROP TABLE image_refcounts""")
+
+        self.cur.execute("""
+            CREATE INDEX IF NOT EXISTS images_unused ON images (tile_id) WHERE refcount=0""")
+        self.cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS map_refcount_delete AFTER DELETE ON %s WHEN OLD.tile_id IS NOT NULL
+            BEGIN
+                UPDATE images SET refcount=refcount-1 WHERE tile_id=OLD.tile_id;
+            END""" % (self.map_table()))
+        self.cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS map_refcount_update AFTER UPDATE OF tile_id ON %s WHEN OLD.tile_id IS NOT NEW.tile_id
+            BEGIN
+                UPDATE images SET refcount=refcount-1 WHERE tile_id=OLD.tile_id;
+                UPDATE images SET refcount=refcount+1 WHERE tile_id=NEW.tile_id;
+            END""" % (self.map_table()))
+        self.cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS map_refcount_insert AFTER INSERT ON %s WHEN NEW.tile_id IS NOT NULL
+            BEGIN
+                UPDATE images SET refcount=refcount+1 WHERE tile_id=NEW.tile_id;
+            END""" % (self.map_table()))
+        self.con.commit()
+
+
+    def drop_refcount_triggers(self):
+        self.cur.execute("""DROP TRIGGER IF EXISTS map_refcount_insert""")
+        self.cur.execute("""DROP TRIGGER IF EXISTS map_refcount_update""")
+        self.cur.execute("""DROP TRIGGER IF EXISTS map_refcount_delete""")
+
+
+    # Remembers the images of the map rows matching where_sql before they are deleted or
+    # expired, so that delete_unused_images() can remove the ones nobody uses anymore
+    def release_images(self, where_sql, params):
+        self.cur.execute("""INSERT OR IGNORE INTO released_images (tile_id)
+            SELECT tile_id FROM map WHERE tile_id IS NOT NULL AND %s""" % (where_sql,), params)
+
+
+    def delete_unused_images(self):
+        self.cur.execute("""DELETE FROM images WHERE refcount=0 AND tile_id IN (SELECT tile_id FROM released_images)""")
+        self.cur.execute("""DELETE FROM released_images""")
 
 
     def create_map_tile_index(self):
-        self.cur.execute("""CREATE INDEX IF NOT EXISTS map_tile_id_index ON map (tile_id)""")
+        self.cur.execute("""CREATE INDEX IF NOT EXISTS map_tile_id_index ON %s (tile_id)""" % (self.map_table()))
 
 
     def drop_map_tile_index(self):
@@ -258,10 +726,101 @@ class MBTilesSQLite(MBTilesDatabase):
 
     def is_compacted(self):
         if self.database_is_compacted == None:
-            self.database_is_compacted = (self.cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND (name='images' OR name='map')").fetchone()[0] == 2)
+            self.database_is_compacted = (self.cur.execute("SELECT count(name) FROM sqlite_master WHERE (type='table' OR type='view') AND (name='images' OR name='map')").fetchone()[0] == 2)
         return self.database_is_compacted
 
 
+    def has_compact_keys(self):
+        if self.database_has_compact_keys == None:
+            self.database_has_compact_keys = (self.cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='map_keys'").fetchone()[0] == 1)
+        return self.database_has_compact_keys
+
+
+    # The table to write the map to, map is a view with compact keys
+    def map_table(self):
+        if self.has_compact_keys():
+            return "map_keys"
+        return "map"
+
+
+    # With compact keys tile_ids are stored as 16 byte digests, the md5 hex digests
+    # used everywhere else are converted on the way in and out
+    def tile_id_value(self, tile_id):
+        if tile_id == None or not self.has_compact_keys():
+            return tile_id
+
+        if len(tile_id) == 32:
+            try:
+                return sqlite3.Binary(binascii.unhexlify(tile_id))
+            except TypeError:
+                pass
+
+        # Other tile_ids, e.g. merged from databases written by other tools
+        return sqlite3.Binary(hashlib.md5(tile_id).digest())
+
+
+    def tile_id_string(self, value):
+        if value == None or not self.has_compact_keys():
+            return value
+        return binascii.hexlify(value)
+
+
+    # With compact keys the zoom levels and the scale are ranges and bits of tile_key,
+    # so the filters can use the primary key instead of the computed columns
+    def tile_filter(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, prefix="", extra_conditions=[], exact_zoom_range=False):
+        if not self.has_compact_keys():
+            return MBTilesDatabase.tile_filter(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, prefix, extra_conditions, exact_zoom_range)
+
+        key_conditions = []
+        key_params = []
+
+        if min_zoom > 0 or exact_zoom_range:
+            key_conditions.append("%stile_key>=?" % (prefix))
+            key_params.append(min_zoom << 58)
+        if max_zoom < 18 or exact_zoom_range:
+            key_conditions.append("%stile_key<?" % (prefix))
+            key_params.append((max_zoom + 1) << 58)
+
+        if scale is not None:
+            key_conditions.append("(%stile_key & 3)=?" % (prefix))
+            key_params.append(scale - 1)
+
+        where_sql, params = MBTilesDatabase.tile_filter(self, 0, 18, min_timestamp, max_timestamp, None, prefix, key_conditions + extra_conditions)
+
+        return (where_sql, params + key_params)
+
+
+    def tile_position_filter(self, tile_z, tile_x, tile_y, scale, prefix=""):
+        if not self.has_compact_keys():
+            return MBTilesDatabase.tile_position_filter(self, tile_z, tile_x, tile_y, scale, prefix)
+
+        if scale is None:
+            key = tile_key(tile_z, tile_x, tile_y, 1)
+            return ("%stile_key>=? AND %stile_key<=?" % (prefix, prefix), [key, key | 3])
+
+        return ("%stile_key=?" % (prefix), [tile_key(tile_z, tile_x, tile_y, scale)])
+
+
+    # The keys of the corners bound all keys of the rectangle on the Z-order curve,
+    # the coordinates are then checked on the rows within these keys
+    def tile_range_filter(self, tile_z, min_x, max_x, min_y, max_y, scale, prefix=""):
+        if not self.has_compact_keys():
+            return MBTilesDatabase.tile_range_filter(self, tile_z, min_x, max_x, min_y, max_y, scale, prefix)
+
+        tile_column = morton_coordinate_sql(prefix + "tile_key", 2, COMPACT_KEYS_MAX_ZOOM)
+        tile_row    = morton_coordinate_sql(prefix + "tile_key", 3, COMPACT_KEYS_MAX_ZOOM)
+
+        sql = "%stile_key>=? AND %stile_key<=? AND %s>=? AND %s<=? AND %s>=? AND %s<=?" % (prefix, prefix,
+            tile_column, tile_column, tile_row, tile_row)
+        params = [tile_key(tile_z, min_x, min_y, 1), tile_key(tile_z, max_x, max_y, 4), min_x, max_x, min_y, max_y]
+
+        if scale is not None:
+            sql += " AND (%stile_key & 3)=?" % (prefix)
+            params.append(scale - 1)
+
+        return (sql, params)
+
+
     def has_scale(self):
         if self.database_has_scale == None:
             try:
@@ -280,46 +839,34 @@ class MBTilesSQLite(MBTilesDatabase):
 
     def zoom_levels(self, scale):
         sql = "SELECT distinct(zoom_level) FROM tiles "
+        params = []
 
         if scale:
-            sql += " WHERE tile_scale=%d " % (scale,)
+            sql += " WHERE tile_scale=? "
+            params.append(scale)
 
-        return [int(x[0]) for x in self.cur.execute(sql).fetchall()]
+        return [int(x[0]) for x in self.cur.execute(sql, params).fetchall()]
 
 
     def tiles_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        sql = "SELECT count(zoom_level) FROM map WHERE "
-
-        if min_zoom > 0:
-            sql += " zoom_level>=%d AND " % (min_zoom,)
-        if max_zoom < 18:
-            sql += " zoom_level<=%d AND " % (max_zoom,)
-
-        if self.has_scale() and scale is not None:
-            sql += " tile_scale=%d AND " % (scale,)
-
         if self.is_compacted():
-            if min_timestamp > 0:
-                sql += " updated_at>%d AND " % (min_timestamp,)
-            if max_timestamp > 0:
-                sql += " updated_at<%d AND " % (max_timestamp,)
-
-            sql += " tile_id IS NOT NULL"
+            where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, extra_conditions=["tile_id IS NOT NULL"])
+            sql = "SELECT count(zoom_level) FROM map WHERE %s" % (where_sql,)
+        else:
+            where_sql, params = self.tile_filter(min_zoom, max_zoom, 0, 0, scale)
+            sql = "SELECT count(zoom_level) FROM tiles WHERE %s" % (where_sql,)
 
         logger.debug(sql)
 
-        return self.cur.execute(sql).fetchone()[0]
+        return self.cur.execute(sql, params).fetchone()[0]
 
 
     def columns_and_rows_for_zoom_level(self, zoom_level, scale):
         tiles_cur = self.con.cursor()
 
-        sql = "SELECT tile_column, tile_row FROM map WHERE zoom_level=%d " % (zoom_level,)
-
-        if self.has_scale() and scale is not None:
-            sql += " AND tile_scale=%d " % (scale,)
+        where_sql, params = self.tile_filter(zoom_level, zoom_level, 0, 0, scale, exact_zoom_range=True)
 
-        tiles = tiles_cur.execute(sql)
+        tiles = tiles_cur.execute("SELECT tile_column, tile_row FROM map WHERE %s" % (where_sql,), params)
 
         t = tiles.fetchone()
         while t:
@@ -330,173 +877,153 @@ class MBTilesSQLite(MBTilesDatabase):
 
 
     def columns_for_zoom_level_and_row(self, zoom_level, row, scale):
-        sql = "SELECT tile_column FROM tiles WHERE zoom_level=%d AND tile_row=%d" % (zoom_level, row)
-
-        if self.has_scale() and scale is not None:
-            sql += " AND tile_scale=%d " % (scale,)
+        where_sql, params = self.tile_filter(zoom_level, zoom_level, 0, 0, scale, extra_conditions=["tile_row=?"], exact_zoom_range=True)
 
-        return set([int(x[0]) for x in self.cur.execute(sql).fetchall()])
+        return set([int(x[0]) for x in self.cur.execute("SELECT tile_column FROM tiles WHERE %s" % (where_sql,), params + [row]).fetchall()])
 
 
-    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
         tiles_cur = self.con.cursor()
 
-        chunk = 10000
+        scale_sql, scale_params = self.scale_column(scale, "map.")
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, "map.",
+            ["map.tile_id IS NOT NULL", "images.tile_id = map.tile_id"])
 
-        sql = "SELECT map.zoom_level, map.tile_column, map.tile_row, "
+        sql = "SELECT map.zoom_level, map.tile_column, map.tile_row, %s, images.tile_data, images.tile_id FROM map, images WHERE %s" % (scale_sql, where_sql)
+        sql += order_by_sql(order, "map.", self.morton_zoom_level(order, max_zoom))
 
-        if self.has_scale():
-            sql +=  "map.tile_scale, "
-        elif scale is not None:
-            sql += "%d, " % (scale,)
-        else:
-            sql += "1, "
+        logger.debug(sql)
 
-        sql += "images.tile_data, images.tile_id FROM map, images WHERE "
+        tiles_cur.execute(sql, scale_params + params)
 
-        inner_sql = ""
+        compact_keys = self.has_compact_keys()
 
-        if min_zoom > 0:
-            inner_sql += " map.zoom_level>=%d " % (min_zoom,)
-        if max_zoom < 18:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " map.zoom_level<=%d " % (max_zoom,)
+        rows = tiles_cur.fetchmany(self.itersize)
+        while rows:
+            for t in rows:
+                if compact_keys:
+                    t = t[:5] + (self.tile_id_string(t[5]), )
+                yield t
+            rows = tiles_cur.fetchmany(self.itersize)
 
-        if self.has_scale() and scale is not None:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " tile_scale=%d " % (scale,)
+        tiles_cur.close()
 
-        if min_timestamp > 0:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " map.updated_at>%d " % (min_timestamp,)
-        if max_timestamp > 0:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " map.updated_at<%d " % (max_timestamp,)
 
-        if len(inner_sql) > 0:
-            sql += " (%s) AND " % (inner_sql,)
-        sql += " (map.tile_id IS NOT NULL) AND (images.tile_id == map.tile_id) "
+    def images_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        tiles_cur = self.con.cursor()
+
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, extra_conditions=["tile_id IS NOT NULL"])
+
+        if order == None:
+            sql = "SELECT images.tile_data, images.tile_id FROM images JOIN (SELECT DISTINCT tile_id FROM map WHERE %s) AS m ON m.tile_id = images.tile_id" % (where_sql,)
+        else:
+            # Images shared by several tiles are sorted by their first position
+            sql = "SELECT images.tile_data, images.tile_id FROM images JOIN (SELECT tile_id, MIN(%s) AS sort_key FROM map WHERE %s GROUP BY tile_id) AS m ON m.tile_id = images.tile_id ORDER BY m.sort_key" % (sort_key_sql(order, "", self.morton_zoom_level(order, max_zoom)), where_sql)
 
         logger.debug(sql)
 
-        tiles_cur.execute(sql)
+        tiles_cur.execute(sql, params)
 
-        rows = tiles_cur.fetchmany(chunk)
+        compact_keys = self.has_compact_keys()
+
+        rows = tiles_cur.fetchmany(self.itersize)
         while rows:
             for t in rows:
+                if compact_keys:
+                    t = (t[0], self.tile_id_string(t[1]))
                 yield t
-            rows = tiles_cur.fetchmany(chunk)
+            rows = tiles_cur.fetchmany(self.itersize)
 
         tiles_cur.close()
 
 
-    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        tiles_cur = self.con.cursor()
+    def images_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, extra_conditions=["tile_id IS NOT NULL"])
 
-        chunk = 10000
+        sql = "SELECT count(images.tile_id) FROM images JOIN (SELECT DISTINCT tile_id FROM map WHERE %s) AS m ON m.tile_id = images.tile_id" % (where_sql,)
 
-        sql = "SELECT zoom_level, tile_column, tile_row, "
-
-        if self.has_scale():
-            sql +=  "tile_scale, "
-        elif scale is not None:
-            sql += "%d, " % (scale,)
-        else:
-            sql += "1, "
+        logger.debug(sql)
 
-        sql += " tile_data FROM tiles WHERE "
+        return self.cur.execute(sql, params).fetchone()[0]
 
-        if min_zoom > 0:
-            sql += " zoom_level>=%d AND " % (min_zoom,)
-        if max_zoom < 18:
-            sql += " zoom_level<=%d AND " % (max_zoom,)
 
-        if self.has_scale() and scale is not None:
-            sql += " tile_scale=%d AND " % (scale,)
+    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        tiles_cur = self.con.cursor()
 
+        scale_sql, scale_params = self.scale_column(scale)
         if self.is_compacted():
-            if min_timestamp > 0:
-                sql += " updated_at>%d AND " % (min_timestamp,)
-            if max_timestamp > 0:
-                sql += " updated_at<%d AND " % (max_timestamp,)
+            where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
+        else:
+            where_sql, params = self.tile_filter(min_zoom, max_zoom, 0, 0, scale)
 
-        sql += " 1 "
+        sql = "SELECT zoom_level, tile_column, tile_row, %s, tile_data FROM tiles WHERE %s" % (scale_sql, where_sql)
+        sql += order_by_sql(order, "", self.morton_zoom_level(order, max_zoom))
 
         logger.debug(sql)
 
-        tiles_cur.execute(sql)
+        tiles_cur.execute(sql, scale_params + params)
 
-        rows = tiles_cur.fetchmany(chunk)
+        rows = tiles_cur.fetchmany(self.itersize)
         while rows:
             for t in rows:
                 yield t
-            rows = tiles_cur.fetchmany(chunk)
+            rows = tiles_cur.fetchmany(self.itersize)
 
         tiles_cur.close()
 
 
-    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
+    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
         tiles_cur = self.con.cursor()
 
-        chunk = 10000
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, "map.", exact_zoom_range=True)
 
         tiles_cur.execute("""
             SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_scale, images.tile_data, images.tile_id
             FROM map, images
-            WHERE (map.zoom_level>=? and map.zoom_level<=? AND map.updated_at>? AND map.updated_at<?) AND (images.tile_id == map.tile_id)
-            UNION
+            WHERE (%s) AND (images.tile_id = map.tile_id)
+            UNION ALL
             SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_scale, NULL, NULL
             FROM map
-            WHERE (map.zoom_level>=? and map.zoom_level<=? AND map.updated_at>? AND map.updated_at<?) AND (map.tile_id IS NULL)
-            """,
-            (min_zoom, max_zoom, min_timestamp, max_timestamp, min_zoom, max_zoom, min_timestamp, max_timestamp))
+            WHERE (%s) AND (map.tile_id IS NULL)
+            """ % (where_sql, where_sql),
+            params + params)
 
-        rows = tiles_cur.fetchmany(chunk)
+        compact_keys = self.has_compact_keys()
+
+        rows = tiles_cur.fetchmany(self.itersize)
         while rows:
             for t in rows:
+                if compact_keys:
+                    t = t[:5] + (self.tile_id_string(t[5]), )
                 yield t
-            rows = tiles_cur.fetchmany(chunk)
+            rows = tiles_cur.fetchmany(self.itersize)
 
         tiles_cur.close()
 
 
-    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
-        total_tiles = self.cur.execute("""SELECT count(zoom_level) FROM map WHERE zoom_level>=? AND zoom_level<=? AND updated_at>? AND updated_at<?""",
-            (min_zoom, max_zoom, min_timestamp, max_timestamp)).fetchone()[0]
+    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True)
 
-        return total_tiles
+        return self.cur.execute("SELECT count(zoom_level) FROM map WHERE %s" % (where_sql,), params).fetchone()[0]
 
 
     def delete_tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
         if self.is_compacted():
-            sql_images = "SELECT tile_id FROM map WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-            sql_map = "DELETE FROM map WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-
-            if self.has_scale() and scale is not None:
-                sql_images += " AND tile_scale=%d " % (scale,)
-                sql_map += " AND tile_scale=%d " % (scale,)
+            where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True)
 
-            if min_timestamp > 0:
-                sql_images += " AND updated_at>%d " % (min_timestamp,)
-                sql_map += " AND updated_at>%d " % (min_timestamp,)
-            if max_timestamp > 0:
-                sql_images += " AND updated_at<%d " (max_timestamp,)
-                sql_map += " AND updated_at<%d " % (max_timestamp,)
+            if self.has_refcounts():
+                self.release_images(where_sql, params)
+                self.cur.execute("DELETE FROM %s WHERE %s" % (self.map_table(), where_sql), params)
+                self.delete_unused_images()
+                return
 
-            self.cur.execute("DELETE FROM images WHERE tile_id IN (%s)" % (sql_images,))
-            self.cur.execute(sql_map)
+            self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+            self.cur.execute("DELETE FROM %s WHERE %s" % (self.map_table(), where_sql), params)
 
         else:
-            sql += "DELETE FROM tiles WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-
-            if self.has_scale() and scale is not None:
-                sql += " AND tile_scale=%d " % (scale,)
+            where_sql, params = self.tile_filter(min_zoom, max_zoom, 0, 0, scale, exact_zoom_range=True)
 
-            self.cur.execute(sql)
+            self.cur.execute("DELETE FROM tiles WHERE %s" % (where_sql,), params)
 
 
     def expire_tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
@@ -504,69 +1031,77 @@ class MBTilesSQLite(MBTilesDatabase):
             self.delete_tiles(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
             return
 
-        sql_images = "SELECT tile_id FROM map WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-        sql_map = "UPDATE map SET tile_id=NULL, updated_at=%d WHERE zoom_level>=%d AND zoom_level<=%d " % (int(time.time()), min_zoom, max_zoom)
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True)
 
-        if self.has_scale() and scale is not None:
-            sql_images += " AND tile_scale=%d " % (scale,)
-            sql_map += " AND tile_scale=%d " % (scale,)
-
-        if min_timestamp > 0:
-            sql_images += " AND updated_at>%d " % (min_timestamp,)
-            sql_map += " AND updated_at>%d " % (min_timestamp,)
-        if max_timestamp > 0:
-            sql_images += " AND updated_at<%d " % (max_timestamp,)
-            sql_map += " AND updated_at<%d " % (max_timestamp,)
-
-        self.cur.execute("DELETE FROM images WHERE tile_id IN (%s)" % (sql_images,))
-        self.cur.execute(sql_map)
+        self.expire_map_rows(where_sql, params)
 
 
     def expire_tile(self, tile_z, tile_x, tile_y, scale):
+        where_sql, params = self.tile_position_filter(tile_z, tile_x, tile_y, scale)
+
         if self.is_compacted():
-            sql_images = "SELECT tile_id FROM map WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d " % (tile_z, tile_x, tile_y)
-            sql_map = "UPDATE map SET tile_id=NULL, updated_at=%d WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d " % (int(time.time()), tile_z, tile_x, tile_y)
+            self.expire_map_rows(where_sql, params)
 
-            if self.has_scale() and scale is not None:
-                sql_images += " AND tile_scale=%d " % (scale,)
-                sql_map += " AND tile_scale=%d " % (scale,)
+        else:
+            self.cur.execute("DELETE FROM tiles WHERE %s" % (where_sql,), params)
+
+
+    # One ranged statement per rectangle, which finds the existing tiles through map_index
+    def expire_tile_ranges(self, tile_ranges, scale):
+        for tile_z, min_x, max_x, min_y, max_y in tile_ranges:
+            where_sql, params = self.tile_range_filter(tile_z, min_x, max_x, min_y, max_y, scale)
+
+            if self.is_compacted():
+                self.expire_map_rows(where_sql, params)
+
+            else:
+                self.cur.execute("DELETE FROM tiles WHERE %s" % (where_sql,), params)
 
-            self.cur.execute("DELETE FROM images WHERE tile_id IN (%s)" % (sql_images,))
-            self.cur.execute(sql_map)
 
+    # Without refcounts, the images are deleted even if other tiles still use them
+    def expire_map_rows(self, where_sql, params):
+        if self.has_refcounts():
+            self.release_images(where_sql, params)
+            self.cur.execute("UPDATE %s SET tile_id=NULL, updated_at=? WHERE %s" % (self.map_table(), where_sql), [int(time.time())] + params)
+            self.delete_unused_images()
         else:
-            sql = "DELETE FROM tiles WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d " % (tile_z, tile_x, tile_y)
+            self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+            self.cur.execute("UPDATE %s SET tile_id=NULL, updated_at=? WHERE %s" % (self.map_table(), where_sql), [int(time.time())] + params)
 
-            if self.has_scale() and scale is not None:
-                sql += " AND tile_scale=%d " % (scale,)
 
-            self.cur.execute(sql)
+    def delete_orphaned_images(self):
+        if self.has_refcounts():
+            self.cur.execute("DELETE FROM images WHERE refcount=0")
+        else:
+            MBTilesDatabase.delete_orphaned_images(self)
 
 
     def bounding_box_for_zoom_level(self, zoom_level, scale):
-        sql = "SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row) FROM tiles WHERE zoom_level=%d " % (zoom_level,)
+        where_sql, params = self.tile_filter(zoom_level, zoom_level, 0, 0, scale, exact_zoom_range=True)
 
-        if self.has_scale() and scale is not None:
-            sql += " AND tile_scale=%d " % (scale,)
-
-        return self.cur.execute(sql).fetchone()
+        return self.cur.execute("SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row) FROM tiles WHERE %s" % (where_sql,), params).fetchone()
 
 
     def delete_tile_with_id(self, tile_id):
-        self.cur.execute("""DELETE FROM map WHERE tile_id=?""", (tile_id, ));
-        self.cur.execute("""DELETE FROM images WHERE tile_id=?""", (tile_id, ))
+        self.cur.execute("""DELETE FROM %s WHERE tile_id=?""" % (self.map_table()), (self.tile_id_value(tile_id), ));
+        self.cur.execute("""DELETE FROM images WHERE tile_id=?""", (self.tile_id_value(tile_id), ))
 
 
     def insert_tile_to_images(self, tile_id, tile_data):
         self.cur.execute("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
-            (tile_id, sqlite3.Binary(tile_data)))
+            (self.tile_id_value(tile_id), sqlite3.Binary(tile_data)))
 
 
     def insert_tiles_to_images(self, tile_list):
-        self.cur.executemany("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""", [(t[0], sqlite3.Binary(t[1])) for t in tile_list])
+        self.cur.executemany("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""", [(self.tile_id_value(t[0]), sqlite3.Binary(t[1])) for t in tile_list])
 
 
     def insert_tile_to_map(self, zoom_level, tile_column, tile_row, tile_scale, tile_id, replace_existing=True):
+        if self.has_compact_keys():
+            self.cur.execute("""%s INTO map_keys (tile_key, tile_id, updated_at) VALUES (?, ?, ?)""" % ("REPLACE" if replace_existing else "INSERT OR IGNORE"),
+                (tile_key(zoom_level, tile_column, tile_row, tile_scale), self.tile_id_value(tile_id), int(time.time())))
+            return
+
         if replace_existing:
             if self.has_scale():
                 self.cur.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_scale, tile_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)""",
@@ -584,21 +1119,88 @@ class MBTilesSQLite(MBTilesDatabase):
 
 
     def insert_tiles_to_map(self, tile_list):
-        if self.has_scale():
+        if self.has_compact_keys():
+            self.cur.executemany("""REPLACE INTO map_keys (tile_key, tile_id, updated_at) VALUES (?, ?, ?)""",
+                [(tile_key(t[0], t[1], t[2], t[3]), self.tile_id_value(t[4]), t[5]) for t in tile_list])
+        elif self.has_scale():
             self.cur.executemany("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_scale, tile_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)""", tile_list)
         else:
             self.cur.executemany("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id, updated_at) VALUES (?, ?, ?, ?, ?)""", tile_list)
 
 
+    # Merges the tiles of another compacted SQLite database without moving them through Python,
+    # returns the number of merged tiles
+    def merge_attached_database(self, other_con, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        # ATTACH is not allowed within a transaction
+        self.con.commit()
+        self.cur.execute("""ATTACH DATABASE ? AS source""", (other_con.connect_string,))
+
+        inner_sql, params = other_con.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, "m.", ["m.tile_id IS NOT NULL"])
+        tile_scale, scale_params = other_con.scale_column(scale, "m.")
+
+        sql_images = """INSERT OR IGNORE INTO images (tile_id, tile_data)
+            SELECT i.tile_id, i.tile_data FROM source.images i
+            WHERE i.tile_id IN (SELECT m.tile_id FROM source.map m WHERE %s)""" % (inner_sql,)
+        sql_map = """REPLACE INTO map (zoom_level, tile_column, tile_row, tile_scale, tile_id, updated_at)
+            SELECT m.zoom_level, m.tile_column, m.tile_row, %s, m.tile_id, ?
+            FROM source.map m JOIN source.images i ON i.tile_id = m.tile_id
+            WHERE %s""" % (tile_scale, inner_sql)
+
+        # Both databases have compact keys, the keys and tile_ids are copied as they are
+        if self.has_compact_keys():
+            scale_params = []
+            sql_map = """REPLACE INTO map_keys (tile_key, tile_id, updated_at)
+                SELECT m.tile_key, m.tile_id, ?
+                FROM source.map m JOIN source.images i ON i.tile_id = m.tile_id
+                WHERE %s""" % (inner_sql,)
+
+        logger.debug(sql_images)
+        logger.debug(sql_map)
+
+        try:
+            self.cur.execute(sql_images, params)
+            self.cur.execute(sql_map, scale_params + [int(time.time())] + params)
+            count = self.cur.rowcount
+            self.con.commit()
+        except:
+            self.con.rollback()
+            raise
+        finally:
+            self.cur.execute("""DETACH DATABASE source""")
+
+        return count
+
+
     def update_tile(self, old_tile_id, new_tile_id, tile_data):
-        self.cur.execute("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
-            (new_tile_id, sqlite3.Binary(tile_data)))
-        self.cur.execute("""UPDATE map SET tile_id=?, updated_at=? WHERE tile_id=?""",
-            (new_tile_id, int(time.time()), old_tile_id))
+        self.cur.execute("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+            (self.tile_id_value(new_tile_id), sqlite3.Binary(tile_data)))
+        self.cur.execute("""UPDATE %s SET tile_id=?, updated_at=? WHERE tile_id=?""" % (self.map_table()),
+            (self.tile_id_value(new_tile_id), int(time.time()), self.tile_id_value(old_tile_id)))
 
         if old_tile_id != new_tile_id:
             self.cur.execute("""DELETE FROM images WHERE tile_id=?""",
-                [old_tile_id])
+                [self.tile_id_value(old_tile_id)])
+
+
+    def update_tiles(self, tile_list):
+        self.cur.executemany("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+            [(self.tile_id_value(t[1]), sqlite3.Binary(t[2])) for t in tile_list])
+        self.cur.executemany("""REPLACE INTO tile_id_map (old_tile_id, new_tile_id) VALUES (?, ?)""",
+            [(self.tile_id_value(t[0]), self.tile_id_value(t[1])) for t in tile_list])
+
+        self.cur.execute("""UPDATE %(map)s SET tile_id=(SELECT new_tile_id FROM tile_id_map WHERE old_tile_id=%(map)s.tile_id), updated_at=?
+            WHERE tile_id IN (SELECT old_tile_id FROM tile_id_map)""" % {'map' : self.map_table()},
+            (int(time.time()),))
+
+        # An old image might also be the new image of another tile
+        if self.has_refcounts():
+            self.cur.execute("""DELETE FROM images WHERE tile_id IN (SELECT old_tile_id FROM tile_id_map WHERE old_tile_id!=new_tile_id)
+                AND refcount=0""")
+        else:
+            self.cur.execute("""DELETE FROM images WHERE tile_id IN (SELECT old_tile_id FROM tile_id_map WHERE old_tile_id!=new_tile_id)
+                AND NOT EXISTS (SELECT 1 FROM %(map)s WHERE %(map)s.tile_id=images.tile_id)""" % {'map' : self.map_table()})
+
+        self.cur.execute("""DELETE FROM tile_id_map""")
 
 
     def metadata(self):
@@ -616,11 +1218,18 @@ class MBTilesSQLite(MBTilesDatabase):
 
 class MBTilesPostgres(MBTilesDatabase):
 
+    placeholder = "%s"
+
     def __init__(self, connect_string, auto_commit=False, journal_mode='wal', synchronous_off=False, exclusive_lock=False, check_if_exists=False):
         self.database_has_scale = None
 
         try:
 
+            # The driver is only imported when it is used, so the other backends and the
+            # CLI don't depend on it and start faster
+            global psycopg2
+            import psycopg2
+
             if connect_string.startswith("pg:"):
                 if os.path.isfile("/etc/mb-util.conf"):
                     config = {}
@@ -798,35 +1407,24 @@ class MBTilesPostgres(MBTilesDatabase):
 
     def zoom_levels(self, scale):
         sql = "SELECT distinct(zoom_level) FROM tiles "
+        params = []
 
         if scale is not None:
-            sql += " WHERE tile_scale=%d " % (scale,)
+            sql += " WHERE tile_scale=%s "
+            params.append(scale)
 
-        self.cur.execute(sql)
+        self.cur.execute(sql, params)
         return [int(x[0]) for x in self.cur.fetchall()]
 
 
     def tiles_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        sql = "SELECT count(zoom_level) FROM map WHERE "
-
-        if min_zoom > 0:
-            sql += " zoom_level>=%d AND " % (min_zoom,)
-        if max_zoom < 18:
-            sql += " zoom_level<=%d AND " % (max_zoom,)
-
-        if self.has_scale() and scale is not None:
-            sql += " tile_scale=%d AND " % (scale,)
-
-        if min_timestamp > 0:
-            sql += " updated_at>%d AND " % (min_timestamp,)
-        if max_timestamp > 0:
-            sql += " updated_at<%d AND " % (max_timestamp,)
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, extra_conditions=["tile_id IS NOT NULL"])
 
-        sql += " tile_id IS NOT NULL"
+        sql = "SELECT count(zoom_level) FROM map WHERE %s" % (where_sql,)
 
         logger.debug(sql)
 
-        self.cur.execute(sql)
+        self.cur.execute(sql, params)
 
         return self.cur.fetchone()[0]
 
@@ -834,12 +1432,9 @@ class MBTilesPostgres(MBTilesDatabase):
     def columns_and_rows_for_zoom_level(self, zoom_level, scale):
         tiles_cur = self.con.cursor()
 
-        sql = "SELECT tile_column, tile_row FROM map WHERE zoom_level=%d " % (zoom_level,)
-
-        if self.has_scale() and scale is not None:
-            sql += " AND tile_scale=%d " % (scale,)
+        where_sql, params = self.tile_filter(zoom_level, zoom_level, 0, 0, scale, exact_zoom_range=True)
 
-        tiles = tiles_cur.execute(sql)
+        tiles_cur.execute("SELECT tile_column, tile_row FROM map WHERE %s" % (where_sql,), params)
 
         t = tiles_cur.fetchone()
         while t:
@@ -850,208 +1445,141 @@ class MBTilesPostgres(MBTilesDatabase):
 
 
     def columns_for_zoom_level_and_row(self, zoom_level, row, scale):
-        sql = "SELECT tile_column FROM tiles WHERE zoom_level=%d AND tile_row=%d" % (zoom_level, row)
+        where_sql, params = self.tile_filter(zoom_level, zoom_level, 0, 0, scale, extra_conditions=["tile_row=%s"], exact_zoom_range=True)
 
-        if self.has_scale() and scale is not None:
-            sql += " AND tile_scale=%d " % (scale,)
-
-        self.cur.execute(sql)
+        self.cur.execute("SELECT tile_column FROM tiles WHERE " + where_sql, params + [row])
 
         return set([int(x[0]) for x in self.cur.fetchall()])
 
 
-    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        # Second connection to the database, for the named cursor
+    # Yields the rows of a query itersize rows at a time from a named cursor, which keeps
+    # the result on the server. It needs a second connection, since self.con is in
+    # autocommit mode and the tiles are usually written while they are read.
+    def streaming_rows(self, sql, params):
         iter_con = psycopg2.connect(self.connect_string)
 
-        tiles_cur = iter_con.cursor("tiles_with_tile_id_cursor")
-
-        sql = "SELECT map.zoom_level, map.tile_column, map.tile_row, "
-
-        if self.has_scale():
-            sql +=  "map.tile_scale, "
-        elif scale is not None:
-            sql += "%d, " % (scale,)
-        else:
-            sql += "1, "
-
-        sql += "images.tile_data, images.tile_id FROM map, images WHERE "
+        try:
+            tiles_cur = iter_con.cursor("streaming_rows_cursor")
+            tiles_cur.execute(sql, params)
 
-        inner_sql = ""
+            rows = tiles_cur.fetchmany(self.itersize)
+            while rows:
+                for t in rows:
+                    yield t
+                rows = tiles_cur.fetchmany(self.itersize)
 
-        if min_zoom > 0:
-            inner_sql += " map.zoom_level>=%d " % (min_zoom,)
-        if max_zoom < 18:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " map.zoom_level<=%d " % (max_zoom,)
+            tiles_cur.close()
+        finally:
+            iter_con.close()
 
-        if self.has_scale() and scale is not None:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " tile_scale=%d " % (scale,)
 
-        if min_timestamp > 0:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " map.updated_at>%d " % (min_timestamp,)
-        if max_timestamp > 0:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " map.updated_at<%d " % (max_timestamp,)
+    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        scale_sql, scale_params = self.scale_column(scale, "map.")
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, "map.",
+            ["map.tile_id IS NOT NULL", "images.tile_id = map.tile_id"])
 
-        if len(inner_sql) > 0:
-            sql += " (%s) AND " % (inner_sql,)
-        sql += " (map.tile_id IS NOT NULL) AND (images.tile_id = map.tile_id) "
+        sql = "SELECT map.zoom_level, map.tile_column, map.tile_row, %s, images.tile_data, images.tile_id FROM map, images WHERE %s" % (scale_sql, where_sql)
+        sql += order_by_sql(order, "map.", self.morton_zoom_level(order, max_zoom), "CAST(%s AS BIGINT)")
 
         logger.debug(sql)
 
-        tiles_cur.execute(sql)
-
-        t = tiles_cur.fetchone()
-        while t:
-            yield t
-            t = tiles_cur.fetchone()
+        return self.streaming_rows(sql, scale_params + params)
 
-        tiles_cur.close()
-        iter_con.close()
 
+    def images_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, extra_conditions=["tile_id IS NOT NULL"])
 
-    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        # Second connection to the database, for the named cursor
-        iter_con = psycopg2.connect(self.connect_string)
+        if order == None:
+            sql = "SELECT images.tile_data, images.tile_id FROM images JOIN (SELECT DISTINCT tile_id FROM map WHERE %s) AS m ON m.tile_id = images.tile_id" % (where_sql,)
+        else:
+            # Images shared by several tiles are sorted by their first position
+            sql = "SELECT images.tile_data, images.tile_id FROM images JOIN (SELECT tile_id, MIN(%s) AS sort_key FROM map WHERE %s GROUP BY tile_id) AS m ON m.tile_id = images.tile_id ORDER BY m.sort_key" % (sort_key_sql(order, "", self.morton_zoom_level(order, max_zoom), "CAST(%s AS BIGINT)"), where_sql)
 
-        tiles_cur = iter_con.cursor("tiles_cursor")
+        logger.debug(sql)
 
-        sql = "SELECT zoom_level, tile_column, tile_row, "
+        return self.streaming_rows(sql, params)
 
-        if self.has_scale():
-            sql +=  "tile_scale, "
-        elif scale is not None:
-            sql += "%d, " % (scale,)
-        else:
-            sql += "1, "
 
-        sql += " tile_data FROM tiles WHERE "
+    def images_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, extra_conditions=["tile_id IS NOT NULL"])
 
-        if min_zoom > 0:
-            sql += " zoom_level>=%d AND " % (min_zoom,)
-        if max_zoom < 18:
-            sql += " zoom_level<=%d AND " % (max_zoom,)
+        sql = "SELECT count(images.tile_id) FROM images JOIN (SELECT DISTINCT tile_id FROM map WHERE %s) AS m ON m.tile_id = images.tile_id" % (where_sql,)
 
-        if self.has_scale() and scale is not None:
-            sql += " tile_scale=%d AND " % (scale,)
+        logger.debug(sql)
 
-        if min_timestamp > 0:
-            sql += " updated_at>%d AND " % (min_timestamp,)
-        if max_timestamp > 0:
-            sql += " updated_at<%d AND " % (max_timestamp,)
+        self.cur.execute(sql, params)
 
-        sql += " 1 "
+        return self.cur.fetchone()[0]
 
-        logger.debug(sql)
 
-        tiles_cur.execute(sql)
+    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        scale_sql, scale_params = self.scale_column(scale)
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
 
-        t = tiles_cur.fetchone()
-        while t:
-            yield t
-            t = tiles_cur.fetchone()
+        sql = "SELECT zoom_level, tile_column, tile_row, %s, tile_data FROM tiles WHERE %s" % (scale_sql, where_sql)
+        sql += order_by_sql(order, "", self.morton_zoom_level(order, max_zoom), "CAST(%s AS BIGINT)")
 
-        tiles_cur.close()
-        iter_con.close()
+        logger.debug(sql)
 
+        return self.streaming_rows(sql, scale_params + params)
 
-    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
-        # Second connection to the database, for the named cursor
-        iter_con = psycopg2.connect(self.connect_string)
 
-        tiles_cur = iter_con.cursor("tiles_with_tile_id_cursor")
+    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, "map.", exact_zoom_range=True)
 
-        tiles_cur.execute("""
+        return self.streaming_rows("""
             SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_scale, images.tile_data, images.tile_id
             FROM map, images
-            WHERE (map.zoom_level>=%s and map.zoom_level<=%s AND map.updated_at>%s AND map.updated_at<%s) AND (images.tile_id = map.tile_id)
-            UNION
+            WHERE (%s) AND (images.tile_id = map.tile_id)
+            UNION ALL
             SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_scale, NULL, NULL
             FROM map
-            WHERE (map.zoom_level>=%s and map.zoom_level<=%s AND map.updated_at>%s AND map.updated_at<%s) AND map.tile_id IS NULL
-            """,
-            (min_zoom, max_zoom, min_timestamp, max_timestamp, min_zoom, max_zoom, min_timestamp, max_timestamp))
-
-        t = tiles_cur.fetchone()
-        while t:
-            yield t
-            t = tiles_cur.fetchone()
+            WHERE (%s) AND map.tile_id IS NULL
+            """ % (where_sql, where_sql),
+            params + params)
 
-        tiles_cur.close()
-        iter_con.close()
 
+    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True)
 
-    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
-        self.cur.execute("""SELECT count(zoom_level) FROM map WHERE zoom_level>=%s AND zoom_level<=%s AND updated_at>%s AND updated_at<%s""",
-            (min_zoom, max_zoom, min_timestamp, max_timestamp))
+        self.cur.execute("SELECT count(zoom_level) FROM map WHERE %s" % (where_sql,), params)
 
         return self.cur.fetchone()[0]
 
 
     def delete_tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        sql_images = "SELECT tile_id FROM map WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-        sql_map = "DELETE FROM map WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-
-        if self.has_scale() and scale is not None:
-            sql_images += " AND tile_scale=%d " % (scale,)
-            sql_map += " AND tile_scale=%d " % (scale,)
-
-        if min_timestamp > 0:
-            sql_images += " AND updated_at>%d " % (min_timestamp,)
-            sql_map += " AND updated_at>%d " % (min_timestamp,)
-        if max_timestamp > 0:
-            sql_images += " AND updated_at<%d " (max_timestamp,)
-            sql_map += " AND updated_at<%d " % (max_timestamp,)
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True)
 
-        self.cur.execute("DELETE FROM images WHERE tile_id IN (%s)" % (sql_images,))
-        self.cur.execute(sql_map)
+        self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+        self.cur.execute("DELETE FROM map WHERE %s" % (where_sql,), params)
 
 
     def expire_tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        sql_images = "SELECT tile_id FROM map WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-        sql_map = "UPDATE map SET tile_id=NULL, updated_at=%d WHERE zoom_level>=%d AND zoom_level<=%d " % (int(time.time()), min_zoom, max_zoom)
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True)
 
-        if self.has_scale() and scale is not None:
-            sql_images += " AND tile_scale=%d " % (scale,)
-            sql_map += " AND tile_scale=%d " % (scale,)
+        self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+        self.cur.execute("UPDATE map SET tile_id=NULL, updated_at=%s WHERE " + where_sql, [int(time.time())] + params)
 
-        if min_timestamp > 0:
-            sql_images += " AND updated_at>%d " % (min_timestamp,)
-            sql_map += " AND updated_at>%d " % (min_timestamp,)
-        if max_timestamp > 0:
-            sql_images += " AND updated_at<%d " % (max_timestamp,)
-            sql_map += " AND updated_at<%d " % (max_timestamp,)
 
-        self.cur.execute("DELETE FROM images WHERE tile_id IN (%s)" % (sql_images,))
-        self.cur.execute(sql_map)
+    def expire_tile(self, tile_z, tile_x, tile_y, scale):
+        where_sql, params = self.tile_position_filter(tile_z, tile_x, tile_y, scale)
 
+        self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+        self.cur.execute("UPDATE map SET tile_id=NULL, updated_at=%s WHERE " + where_sql, [int(time.time())] + params)
 
-    def expire_tile(self, tile_z, tile_x, tile_y, scale):
-        sql_images = "SELECT tile_id FROM map WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d " % (tile_z, tile_x, tile_y)
-        sql_map = "UPDATE map SET tile_id=NULL, updated_at=%d WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d " % (int(time.time()), tile_z, tile_x, tile_y)
 
-        if self.has_scale() and scale is not None:
-            sql_images += " AND tile_scale=%d " % (scale,)
-            sql_map += " AND tile_scale=%d " % (scale,)
+    def expire_tile_ranges(self, tile_ranges, scale):
+        for tile_z, min_x, max_x, min_y, max_y in tile_ranges:
+            where_sql, params = self.tile_range_filter(tile_z, min_x, max_x, min_y, max_y, scale)
 
-        self.cur.execute("DELETE FROM images WHERE tile_id IN (%s)" % (sql_images,))
-        self.cur.execute(sql_map)
+            self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+            self.cur.execute("UPDATE map SET tile_id=NULL, updated_at=%s WHERE " + where_sql, [int(time.time())] + params)
 
 
     def bounding_box_for_zoom_level(self, zoom_level, scale):
-        sql = "SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row) FROM tiles WHERE zoom_level=%d " % (zoom_level,)
+        where_sql, params = self.tile_filter(zoom_level, zoom_level, 0, 0, scale, exact_zoom_range=True)
 
-        if self.has_scale() and scale is not None:
-            sql += " AND tile_scale=%d " % (scale,)
-
-        self.cur.execute(sql)
+        self.cur.execute("SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row) FROM tiles WHERE %s" % (where_sql,), params)
         return self.cur.fetchone()
 
 
@@ -1068,9 +1596,35 @@ class MBTilesPostgres(MBTilesDatabase):
             pass
 
 
+    # Loads the rows into a temporary staging table with COPY
+    def copy_to_staging(self, table, columns, rows):
+        data = StringIO.StringIO()
+        for row in rows:
+            data.write("\t".join([copy_value(v) for v in row]))
+            data.write("\n")
+        data.seek(0)
+
+        self.cur.copy_from(data, table, columns=columns)
+
+
     def insert_tiles_to_images(self, tile_list):
-        for t in tile_list:
-            self.insert_tile_to_images(t[0], t[1])
+        self.cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS images_staging (
+            tile_id VARCHAR(256),
+            tile_data BYTEA ) ON COMMIT DELETE ROWS""")
+
+        self.cur.execute("BEGIN")
+
+        try:
+            self.copy_to_staging("images_staging", ("tile_id", "tile_data"),
+                [(t[0], "\\x" + binascii.hexlify(t[1])) for t in tile_list])
+            self.cur.execute("""INSERT INTO images (tile_id, tile_data)
+                SELECT DISTINCT ON (tile_id) tile_id, tile_data FROM images_staging
+                ON CONFLICT (tile_id) DO NOTHING""")
+            self.cur.execute("COMMIT")
+        except:
+            self.cur.execute("ROLLBACK")
+            raise
 
 
     def insert_tile_to_map(self, zoom_level, tile_column, tile_row, tile_scale, tile_id, replace_existing=True):
@@ -1094,8 +1648,36 @@ class MBTilesPostgres(MBTilesDatabase):
 
 
     def insert_tiles_to_map(self, tile_list):
-        for t in tile_list:
-            self.insert_tile_to_map(t[0], t[1], t[2], t[3], t[4])
+        self.cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS map_staging (
+            seq SERIAL,
+            zoom_level SMALLINT,
+            tile_column INTEGER,
+            tile_row INTEGER,
+            tile_scale SMALLINT,
+            tile_id VARCHAR(256),
+            updated_at INTEGER ) ON COMMIT DELETE ROWS""")
+
+        if self.has_scale():
+            key_columns = "zoom_level, tile_column, tile_row, tile_scale"
+            rows = [(t[0], t[1], t[2], t[3], t[4], t[5]) for t in tile_list]
+        else:
+            key_columns = "zoom_level, tile_column, tile_row"
+            rows = [(t[0], t[1], t[2], t[4], t[5]) for t in tile_list]
+
+        self.cur.execute("BEGIN")
+
+        try:
+            self.copy_to_staging("map_staging", tuple(key_columns.split(", ")) + ("tile_id", "updated_at"), rows)
+
+            # A tile may only be updated once per statement, the last row of the batch wins
+            self.cur.execute("""INSERT INTO map (%s, tile_id, updated_at)
+                SELECT DISTINCT ON (%s) %s, tile_id, updated_at FROM map_staging ORDER BY %s, seq DESC
+                ON CONFLICT (%s) DO UPDATE SET tile_id=EXCLUDED.tile_id, updated_at=EXCLUDED.updated_at""" % ((key_columns,) * 5))
+            self.cur.execute("COMMIT")
+        except:
+            self.cur.execute("ROLLBACK")
+            raise
 
 
     def update_tile(self, old_tile_id, new_tile_id, tile_data):
@@ -1113,6 +1695,36 @@ class MBTilesPostgres(MBTilesDatabase):
                 [old_tile_id])
 
 
+    def update_tiles(self, tile_list):
+        self.cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS tile_id_map (
+            old_tile_id VARCHAR(256) PRIMARY KEY,
+            new_tile_id VARCHAR(256) )""")
+
+        self.cur.execute("BEGIN")
+
+        try:
+            self.cur.executemany("""INSERT INTO images (tile_id, tile_data) SELECT %s, %s WHERE NOT EXISTS (SELECT 1 FROM images WHERE tile_id=%s)""",
+                [(t[1], psycopg2.Binary(t[2]), t[1]) for t in tile_list])
+            self.cur.executemany("""INSERT INTO tile_id_map (old_tile_id, new_tile_id) VALUES (%s, %s)""",
+                dict((t[0], t[1]) for t in tile_list).items())
+
+            self.cur.execute("""UPDATE map SET tile_id=tile_id_map.new_tile_id, updated_at=%s
+                FROM tile_id_map WHERE map.tile_id=tile_id_map.old_tile_id""",
+                (int(time.time()),))
+
+            # An old image might also be the new image of another tile
+            self.cur.execute("""DELETE FROM images USING tile_id_map
+                WHERE images.tile_id=tile_id_map.old_tile_id AND tile_id_map.old_tile_id<>tile_id_map.new_tile_id
+                AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id=images.tile_id)""")
+
+            self.cur.execute("""DELETE FROM tile_id_map""")
+            self.cur.execute("COMMIT")
+        except:
+            self.cur.execute("ROLLBACK")
+            raise
+
+
     def metadata(self):
         try:
             self.cur.execute('SELECT name, value FROM metadata')
@@ -1133,9 +1745,15 @@ class MBTilesPostgres(MBTilesDatabase):
 
 class MBTilesMySQL(MBTilesDatabase):
 
+    # Limit of the bytes of a multi-row INSERT, read from max_allowed_packet
+    max_insert_size = None
+
     def __init__(self, connect_string, auto_commit=False, journal_mode='wal', synchronous_off=False, exclusive_lock=False, check_if_exists=False):
         try:
 
+            global oursql
+            import oursql
+
             if connect_string.startswith("my:"):
                 if os.path.isfile("/etc/mb-util.conf"):
                     config = {}
@@ -1229,11 +1847,13 @@ class MBTilesMySQL(MBTilesDatabase):
 
 
     def create_map_tile_index(self):
-        self.cur.execute("""CREATE INDEX map_tile_id_index ON map (tile_id)""")
+        self.cur.execute("""SELECT count(*) FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = 'map' AND index_name = 'map_tile_id_index'""")
+        if self.cur.fetchall()[0][0] == 0:
+            self.cur.execute("""CREATE INDEX map_tile_id_index ON map (tile_id)""")
 
 
     def drop_map_tile_index(self):
-        self.cur.execute("""DROP INDEX map_tile_id_index""")
+        self.cur.execute("""DROP INDEX map_tile_id_index ON map""")
 
 
     def max_timestamp(self):
@@ -1248,35 +1868,24 @@ class MBTilesMySQL(MBTilesDatabase):
 
     def zoom_levels(self, scale):
         sql = "SELECT distinct(zoom_level) FROM tiles "
+        params = []
 
         if scale is not None:
-            sql += " WHERE tile_scale=%d " % (scale,)
+            sql += " WHERE tile_scale=? "
+            params.append(scale)
 
-        self.cur.execute(sql)
+        self.cur.execute(sql, params)
         return [int(x[0]) for x in self.cur.fetchall()]
 
 
     def tiles_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        sql = "SELECT count(zoom_level) FROM map WHERE "
-
-        if min_zoom > 0:
-            sql += " zoom_level>=%d AND " % (min_zoom,)
-        if max_zoom < 18:
-            sql += " zoom_level<=%d AND " % (max_zoom,)
-
-        if scale is not None:
-            sql += " tile_scale=%d AND " % (scale,)
-
-        if min_timestamp > 0:
-            sql += " updated_at>%d AND " % (min_timestamp,)
-        if max_timestamp > 0:
-            sql += " updated_at<%d AND " % (max_timestamp,)
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, extra_conditions=["tile_id IS NOT NULL"])
 
-        sql += " tile_id IS NOT NULL"
+        sql = "SELECT count(zoom_level) FROM map WHERE %s" % (where_sql,)
 
         logger.debug(sql)
 
-        self.cur.execute(sql)
+        self.cur.execute(sql, params)
 
         result = self.cur.fetchall()
         if len(result) == 0:
@@ -1289,8 +1898,9 @@ class MBTilesMySQL(MBTilesDatabase):
         tiles_cur = self.con.cursor()
         tiles_cur.execute("SET autocommit = 0")
 
-        tiles_cur.execute("""SELECT tile_column, tile_row FROM map WHERE zoom_level = %s AND tile_scale = %s ORDER BY tile_column, tile_row""",
-            [zoom_level, scale])
+        where_sql, params = self.tile_filter(zoom_level, zoom_level, 0, 0, scale, exact_zoom_range=True)
+
+        tiles_cur.execute("SELECT tile_column, tile_row FROM map WHERE %s ORDER BY tile_column, tile_row" % (where_sql,), params)
 
         t = tiles_cur.fetchone()
         while t:
@@ -1301,190 +1911,144 @@ class MBTilesMySQL(MBTilesDatabase):
 
 
     def columns_for_zoom_level_and_row(self, zoom_level, row, scale):
-        self.cur.execute("""SELECT tile_column FROM tiles WHERE zoom_level = %s AND tile_row = %s AND tile_scale = %s""",
-            (zoom_level, row, scale))
+        where_sql, params = self.tile_filter(zoom_level, zoom_level, 0, 0, scale, extra_conditions=["tile_row=?"], exact_zoom_range=True)
+
+        self.cur.execute("SELECT tile_column FROM tiles WHERE %s" % (where_sql,), params + [row])
         return set([int(x[0]) for x in self.cur.fetchall()])
 
 
-    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        # Second connection to the database, for the named cursor
+    # Yields the rows of a query itersize rows at a time from an unbuffered cursor. It needs
+    # a second connection, since the cursor blocks its connection until all rows are read.
+    def streaming_rows(self, sql, params):
         iter_con = oursql.connect(host=self.connect_options['hostaddr'], user=self.connect_options['user'], passwd=self.connect_options['password'], db=self.connect_options['dbname'], raise_on_warnings=False)
-        tiles_cur = iter_con.cursor()
-        tiles_cur.execute("SET autocommit = 0")
 
-        chunk = 10000
-
-        sql = "SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_scale, images.tile_data, images.tile_id FROM map, images WHERE "
+        try:
+            tiles_cur = iter_con.cursor()
+            tiles_cur.execute("SET autocommit = 0")
+            tiles_cur.execute(sql, params)
 
-        inner_sql = ""
+            rows = tiles_cur.fetchmany(self.itersize)
+            while rows:
+                for t in rows:
+                    yield t
+                rows = tiles_cur.fetchmany(self.itersize)
 
-        if min_zoom > 0:
-            inner_sql += " map.zoom_level>=%d " % (min_zoom,)
-        if max_zoom < 18:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " map.zoom_level<=%d " % (max_zoom,)
+            tiles_cur.close()
+        finally:
+            iter_con.close()
 
-        if scale is not None:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " tile_scale=%d " % (scale,)
 
-        if min_timestamp > 0:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " map.updated_at>%d " % (min_timestamp,)
-        if max_timestamp > 0:
-            if len(inner_sql) > 0:
-                inner_sql += " AND "
-            inner_sql += " map.updated_at<%d " % (max_timestamp,)
+    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        scale_sql, scale_params = self.scale_column(scale, "map.")
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, "map.",
+            ["map.tile_id IS NOT NULL", "images.tile_id = map.tile_id"])
 
-        if len(inner_sql) > 0:
-            sql += " (%s) AND " % (inner_sql,)
-        sql += " (map.tile_id IS NOT NULL) AND (images.tile_id = map.tile_id) "
+        sql = "SELECT map.zoom_level, map.tile_column, map.tile_row, %s, images.tile_data, images.tile_id FROM map, images WHERE %s" % (scale_sql, where_sql)
+        sql += order_by_sql(order, "map.", self.morton_zoom_level(order, max_zoom))
 
         logger.debug(sql)
 
-        tiles_cur.execute(sql)
+        return self.streaming_rows(sql, scale_params + params)
 
-        rows = tiles_cur.fetchmany(chunk)
-        while rows:
-            for t in rows:
-                yield t
-            rows = tiles_cur.fetchmany(chunk)
 
-        tiles_cur.close()
-        iter_con.close()
+    def images_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, extra_conditions=["tile_id IS NOT NULL"])
 
+        if order == None:
+            sql = "SELECT images.tile_data, images.tile_id FROM images JOIN (SELECT DISTINCT tile_id FROM map WHERE %s) AS m ON m.tile_id = images.tile_id" % (where_sql,)
+        else:
+            # Images shared by several tiles are sorted by their first position
+            sql = "SELECT images.tile_data, images.tile_id FROM images JOIN (SELECT tile_id, MIN(%s) AS sort_key FROM map WHERE %s GROUP BY tile_id) AS m ON m.tile_id = images.tile_id ORDER BY m.sort_key" % (sort_key_sql(order, "", self.morton_zoom_level(order, max_zoom)), where_sql)
 
-    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        # Second connection to the database, for the named cursor
-        iter_con = oursql.connect(host=self.connect_options['hostaddr'], user=self.connect_options['user'], passwd=self.connect_options['password'], db=self.connect_options['dbname'], raise_on_warnings=False)
-        tiles_cur = iter_con.cursor()
-        tiles_cur.execute("SET autocommit = 0")
+        logger.debug(sql)
 
-        chunk = 10000
+        return self.streaming_rows(sql, params)
 
-        sql = "SELECT zoom_level, tile_column, tile_row, tile_scale, tile_data FROM tiles WHERE "
 
-        if min_zoom > 0:
-            sql += " zoom_level>=%d AND " % (min_zoom,)
-        if max_zoom < 18:
-            sql += " zoom_level<=%d AND " % (max_zoom,)
+    def images_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, extra_conditions=["tile_id IS NOT NULL"])
 
-        if scale is not None:
-            sql += " tile_scale=%d AND " % (scale,)
+        sql = "SELECT count(images.tile_id) FROM images JOIN (SELECT DISTINCT tile_id FROM map WHERE %s) AS m ON m.tile_id = images.tile_id" % (where_sql,)
 
-        if min_timestamp > 0:
-            sql += " updated_at>%d AND " % (min_timestamp,)
-        if max_timestamp > 0:
-            sql += " updated_at<%d AND " % (max_timestamp,)
+        logger.debug(sql)
 
-        sql += " 1 "
+        self.cur.execute(sql, params)
 
-        logger.debug(sql)
+        result = self.cur.fetchall()
+        if len(result) == 0:
+            return 0
 
-        tiles_cur.execute(sql)
+        return result[0][0]
 
-        rows = tiles_cur.fetchmany(chunk)
-        while rows:
-            for t in rows:
-                yield t
-            rows = tiles_cur.fetchmany(chunk)
 
-        tiles_cur.close()
-        iter_con.close()
+    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        scale_sql, scale_params = self.scale_column(scale)
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
 
+        sql = "SELECT zoom_level, tile_column, tile_row, %s, tile_data FROM tiles WHERE %s" % (scale_sql, where_sql)
+        sql += order_by_sql(order, "", self.morton_zoom_level(order, max_zoom))
 
-    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
-        tiles_cur = self.con.cursor()
-        tiles_cur.execute("SET autocommit = 0")
+        logger.debug(sql)
 
-        chunk = 10000
+        return self.streaming_rows(sql, scale_params + params)
 
-        tiles_cur.execute("""
+
+    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, "map.", exact_zoom_range=True)
+
+        return self.streaming_rows("""
             SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_scale, images.tile_data, images.tile_id
             FROM map, images
-            WHERE (map.zoom_level>=? and map.zoom_level<=? AND map.updated_at>? AND map.updated_at<?) AND (images.tile_id == map.tile_id)
-            UNION
+            WHERE (%s) AND (images.tile_id = map.tile_id)
+            UNION ALL
             SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_scale, NULL, NULL
             FROM map
-            WHERE (map.zoom_level>=? and map.zoom_level<=? AND map.updated_at>? AND map.updated_at<?) AND (map.tile_id IS NULL)
-            """,
-            (min_zoom, max_zoom, min_timestamp, max_timestamp, min_zoom, max_zoom, min_timestamp, max_timestamp))
-
-        rows = tiles_cur.fetchmany(chunk)
-        while rows:
-            for t in rows:
-                yield t
-            rows = tiles_cur.fetchmany(chunk)
+            WHERE (%s) AND (map.tile_id IS NULL)
+            """ % (where_sql, where_sql),
+            params + params)
 
-        tiles_cur.close()
 
+    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True)
 
-    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
-        total_tiles = self.cur.execute("""SELECT count(zoom_level) FROM map WHERE zoom_level>=? AND zoom_level<=? AND updated_at>? AND updated_at<?""",
-            (min_zoom, max_zoom, min_timestamp, max_timestamp)).fetchall()[0][0]
+        self.cur.execute("SELECT count(zoom_level) FROM map WHERE %s" % (where_sql,), params)
 
-        return total_tiles
+        return self.cur.fetchall()[0][0]
 
 
     def delete_tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        sql_images = "SELECT tile_id FROM map WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-        sql_map = "DELETE FROM map WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-
-        if scale is not None:
-            sql_images += " AND tile_scale=%d " % (scale,)
-            sql_map += " AND tile_scale=%d " % (scale,)
-
-        if min_timestamp > 0:
-            sql_images += " AND updated_at>%d " % (min_timestamp,)
-            sql_map += " AND updated_at>%d " % (min_timestamp,)
-        if max_timestamp > 0:
-            sql_images += " AND updated_at<%d " (max_timestamp,)
-            sql_map += " AND updated_at<%d " % (max_timestamp,)
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True)
 
-        self.cur.execute("DELETE FROM images WHERE tile_id IN (%s)" % (sql_images,))
-        self.cur.execute(sql_map)
+        self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+        self.cur.execute("DELETE FROM map WHERE %s" % (where_sql,), params)
 
 
-        sql_images = "SELECT tile_id FROM map WHERE zoom_level>=%d AND zoom_level<=%d " % (min_zoom, max_zoom)
-        sql_map = "UPDATE map SET tile_id=NULL, updated_at=%d WHERE zoom_level>=%d AND zoom_level<=%d " % (int(time.time()), min_zoom, max_zoom)
+    def expire_tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        where_sql, params = self.tile_filter(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True)
 
-        if scale is not None:
-            sql_images += " AND tile_scale=%d " % (scale,)
-            sql_map += " AND tile_scale=%d " % (scale,)
+        self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+        self.cur.execute("UPDATE map SET tile_id=NULL, updated_at=? WHERE " + where_sql, [int(time.time())] + params)
 
-        if min_timestamp > 0:
-            sql_images += " AND updated_at>%d " % (min_timestamp,)
-            sql_map += " AND updated_at>%d " % (min_timestamp,)
-        if max_timestamp > 0:
-            sql_images += " AND updated_at<%d " % (max_timestamp,)
-            sql_map += " AND updated_at<%d " % (max_timestamp,)
 
-        self.cur.execute("DELETE FROM images WHERE tile_id IN (%s)" % (sql_images,))
-        self.cur.execute(sql_map)
+    def expire_tile(self, tile_z, tile_x, tile_y, scale):
+        where_sql, params = self.tile_position_filter(tile_z, tile_x, tile_y, scale)
 
+        self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+        self.cur.execute("UPDATE map SET tile_id=NULL, updated_at=? WHERE " + where_sql, [int(time.time())] + params)
 
-    def expire_tile(self, tile_z, tile_x, tile_y, scale):
-        sql_images = "SELECT tile_id FROM map WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d " % (tile_z, tile_x, tile_y)
-        sql_map = "UPDATE map SET tile_id=NULL, updated_at=%d WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d " % (int(time.time()), tile_z, tile_x, tile_y)
 
-        if scale is not None:
-            sql_images += " AND tile_scale=%d " % (scale,)
-            sql_map += " AND tile_scale=%d " % (scale,)
+    def expire_tile_ranges(self, tile_ranges, scale):
+        for tile_z, min_x, max_x, min_y, max_y in tile_ranges:
+            where_sql, params = self.tile_range_filter(tile_z, min_x, max_x, min_y, max_y, scale)
 
-        self.cur.execute("DELETE FROM images WHERE tile_id IN (%s)" % (sql_images,))
-        self.cur.execute(sql_map)
+            self.cur.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE %s)" % (where_sql,), params)
+            self.cur.execute("UPDATE map SET tile_id=NULL, updated_at=? WHERE " + where_sql, [int(time.time())] + params)
 
 
     def bounding_box_for_zoom_level(self, zoom_level, scale):
-        sql = "SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row) FROM tiles WHERE zoom_level=%d " % (zoom_level,)
-
-        if scale is not None:
-            sql += " AND tile_scale=%d " % (scale,)
+        where_sql, params = self.tile_filter(zoom_level, zoom_level, 0, 0, scale, exact_zoom_range=True)
 
-        self.cur.execute(sql)
+        self.cur.execute("SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row) FROM tiles WHERE %s" % (where_sql,), params)
         return self.cur.fetchall()[0]
 
 
@@ -1493,18 +2057,64 @@ class MBTilesMySQL(MBTilesDatabase):
         self.cur.execute("""DELETE FROM images WHERE tile_id=?""", (tile_id, ))
 
 
+    # Inserts the rows with as few multi-row INSERT statements as fit into
+    # max_allowed_packet (and the 65535 parameters of a prepared statement),
+    # all in one transaction
+    def insert_rows(self, insert_sql, update_sql, rows):
+        if len(rows) == 0:
+            return
+
+        if self.max_insert_size == None:
+            self.cur.execute("SELECT @@max_allowed_packet")
+            # Leave room for the SQL and the protocol overhead of each value
+            self.max_insert_size = int(self.cur.fetchall()[0][0]) / 2
+
+        row_sql = "(" + ", ".join(["?"] * len(rows[0])) + ")"
+        max_rows = 65535 / len(rows[0])
+
+        self.cur.execute("START TRANSACTION")
+
+        try:
+            batch = []
+            batch_size = 0
+
+            for row in rows:
+                row_size = sum([len(v) if isinstance(v, (basestring, buffer)) else 8 for v in row])
+
+                if len(batch) > 0 and (batch_size + row_size > self.max_insert_size or len(batch) >= max_rows):
+                    self.cur.execute("%s VALUES %s %s" % (insert_sql, ", ".join([row_sql] * len(batch)), update_sql),
+                        [v for r in batch for v in r])
+                    batch = []
+                    batch_size = 0
+
+                batch.append(row)
+                batch_size += row_size
+
+            self.cur.execute("%s VALUES %s %s" % (insert_sql, ", ".join([row_sql] * len(batch)), update_sql),
+                [v for r in batch for v in r])
+
+            self.cur.execute("COMMIT")
+        except:
+            self.cur.execute("ROLLBACK")
+            raise
+
+
     def insert_tile_to_images(self, tile_id, tile_data):
         self.cur.execute("""INSERT IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
             (tile_id, buffer(tile_data)))
 
 
     def insert_tiles_to_images(self, tile_list):
-        self.cur.executemany("""INSERT IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""", [(t[0], buffer(t[1])) for t in tile_list])
+        # Unlike INSERT IGNORE this only skips existing images, not other errors
+        self.insert_rows("INSERT INTO images (tile_id, tile_data)", "ON DUPLICATE KEY UPDATE tile_id=tile_id",
+            [(t[0], buffer(t[1])) for t in tile_list])
 
 
     def insert_tile_to_map(self, zoom_level, tile_column, tile_row, tile_scale, tile_id, replace_existing=True):
         if replace_existing:
-            self.cur.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_scale, tile_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)""",
+            # Updates the existing row in place, REPLACE would delete and insert it
+            self.cur.execute("""INSERT INTO map (zoom_level, tile_column, tile_row, tile_scale, tile_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON DUPLICATE KEY UPDATE tile_id=VALUES(tile_id), updated_at=VALUES(updated_at)""",
                 (zoom_level, tile_column, tile_row, tile_scale, tile_id, int(time.time())))
         else:
             self.cur.execute("""INSERT IGNORE INTO map (zoom_level, tile_column, tile_row, tile_scale, tile_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)""",
@@ -1512,12 +2122,15 @@ class MBTilesMySQL(MBTilesDatabase):
 
 
     def insert_tiles_to_map(self, tile_list):
-        self.cur.executemany("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_scale, tile_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)""", tile_list)
+        # The rows are applied in order, so the last row of a tile wins like with REPLACE
+        self.insert_rows("INSERT INTO map (zoom_level, tile_column, tile_row, tile_scale, tile_id, updated_at)",
+            "ON DUPLICATE KEY UPDATE tile_id=VALUES(tile_id), updated_at=VALUES(updated_at)",
+            [tuple(t[0:6]) for t in tile_list])
 
 
     def update_tile(self, old_tile_id, new_tile_id, tile_data):
-        self.cur.execute("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
-            (new_tile_id, sqlite3.Binary(tile_data)))
+        self.cur.execute("""INSERT IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+            (new_tile_id, buffer(tile_data)))
         self.cur.execute("""UPDATE map SET tile_id=?, updated_at=? WHERE tile_id=?""",
             (new_tile_id, int(time.time()), old_tile_id))
 
@@ -1526,6 +2139,30 @@ class MBTilesMySQL(MBTilesDatabase):
                 [old_tile_id])
 
 
+    def update_tiles(self, tile_list):
+        self.cur.execute("""
+            CREATE TEMPORARY TABLE IF NOT EXISTS tile_id_map (
+            old_tile_id CHAR(40) PRIMARY KEY,
+            new_tile_id CHAR(40) )""")
+
+        self.cur.executemany("""INSERT IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+            [(t[1], buffer(t[2])) for t in tile_list])
+        self.cur.executemany("""REPLACE INTO tile_id_map (old_tile_id, new_tile_id) VALUES (?, ?)""",
+            [(t[0], t[1]) for t in tile_list])
+
+        self.cur.execute("""UPDATE map JOIN tile_id_map ON map.tile_id=tile_id_map.old_tile_id
+            SET map.tile_id=tile_id_map.new_tile_id, map.updated_at=?""",
+            (int(time.time()),))
+
+        # An old image might also be the new image of another tile
+        self.cur.execute("""DELETE images FROM images
+            JOIN tile_id_map ON images.tile_id=tile_id_map.old_tile_id
+            LEFT JOIN map ON map.tile_id=images.tile_id
+            WHERE tile_id_map.old_tile_id<>tile_id_map.new_tile_id AND map.tile_id IS NULL""")
+
+        self.cur.execute("""DELETE FROM tile_id_map""")
+
+
     def metadata(self):
         try:
             self.cur.execute('SELECT name, value FROM metadata')
@@ -1544,6 +2181,10 @@ class MBTilesMongoDB(MBTilesDatabase):
     def __init__(self, connect_string, auto_commit=False, journal_mode='wal', synchronous_off=False, exclusive_lock=False, check_if_exists=False):
         try:
 
+            global pymongo, bson
+            import pymongo
+            import bson
+
             if connect_string.startswith("mongodb:"):
                 if os.path.isfile("/etc/mb-util.conf"):
                     config = {}
@@ -1575,6 +2216,9 @@ class MBTilesMongoDB(MBTilesDatabase):
             logger.error(e)
             sys.exit(1)
 
+        # Also for commands which don't call mbtiles_setup(), like --export
+        self.try_upgrade_legacy_tiles()
+
     def close(self):
         self.con.close()
 
@@ -1582,7 +2226,48 @@ class MBTilesMongoDB(MBTilesDatabase):
         return False
 
     def mbtiles_setup(self):
-        pass
+        self.create_tile_indexes()
+        self.upgrade_legacy_tiles()
+
+    def create_tile_indexes(self):
+        self.cur.tiles.create_index([("z", pymongo.ASCENDING), ("x", pymongo.ASCENDING), ("y", pymongo.ASCENDING), ("s", pymongo.ASCENDING)])
+        self.cur.tiles.create_index([("t", pymongo.ASCENDING)])
+
+    # Documents written by older versions only have the position in the _id, it's copied
+    # to x, y and s once, since the queries filter on these fields. Finding such documents
+    # only takes one index lookup per zoom level once mbtiles_setup() created the indexes.
+    def upgrade_legacy_tiles(self):
+        legacy_query = {"z" : {"$in" : range(0, 31)}, "x" : None}
+
+        if self.cur.tiles.find_one(legacy_query, {"_id" : 1}) == None:
+            return
+
+        logger.info("Adding the tile coordinates to documents of older versions")
+
+        bulk = self.cur.tiles.initialize_unordered_bulk_op()
+        count = 0
+
+        for t in self.cur.tiles.find(legacy_query, {"_id" : 1}).batch_size(self.itersize):
+            tile_z, tile_x, tile_y, tile_scale = self.tile_position(t)
+            bulk.find({"_id" : t["_id"]}).update({"$set" : {"x" : tile_x, "y" : tile_y, "s" : tile_scale}})
+
+            count = count + 1
+            if (count % 1000) == 0:
+                bulk.execute()
+                bulk = self.cur.tiles.initialize_unordered_bulk_op()
+
+        if (count % 1000) != 0:
+            bulk.execute()
+
+        logger.info("%d documents upgraded" % (count))
+
+    # Users which may only read the database can't upgrade the documents, the queries
+    # filtering on the position then don't find documents of older versions
+    def try_upgrade_legacy_tiles(self):
+        try:
+            self.upgrade_legacy_tiles()
+        except pymongo.errors.OperationFailure, e:
+            logger.warning("Could not upgrade the documents of older versions: %s" % (e))
 
     def optimize_database(self, skip_analyze, skip_vacuum):
         pass
@@ -1594,19 +2279,20 @@ class MBTilesMongoDB(MBTilesDatabase):
         pass
 
     def max_timestamp(self):
+        for t in self.cur.tiles.find({}, {"t" : 1}).sort("t", pymongo.DESCENDING).limit(1):
+            return t["t"]
         return 0
 
-    def zoom_levels(self, scale):
-        return self.cur.tiles.distinct("z")
-
-    def tiles_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+    # The query for the usual tile filters, like tile_filter() for the SQL databases.
+    # Expired tiles are kept with "d" : None until they are deleted.
+    def tile_query(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=False, expired=False):
         query = {}
 
-        if min_zoom > 0 or max_zoom < 18:
+        if min_zoom > 0 or max_zoom < 18 or exact_zoom_range:
             z_query = {}
-            if min_zoom > 0:
+            if min_zoom > 0 or exact_zoom_range:
                 z_query["$gte"] = min_zoom
-            if max_zoom < 18:
+            if max_zoom < 18 or exact_zoom_range:
                 z_query["$lte"] = max_zoom
             query["z"] = z_query
 
@@ -1621,75 +2307,115 @@ class MBTilesMongoDB(MBTilesDatabase):
                 t_query["$lt"] = max_timestamp
             query["t"] = t_query
 
-        if len(query):
-            return self.cur.tiles.find(query).count()
+        if not expired:
+            query["d"] = {"$ne" : None}
+
+        return query
+
+    # Returns (z, x, y, scale) of a document, older documents only have them in the _id
+    def tile_position(self, t):
+        if "x" in t:
+            return (t["z"], t["x"], t["y"], t.get("s", 1))
+
+        tile_z, tile_x, tile_y, tile_scale = t["_id"].split('/')
+        return (int(tile_z), int(tile_x), int(tile_y), int(tile_scale))
+
+    def zoom_levels(self, scale):
+        return [int(z) for z in self.cur.tiles.find(self.tile_query(0, 18, 0, 0, scale), {"z" : 1}).distinct("z")]
 
-        return self.cur.tiles.count()
+    def tiles_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        return self.cur.tiles.find(self.tile_query(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)).count()
 
     def columns_and_rows_for_zoom_level(self, zoom_level, scale):
-        raise("Not implemented")
+        query = self.tile_query(zoom_level, zoom_level, 0, 0, scale, exact_zoom_range=True)
+
+        for t in self.cur.tiles.find(query, {"z" : 1, "x" : 1, "y" : 1}).batch_size(self.itersize):
+            tile_z, tile_x, tile_y, tile_scale = self.tile_position(t)
+            yield (tile_x, tile_y)
 
     def columns_for_zoom_level_and_row(self, zoom_level, row, scale):
-        raise("Not implemented")
+        query = self.tile_query(zoom_level, zoom_level, 0, 0, scale, exact_zoom_range=True)
+        query["y"] = row
 
-    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        return tiles(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
+        return set([int(t["x"]) for t in self.cur.tiles.find(query, {"x" : 1, "_id" : 0}).batch_size(self.itersize)])
 
-    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        query = {}
+    # The tiles aren't compacted, so there are no tile_ids
+    def tiles_with_tile_id(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        return self.tiles(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order)
 
-        if min_zoom > 0 or max_zoom < 18:
-            z_query = {}
-            if min_zoom > 0:
-                z_query["$gte"] = min_zoom
-            if max_zoom < 18:
-                z_query["$lte"] = max_zoom
-            query["z"] = z_query
+    def tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order=None):
+        if order != None:
+            logger.debug("Ordered iteration is not supported for MongoDB, ignoring --order")
 
-        if scale is not None:
-            query["s"] = scale
+        query = self.tile_query(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
 
-        if min_timestamp > 0 or max_timestamp > 0:
-            t_query = {}
-            if min_timestamp > 0:
-                t_query["$gt"] = min_timestamp
-            if max_timestamp > 0:
-                t_query["$lt"] = max_timestamp
-            query["t"] = t_query
+        for t in self.cur.tiles.find(query, {"z" : 1, "x" : 1, "y" : 1, "s" : 1, "d" : 1}).batch_size(self.itersize):
+            tile_z, tile_x, tile_y, tile_scale = self.tile_position(t)
 
-        cur = self.cur.tiles.find(query)
+            yield [tile_z, tile_x, tile_y, tile_scale, t["d"]]
 
-        for t in cur:
-            tile_id = t["_id"]
-            tile_z, tile_x, tile_y, tile_scale = tile_id.split('/')
+    # The tile_id is the md5 of the tile data, like for --import into compacted databases
+    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        query = self.tile_query(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True, expired=True)
 
-            yield [ int(tile_z), int(tile_x), int(tile_y), int(tile_scale), t["d"]]
+        for t in self.cur.tiles.find(query, {"z" : 1, "x" : 1, "y" : 1, "s" : 1, "d" : 1}).batch_size(self.itersize):
+            tile_z, tile_x, tile_y, tile_scale = self.tile_position(t)
 
-    def updates(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
-        raise("Not implemented")
+            if t["d"] is None:
+                yield [tile_z, tile_x, tile_y, tile_scale, None, None]
+            else:
+                yield [tile_z, tile_x, tile_y, tile_scale, t["d"], hashlib.md5(t["d"]).hexdigest()]
 
-    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp):
-        raise("Not implemented")
+    def updates_count(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        return self.cur.tiles.find(self.tile_query(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True, expired=True)).count()
 
     def delete_tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        raise("Not implemented")
+        self.cur.tiles.remove(self.tile_query(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True, expired=True))
+
+    def expire_tiles(self, min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        self.cur.tiles.update(self.tile_query(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, exact_zoom_range=True),
+            {"$set" : {"d" : None, "t" : int(time.time())}}, multi=True)
 
     def expire_tile(self, tile_z, tile_x, tile_y, tile_scale):
         tile_id = "%s/%s/%s/%s" % (tile_z, tile_x, tile_y, tile_scale)
-        self.cur.tiles.remove({ "_id" : tile_id })
+        self.cur.tiles.update({"_id" : tile_id, "d" : {"$ne" : None}}, {"$set" : {"d" : None, "t" : int(time.time())}})
+
+    def expire_tile_ranges(self, tile_ranges, scale):
+        for tile_z, min_x, max_x, min_y, max_y in tile_ranges:
+            query = self.tile_query(tile_z, tile_z, 0, 0, scale, exact_zoom_range=True)
+            query["x"] = {"$gte" : min_x, "$lte" : max_x}
+            query["y"] = {"$gte" : min_y, "$lte" : max_y}
+
+            self.cur.tiles.update(query, {"$set" : {"d" : None, "t" : int(time.time())}}, multi=True)
+
+    def delete_orphaned_images(self):
+        pass
 
     def bounding_box_for_zoom_level(self, zoom_level, scale):
-        raise("Not implemented")
+        query = self.tile_query(zoom_level, zoom_level, 0, 0, scale, exact_zoom_range=True)
+
+        result = []
+        for field in ("x", "y"):
+            for direction in (pymongo.ASCENDING, pymongo.DESCENDING):
+                t = list(self.cur.tiles.find(query, {field : 1, "_id" : 0}).sort(field, direction).limit(1))
+                result.append(t[0][field] if len(t) > 0 else None)
+
+        return result
 
     def delete_tile_with_id(self, tile_id):
-        raise("Not implemented")
+        raise Exception("Not implemented.")
 
     def insert_tile(self, zoom_level, tile_column, tile_row, tile_scale, tile_data):
-        raise Exception("Not implemented.")
+        self.insert_tiles([(zoom_level, tile_column, tile_row, tile_scale, tile_data, int(time.time()))])
 
     # tile_list must be an array of (z, x, y, scale, tile_data, timestamp)
     def insert_tiles(self, tile_list):
-        bulk = self.cur.tiles.initialize_ordered_bulk_op()
+        if len(tile_list) == 0:
+            return None
+
+        # Only the last row of a tile is kept, the upserts of an unordered
+        # bulk operation can be applied in any order
+        tiles = {}
 
         for t in tile_list:
             tile_z = t[0]
@@ -1701,7 +2427,14 @@ class MBTilesMongoDB(MBTilesDatabase):
 
             tile_id = "%s/%s/%s/%s" % (tile_z, tile_x, tile_y, tile_scale)
 
-            bulk.find({ "_id" : tile_id }).upsert().update( { "$set" : {"_id" : tile_id, "z" : tile_z, "t" : timestamp, "d" : tile_data}})
+            tiles[tile_id] = {"z" : tile_z, "x" : tile_x, "y" : tile_y, "s" : tile_scale, "t" : timestamp, "d" : tile_data}
+
+        # Unordered, so the server can apply the upserts in parallel and one
+        # failed write doesn't stop the others
+        bulk = self.cur.tiles.initialize_unordered_bulk_op()
+
+        for tile_id, tile in tiles.items():
+            bulk.find({ "_id" : tile_id }).upsert().update( { "$set" : tile })
 
         return bulk.execute()
 
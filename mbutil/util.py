@@ -1,10 +1,68 @@
-import sqlite3, uuid, sys, logging, time, os, re, json, zlib, hashlib, tempfile, math
+import sqlite3, sys, logging, time, os, re, json, zlib, hashlib, tempfile, math, Queue, shlex, subprocess, pipes, importlib, multiprocessing
 
 from database import database_connect
 
 logger = logging.getLogger(__name__)
 
 
+# The --transform function, set in every pool worker by init_transform_worker()
+tile_transform = None
+
+
+def load_transform(transform):
+    if transform == None:
+        return None
+
+    module_name, _, function_name = transform.partition(":")
+    if len(module_name) == 0 or len(function_name) == 0:
+        raise Exception("Invalid transform '%s', must be 'module:function'" % (transform))
+
+    module = importlib.import_module(module_name)
+
+    transform_function = getattr(module, function_name, None)
+    if not callable(transform_function):
+        raise Exception("Transform function '%s' not found in module '%s'" % (function_name, module_name))
+
+    return transform_function
+
+
+def init_transform_worker(transform):
+    global tile_transform
+    tile_transform = load_transform(transform)
+
+
+# Returns a process pool whose workers import the transform function only once. The
+# transform is imported here first, a worker failing to import it would hang the pool.
+def transform_pool(pool_size, transform):
+    load_transform(transform)
+
+    return multiprocessing.Pool(pool_size, init_transform_worker, (transform,))
+
+
+# Returns the transformed tile data, or None if the tile should vanish
+def apply_transform(tile_data):
+    if tile_transform == None or tile_data == None:
+        return tile_data
+
+    return tile_transform(tile_data)
+
+
+def apply_transform_to_file(image_file_path):
+    if tile_transform == None or not os.path.isfile(image_file_path):
+        return
+
+    tmp_file = open(image_file_path, "r")
+    tile_data = apply_transform(tmp_file.read())
+    tmp_file.close()
+
+    if tile_data == None:
+        os.remove(image_file_path)
+    else:
+        tmp_file = open(image_file_path, "w")
+        tmp_file.write(tile_data)
+        tmp_file.close()
+
+
 def flip_y(zoom, y):
     return (2**int(zoom)-1) - int(y)
 
@@ -30,8 +88,8 @@ def tile_to_coordinate(tileX, tileY, zoom):
     return (longitude, latitude)
 
 
-def mbtiles_connect(connect_string, auto_commit=False, journal_mode='wal', synchronous_off=False, exclusive_lock=False, check_if_exists=False):
-    return database_connect(connect_string, auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists)
+def mbtiles_connect(connect_string, auto_commit=False, journal_mode='wal', synchronous_off=False, exclusive_lock=False, check_if_exists=False, itersize=None):
+    return database_connect(connect_string, auto_commit, journal_mode, synchronous_off, exclusive_lock, check_if_exists, itersize)
 
 
 def optimize_database(connect_string, auto_commit=False, skip_analyze=True, skip_vacuum=True, journal_mode='wal'):
@@ -43,7 +101,12 @@ def optimize_database(connect_string, auto_commit=False, skip_analyze=True, skip
 def mbtiles_create(connect_string, **kwargs):
     logger.info("Creating empty database %s" % (connect_string))
     con = mbtiles_connect(connect_string)
-    con.mbtiles_setup()
+    if kwargs.get('compact_keys', False):
+        con.mbtiles_setup_compact_keys()
+    else:
+        con.mbtiles_setup()
+    if kwargs.get('refcounts', False):
+        con.mbtiles_setup_refcounts()
     con.close()
 
 
@@ -58,10 +121,29 @@ def prettify_connect_string(connect_string):
         return connect_string
 
 
-def execute_commands_on_tile(command_list, image_format, tile_data, tmp_dir=None):
+# Returns 'zip', 'tar', 'tar:gz' or 'tar:bz2' for archive file names, None for directories
+def archive_type(path):
+    lower_path = path.lower()
+
+    if lower_path.endswith(".zip"):
+        return "zip"
+    elif lower_path.endswith(".tar"):
+        return "tar"
+    elif lower_path.endswith(".tar.gz") or lower_path.endswith(".tgz"):
+        return "tar:gz"
+    elif lower_path.endswith(".tar.bz2") or lower_path.endswith(".tbz2"):
+        return "tar:bz2"
+
+    return None
+
+
+def execute_commands_on_tile(command_list, image_format, tile_data, tmp_dir=None, execute_pipe=False):
     if command_list == None or tile_data == None:
         return tile_data
 
+    if execute_pipe:
+        return execute_commands_on_data(command_list, tile_data)
+
     tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (image_format), prefix="tile_", dir=tmp_dir)
     tmp_file = os.fdopen(tmp_file_fd, "w")
     tmp_file.write(tile_data)
@@ -69,7 +151,11 @@ def execute_commands_on_tile(command_list, image_format, tile_data, tmp_dir=None
 
     for command in command_list:
         # logger.debug("Executing command: %s" % command)
-        os.system(command % (tmp_file_name))
+        os.system(format_command(command, [tmp_file_name]))
+
+    # The tile vanished
+    if not os.path.isfile(tmp_file_name):
+        return None
 
     tmp_file = open(tmp_file_name, "r")
     new_tile_data = tmp_file.read()
@@ -80,21 +166,192 @@ def execute_commands_on_tile(command_list, image_format, tile_data, tmp_dir=None
     return new_tile_data
 
 
+# Pipes the tile data through all commands, returns None if the tile vanished
+def execute_commands_on_data(command_list, tile_data):
+    if command_list == None or tile_data == None:
+        return tile_data
+
+    for command in command_list:
+        # logger.debug("Executing command: %s" % command)
+        p = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        new_tile_data, ignore = p.communicate(tile_data)
+
+        if p.returncode != 0:
+            logger.error("Command '%s' failed with exit code %d, ignoring its output" % (command, p.returncode))
+            continue
+
+        if len(new_tile_data) == 0:
+            return None
+
+        tile_data = new_tile_data
+
+    return tile_data
+
+
 def execute_commands_on_file(command_list, image_format, image_file_path):
     if command_list == None or image_file_path == None or not os.path.isfile(image_file_path):
         return False
 
     for command in command_list:
         # logger.debug("Executing command: %s" % command)
-        os.system(command % (image_file_path))
+        os.system(format_command(command, [image_file_path]))
+
+    return True
+
+
+# Executes every command once for all files if it contains %files, else once per file
+def execute_commands_on_files(command_list, image_format, image_file_paths):
+    if command_list == None or image_file_paths == None:
+        return False
+
+    for command in command_list:
+        existing_file_paths = [f for f in image_file_paths if os.path.isfile(f)]
+        if len(existing_file_paths) == 0:
+            return False
+
+        # logger.debug("Executing command: %s" % command)
+        if command.find("%files") >= 0:
+            os.system(format_command(command, existing_file_paths))
+        else:
+            for image_file_path in existing_file_paths:
+                os.system(format_command(command, [image_file_path]))
 
     return True
 
 
+# %files is replaced with all (quoted) file names, %s with the single file name
+def format_command(command, image_file_paths):
+    if command.find("%files") >= 0:
+        return command.replace("%files", " ".join([pipes.quote(f) for f in image_file_paths]))
+    return command % (image_file_paths[0])
+
+
+def uses_batch_commands(command_list):
+    return command_list != None and any([command.find("%files") >= 0 for command in command_list])
+
+
+# Piped tiles are passed one at a time, so they can't be combined with %files
+def check_batch_commands(command_list, execute_pipe):
+    if execute_pipe and uses_batch_commands(command_list):
+        sys.stderr.write('--execute-pipe can\'t be used with %files.\n')
+        sys.exit(1)
+
+
+def tile_batches(tiles, batch_size):
+    tile_batch = []
+
+    for next_tile in tiles:
+        tile_batch.append(next_tile)
+
+        if len(tile_batch) >= batch_size:
+            yield tile_batch
+            tile_batch = []
+
+    if len(tile_batch) > 0:
+        yield tile_batch
+
+
 def process_tile(next_tile):
-    tile_id, tile_file_path, image_format, command_list = next_tile['tile_id'], next_tile['filename'], next_tile['format'], next_tile['command_list']
-    # sys.stderr.write("%s (%s) -> %s\n" % (tile_id, image_format, tile_file_path))
+    tile_id, image_format, command_list = next_tile['tile_id'], next_tile['format'], next_tile['command_list']
+
+    # The result was found in the transform cache
+    if next_tile.get('cached'):
+        return next_tile
+
+    if next_tile.has_key('tile_data'):
+        tile_data = apply_transform(next_tile['tile_data'])
 
-    tile_data = execute_commands_on_file(command_list, image_format, tile_file_path)
+        if command_list:
+            tile_data = execute_commands_on_data(command_list, tile_data)
+
+        next_tile['tile_data'] = tile_data
+    else:
+        tile_file_path = next_tile['filename']
+        # sys.stderr.write("%s (%s) -> %s\n" % (tile_id, image_format, tile_file_path))
+
+        apply_transform_to_file(tile_file_path)
+        execute_commands_on_file(command_list, image_format, tile_file_path)
 
     return next_tile
+
+
+def process_tile_batch(tile_batch):
+    image_format, command_list = tile_batch[0]['format'], tile_batch[0]['command_list']
+
+    image_file_paths = [next_tile['filename'] for next_tile in tile_batch if not next_tile.get('cached')]
+
+    for image_file_path in image_file_paths:
+        apply_transform_to_file(image_file_path)
+
+    execute_commands_on_files(command_list, image_format, image_file_paths)
+
+    return tile_batch
+
+
+# Returns the tile data after process_tile(), or None if the tile vanished
+def read_processed_tile(next_tile):
+    if next_tile.has_key('tile_data'):
+        return next_tile['tile_data']
+
+    tile_file_path = next_tile['filename']
+    if not os.path.isfile(tile_file_path):
+        return None
+
+    tmp_file = open(tile_file_path, "r")
+    tile_data = tmp_file.read()
+    tmp_file.close()
+
+    os.remove(tile_file_path)
+
+    return tile_data
+
+
+def execute_guarded(func, item):
+    try:
+        return (True, func(item))
+    except Exception, e:
+        return (False, "%s: %s" % (e.__class__.__name__, e))
+
+
+def pool_imap_unordered(pool, func, iterable, max_in_flight):
+    # Like pool.imap_unordered(), but reads from the iterable only as fast as the results
+    # are consumed and never has more than max_in_flight items in the pool
+    results = Queue.Queue()
+    in_flight = 0
+
+    def next_result():
+        while True:
+            try:
+                # Waiting with a timeout keeps the main process responsive to Ctrl-C
+                success, result = results.get(True, 1)
+            except Queue.Empty:
+                continue
+
+            if not success:
+                raise Exception(result)
+            return result
+
+    for item in iterable:
+        pool.apply_async(execute_guarded, (func, item), callback=results.put)
+        in_flight += 1
+
+        while in_flight >= max_in_flight or (in_flight > 0 and not results.empty()):
+            in_flight -= 1
+            yield next_result()
+
+    while in_flight > 0:
+        in_flight -= 1
+        yield next_result()
+
+
+# Writes the batched images and map rows once there are more than 250 of them, or all
+# of them if force is set, and empties the lists. The images are always written before
+# the map rows, the image refcounts are counted by triggers on the map rows.
+def flush_tiles(con, images, rows, force=False):
+    if len(images) > 0 and (force or len(images) > 250 or len(rows) > 250):
+        con.insert_tiles_to_images(images)
+        del images[:]
+
+    if len(rows) > 0 and (force or len(rows) > 250):
+        con.insert_tiles_to_map(rows)
+        del rows[:]
@@ -1,4 +1,4 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+import sqlite3, sys, logging, time, os, json, zlib, hashlib, tempfile
 
 from util import mbtiles_connect, execute_commands_on_tile, prettify_connect_string
 
@@ -1,4 +1,4 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+import sqlite3, sys, logging, time, os, json, zlib, hashlib, tempfile
 
 from util import mbtiles_connect, prettify_connect_string
 
@@ -19,6 +19,9 @@ def clean_mbtiles(mbtiles_file, **kwargs):
 
     logger.info("Cleaning %s" % (prettify_connect_string(con.connect_string)))
 
+    if kwargs.get('refcounts', False):
+        con.mbtiles_setup_refcounts()
+
     con.delete_orphaned_images()
 
     con.close()
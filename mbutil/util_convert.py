@@ -15,13 +15,23 @@ def convert_tile_to_bbox(tile_z, tile_x, tile_y, flip_tile_y):
     return [min_x, min_y, max_x, max_y]
 
 
-def tiles_for_bbox(left, bottom, right, top, tile_z, flip_tile_y):
+# Returns (min_x, max_x, min_y, max_y) of the tiles covering the bounding box
+def tile_range_for_bbox(left, bottom, right, top, tile_z, flip_tile_y):
     min_x, min_y = coordinate_to_tile(left, bottom, tile_z)
     max_x, max_y = coordinate_to_tile(right, top, tile_z)
 
     if min_y > max_y:
         min_y, max_y = max_y, min_y
 
+    if flip_tile_y:
+        min_y, max_y = flip_y(tile_z, max_y), flip_y(tile_z, min_y)
+
+    return (min_x, max_x, min_y, max_y)
+
+
+def tiles_for_bbox(left, bottom, right, top, tile_z, flip_tile_y):
+    min_x, max_x, min_y, max_y = tile_range_for_bbox(left, bottom, right, top, tile_z, False)
+
     for tile_x in range(min_x, max_x+1):
         for tile_y in range(min_y, max_y+1):
             if flip_tile_y:
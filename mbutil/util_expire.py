@@ -3,7 +3,7 @@ import sys, logging, sqlite3, time
 logger = logging.getLogger(__name__)
 
 from util import mbtiles_connect, prettify_connect_string
-from util_convert import parse_and_convert_tile_bbox, parse_bbox, tiles_for_bbox
+from util_convert import parse_and_convert_tile_bbox, parse_bbox, tile_range_for_bbox
 
 def expire_mbtiles(mbtiles_file, **kwargs):
 
@@ -81,12 +81,13 @@ def expire_tiles_bbox(mbtiles_file, **kwargs):
     logger.info("Expiring tiles from %s" % (prettify_connect_string(con.connect_string)))
 
     for tile_z in range(min_zoom, max_zoom+1):
-        for tile_z, tile_x, tile_y in tiles_for_bbox(min_x, min_y, max_x, max_y, tile_z, flip_tile_y):
-            logger.debug("Expiring tile %d/%d/%d" % (tile_z, tile_x, tile_y))
-            if print_progress:
-                sys.stdout.write("\rExpiring tile %d/%d/%d" % (tile_z, tile_x, tile_y))
+        tile_range = (tile_z, ) + tile_range_for_bbox(min_x, min_y, max_x, max_y, tile_z, flip_tile_y)
 
-            con.expire_tile(tile_z, tile_x, tile_y, scale)
+        logger.debug("Expiring tiles %d/%d-%d/%d-%d" % tile_range)
+        if print_progress:
+            sys.stdout.write("\rExpiring tiles %d/%d-%d/%d-%d" % tile_range)
+
+        con.expire_tile_ranges([tile_range], scale)
 
 
     if print_progress:
@@ -1,10 +1,162 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+import sqlite3, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing, functools, tarfile, zipfile, StringIO, shutil
 
-from util import mbtiles_connect, execute_commands_on_tile, flip_y, prettify_connect_string
+from util import mbtiles_connect, execute_commands_on_tile, flip_y, archive_type, pool_imap_unordered, prettify_connect_string
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 
 
+# Writes files sequentially into a tar or zip archive
+class TileArchiveWriter(object):
+
+    def __init__(self, archive_path, archive_type):
+        self.archive_type = archive_type
+
+        if archive_type == "zip":
+            self.archive = zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED, True)
+        else:
+            # Stream mode, the archive is never read back while writing
+            self.archive = tarfile.open(archive_path, "w|%s" % (archive_type.partition(":")[2]))
+
+
+    def add(self, name, data):
+        if self.archive_type == "zip":
+            info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0644 << 16
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size  = len(data)
+            info.mtime = int(time.time())
+            info.mode  = 0644
+            self.archive.addfile(info, StringIO.StringIO(data))
+
+
+    def close(self):
+        self.archive.close()
+
+
+# Links the files of all tiles sharing a tile_id to the first file written for
+# that tile_id, files of tiles whose first file isn't written yet are linked later
+class TileLinker(object):
+
+    def __init__(self, link_type):
+        self.link_type = link_type
+        self.count     = 0
+
+        self.first_tiles   = {}
+        self.pending_links = {}
+
+
+    # Returns True if the tile is a duplicate and will be linked
+    def is_duplicate(self, tile_id, tile_file):
+        if not self.first_tiles.has_key(tile_id):
+            self.first_tiles[tile_id] = None
+            return False
+
+        first_tile = self.first_tiles[tile_id]
+        if first_tile == None:
+            self.pending_links.setdefault(tile_id, []).append(tile_file)
+        elif first_tile != False:
+            self.link(first_tile, tile_file)
+
+        return True
+
+
+    def tile_written(self, tile_id, tile_file):
+        self.first_tiles[tile_id] = tile_file
+
+        for link_file in self.pending_links.pop(tile_id, []):
+            self.link(tile_file, link_file)
+
+
+    def tile_vanished(self, tile_id):
+        self.first_tiles[tile_id] = False
+        self.pending_links.pop(tile_id, None)
+
+
+    def link(self, tile_file, link_file):
+        self.count = self.count + 1
+
+        if os.path.lexists(link_file):
+            os.remove(link_file)
+
+        try:
+            if self.link_type == "symlink":
+                os.symlink(os.path.relpath(tile_file, os.path.dirname(link_file)), link_file)
+            else:
+                os.link(tile_file, link_file)
+        except OSError:
+            # e.g. a hard link across file systems
+            shutil.copyfile(tile_file, link_file)
+
+
+# Streams (tile_file, tile_data, tile_id, replace) from tiles(), tiles_with_tile_id() or updates(),
+# the tile directories are created here so every directory is only checked once,
+# replace is set if the directory already existed and might contain files of an earlier export.
+# Duplicates are handed to the linker instead, the files of expired tiles from
+# updates() are deleted and counted in deleted_files.
+def tiles_to_export(tiles, base_path, image_format, flip_tile_y, create_dirs, linker, deleted_files):
+    existing_dirs = {}
+
+    for t in tiles:
+        tile_z = t[0]
+        tile_x = t[1]
+        tile_y = t[2]
+        tile_scale = t[3]
+        tile_id = t[5] if len(t) > 5 else None
+
+        if flip_tile_y:
+            tile_y = flip_y(tile_z, tile_y)
+
+        if len(t) > 5 and tile_id is None:
+            tile_file = os.path.join(base_path, str(tile_z), str(tile_x), '%s.%s' % (tile_y, image_format))
+            if os.path.lexists(tile_file):
+                os.remove(tile_file)
+            deleted_files[0] = deleted_files[0] + 1
+            continue
+
+        tile_data = str(t[4])
+
+        tile_dir = os.path.join(base_path, str(tile_z), str(tile_x))
+        if create_dirs and tile_dir not in existing_dirs:
+            existing_dirs[tile_dir] = os.path.isdir(tile_dir)
+            if not existing_dirs[tile_dir]:
+                os.makedirs(tile_dir)
+
+        tile_file = os.path.join(tile_dir, '%s.%s' % (tile_y, image_format))
+
+        if linker and linker.is_duplicate(tile_id, tile_file):
+            continue
+
+        yield (tile_file, tile_data, tile_id, existing_dirs.get(tile_dir, False))
+
+
+# Runs in the pool: executes the commands and writes the tile if write_file is set,
+# returns (tile_file, tile_data, tile_id), tile_data is None if the tile vanished
+def export_tile(next_tile, command_list, image_format, tmp_dir, execute_pipe, write_file):
+    tile_file, tile_data, tile_id, replace = next_tile
+
+    # Execute commands
+    if command_list:
+        tile_data = execute_commands_on_tile(command_list, image_format, tile_data, tmp_dir, execute_pipe)
+        if tile_data is None:
+            return (tile_file, None, tile_id)
+
+    if write_file:
+        # Don't write through a link from an earlier export, files in
+        # directories created by this export can't be links
+        if replace and os.path.lexists(tile_file):
+            os.remove(tile_file)
+
+        f = open(tile_file, 'wb')
+        f.write(tile_data)
+        f.close()
+
+    return (tile_file, tile_data, tile_id)
+
+
 def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
 
     delete_after_export = kwargs.get('delete_after_export', False)
@@ -21,6 +173,10 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
 
     print_progress = kwargs.get('progress', False)
     flip_tile_y    = kwargs.get('flip_y', False)
+    execute_pipe   = kwargs.get('execute_pipe', False)
+    export_links   = kwargs.get('export_links', None)
+    incremental    = kwargs.get('incremental', False)
+    order          = kwargs.get('order', None)
     min_timestamp  = kwargs.get('min_timestamp', 0)
     max_timestamp  = kwargs.get('max_timestamp', 0)
 
@@ -30,7 +186,16 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
     if zoom >= 0:
         min_zoom = max_zoom = zoom
 
-    con = mbtiles_connect(mbtiles_file, auto_commit, journal_mode, synchronous_off, False, True)
+    if incremental and archive_type(directory_path):
+        sys.stderr.write('Incremental exports can only be written to directories.\n')
+        sys.exit(1)
+
+    # Rewriting or deleting the file of an updated tile would change all symlinks pointing to it
+    if incremental and export_links == "symlink":
+        sys.stderr.write('Incremental exports can only be used with --export-links=hardlink.\n')
+        sys.exit(1)
+
+    con = mbtiles_connect(mbtiles_file, auto_commit, journal_mode, synchronous_off, False, True, kwargs.get('itersize'))
 
 
     zoom_level_string = None
@@ -42,15 +207,21 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
 
     logger.info("Exporting %s --> path:'%s' (%s)" % (prettify_connect_string(con.connect_string), directory_path, zoom_level_string))
 
-    if not os.path.isdir(directory_path):
-        os.mkdir(directory_path)
-    base_path = os.path.join(directory_path, "tiles")
-    if not os.path.isdir(base_path):
-        os.makedirs(base_path)
+    archive = None
+    metadata = con.metadata()
 
+    if archive_type(directory_path):
+        archive = TileArchiveWriter(directory_path, archive_type(directory_path))
+        archive.add('metadata.json', json.dumps(metadata, indent=4))
+        base_path = "tiles"
+    else:
+        if not os.path.isdir(directory_path):
+            os.mkdir(directory_path)
+        base_path = os.path.join(directory_path, "tiles")
+        if not os.path.isdir(base_path):
+            os.makedirs(base_path)
 
-    metadata = con.metadata()
-    json.dump(metadata, open(os.path.join(directory_path, 'metadata.json'), 'w'), indent=4)
+        json.dump(metadata, open(os.path.join(directory_path, 'metadata.json'), 'w'), indent=4)
 
     count = 0
     start_time = time.time()
@@ -62,8 +233,31 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
         sys.stderr.write('min-timestamp/max-timestamp can only be used with compacted databases.\n')
         sys.exit(1)
 
-
-    total_tiles = con.tiles_count(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
+    export_updates = False
+    if incremental:
+        if not sending_mbtiles_is_compacted:
+            con.close()
+            sys.stderr.write('Incremental exports can only be done from compacted databases.\n')
+            sys.exit(1)
+
+        # The state file remembers the second of the last export, tiles updated in
+        # that second are exported again because they might have been missed
+        state_file = os.path.join(directory_path, 'export-state.json')
+        exported_until = int(time.time())
+        try:
+            min_timestamp = json.load(open(state_file, 'r'))['exported_until'] - 1
+            max_timestamp = exported_until + 1
+            export_updates = True
+            logger.info("Exporting tiles updated since %d" % (min_timestamp + 1))
+        except IOError:
+            # Without a state file all tiles are exported, including the ones
+            # without an updated_at timestamp
+            logger.info("%s not found, exporting all tiles" % (state_file))
+
+    if export_updates:
+        total_tiles = con.updates_count(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
+    else:
+        total_tiles = con.tiles_count(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
 
     logger.debug("%d tiles to export" % (total_tiles))
     if print_progress:
@@ -72,29 +266,54 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
         sys.stdout.flush()
 
 
-    for t in con.tiles(min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        tile_z = t[0]
-        tile_x = t[1]
-        tile_y = t[2]
-        tile_scale = t[3]
-        tile_data = str(t[4])
+    default_pool_size = kwargs.get('poolsize', -1)
+    if default_pool_size < 1:
+        default_pool_size = None
+        logger.debug("Using default pool size")
+    else:
+        logger.debug("Using pool size = %d" % (default_pool_size))
+
+    # Writing files and executing commands both release the GIL, so threads are good enough,
+    # archives are written by this thread only
+    pool = ThreadPool(default_pool_size)
+    max_in_flight = (default_pool_size or multiprocessing.cpu_count()) * 8
+
+    linker = None
+    if export_links:
+        if not sending_mbtiles_is_compacted:
+            logger.info("The database isn't compacted, exporting copies instead of links")
+        elif archive:
+            logger.info("Links aren't supported in archives, exporting copies instead")
+        else:
+            linker = TileLinker(export_links)
+
+    if export_updates:
+        tiles = con.updates(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
+    elif linker:
+        tiles = con.tiles_with_tile_id(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order)
+    else:
+        tiles = con.tiles(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order)
 
-        # Execute commands
-        if kwargs.get('command_list'):
-            tile_data = execute_commands_on_tile(kwargs['command_list'], image_format, tile_data, tmp_dir)
+    # A list so tiles_to_export() can count into it
+    deleted_files = [0]
 
-        if flip_tile_y:
-            tile_y = flip_y(tile_z, tile_y)
+    process_tile = functools.partial(export_tile, command_list=kwargs.get('command_list'), image_format=image_format,
+        tmp_dir=tmp_dir, execute_pipe=execute_pipe, write_file=(archive == None))
 
-        tile_dir = os.path.join(base_path, str(tile_z), str(tile_x))
-        if not os.path.isdir(tile_dir):
-            os.makedirs(tile_dir)
+    for next_tile in pool_imap_unordered(pool, process_tile,
+            tiles_to_export(tiles, base_path, image_format, flip_tile_y, archive == None, linker, deleted_files), max_in_flight):
+        tile_file, tile_data, tile_id = next_tile
 
-        tile_file = os.path.join(tile_dir, '%s.%s' % (tile_y, metadata.get('format', 'png')))
+        if tile_data is None:
+            if linker:
+                linker.tile_vanished(tile_id)
+            continue
 
-        f = open(tile_file, 'wb')
-        f.write(tile_data)
-        f.close()
+        if archive:
+            archive.add(tile_file, tile_data)
+
+        if linker:
+            linker.tile_written(tile_id, tile_file)
 
         count = count + 1
         if (count % 100) == 0:
@@ -105,6 +324,20 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
                     (count, total_tiles, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
                 sys.stdout.flush()
 
+    pool.close()
+    pool.join()
+
+    if archive:
+        archive.close()
+
+    if linker:
+        count = count + linker.count
+
+    if incremental:
+        json.dump({'exported_until': exported_until}, open(state_file, 'w'), indent=4)
+
+        logger.info("%d files of expired tiles deleted" % (deleted_files[0]))
+
 
     if print_progress:
         sys.stdout.write('\n')
@@ -1,4 +1,4 @@
-import sqlite3, uuid, sys, logging, time, os, re, json, zlib, hashlib, tempfile
+import sqlite3, sys, logging, time, os, re, json, zlib, hashlib, tempfile
 
 from util import mbtiles_connect, coordinate_to_tile, prettify_connect_string, flip_y
 
@@ -64,6 +64,9 @@ def fill_mbtiles(mbtiles_file, image_filename, **kwargs):
     m.update(tile_data)
     tile_id = m.hexdigest()
 
+    if con.begin_bulk_load(kwargs.get('bulk_load', False)):
+        logger.debug("Bulk loading, the indexes are built at the end")
+
     con.insert_tile_to_images(tile_id, tile_data)
 
 
@@ -106,6 +109,8 @@ def fill_mbtiles(mbtiles_file, image_filename, **kwargs):
                         sys.stdout.flush()
 
 
+    con.end_bulk_load(False) # Don't overwrite existing tiles
+
     if print_progress:
         sys.stdout.write('\n')
 
@@ -1,10 +1,173 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+import sqlite3, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing, functools, tarfile, zipfile
 
-from util import mbtiles_connect, execute_commands_on_tile, flip_y, prettify_connect_string
+from util import mbtiles_connect, execute_commands_on_tile, flip_y, archive_type, pool_imap_unordered, flush_tiles, prettify_connect_string
+from cache import open_transform_cache
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 
 
+def list_directory(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+# Lists every directory of tiles/z/x/y.ext exactly once, without a stat() per entry,
+# and yields (z, x, y, path) for each tile
+def scan_tiles_directory(directory_path, min_zoom, max_zoom):
+    tiles_path = os.path.join(directory_path, "tiles")
+
+    for tile_z in list_directory(tiles_path):
+        if not tile_z.isdigit() or int(tile_z) < min_zoom or int(tile_z) > max_zoom:
+            continue
+
+        z_path = os.path.join(tiles_path, tile_z)
+
+        for tile_x in list_directory(z_path):
+            if not tile_x.isdigit():
+                continue
+
+            x_path = os.path.join(z_path, tile_x)
+
+            for file_name in list_directory(x_path):
+                tile_y, _, extension = file_name.partition('.')
+                if not tile_y.isdigit() or len(extension) == 0:
+                    continue
+
+                yield (int(tile_z), int(tile_x), int(tile_y), os.path.join(x_path, file_name))
+
+
+# Returns (z, x, y) for names like tiles/z/x/y.ext, None for anything else
+def parse_tile_name(name):
+    parts = name.lstrip("./").split("/")
+    if len(parts) != 4 or parts[0] != "tiles":
+        return None
+
+    tile_z, tile_x = parts[1], parts[2]
+    tile_y, _, extension = parts[3].partition('.')
+    if not tile_z.isdigit() or not tile_x.isdigit() or not tile_y.isdigit() or len(extension) == 0:
+        return None
+
+    return (int(tile_z), int(tile_x), int(tile_y))
+
+
+# Reads the tiles from a tar or zip archive without unpacking it. Tar archives
+# are read as a stream, so metadata.json must be their first member (as written
+# by --export).
+class TileArchiveReader(object):
+
+    def __init__(self, archive_path, archive_type):
+        self.archive_type = archive_type
+        self.first_member = None
+
+        if archive_type == "zip":
+            self.archive = zipfile.ZipFile(archive_path, "r")
+        else:
+            self.archive = tarfile.open(archive_path, "r|%s" % (archive_type.partition(":")[2]))
+
+
+    def metadata(self):
+        if self.archive_type == "zip":
+            try:
+                return json.loads(self.archive.read("metadata.json"))
+            except KeyError:
+                raise IOError("metadata.json not found")
+
+        self.first_member = self.archive.next()
+        if self.first_member == None or self.first_member.name.lstrip("./") != "metadata.json":
+            raise IOError("metadata.json not found")
+
+        metadata = json.load(self.archive.extractfile(self.first_member))
+        self.first_member = None
+        return metadata
+
+
+    def tar_members(self):
+        if self.first_member != None:
+            yield self.first_member
+
+        while True:
+            member = self.archive.next()
+            if member == None:
+                return
+
+            # TarFile remembers every member, which adds up for millions of tiles
+            self.archive.members = []
+
+            yield member
+
+
+    # Yields (z, x, y, tile_data) for every tile in the archive
+    def tiles(self, min_zoom, max_zoom):
+        if self.archive_type == "zip":
+            for info in self.archive.infolist():
+                tile = parse_tile_name(info.filename)
+                if tile == None or tile[0] < min_zoom or tile[0] > max_zoom:
+                    continue
+
+                yield tile + (self.archive.read(info), )
+        else:
+            for member in self.tar_members():
+                tile = parse_tile_name(member.name)
+                if not member.isfile() or tile == None or tile[0] < min_zoom or tile[0] > max_zoom:
+                    continue
+
+                yield tile + (self.archive.extractfile(member).read(), )
+
+
+    def close(self):
+        self.archive.close()
+
+
+def read_tile(next_tile):
+    tile_z, tile_x, tile_y, tile_path = next_tile
+
+    f = open(tile_path, 'rb')
+    tile_data = f.read()
+    f.close()
+
+    return (tile_z, tile_x, tile_y, tile_data)
+
+
+# Runs in the pool: reads the tile (unless it comes from an archive), executes the
+# commands and computes the tile_id, returns None if the tile vanished
+def import_tile(next_tile, command_list, image_format, tmp_dir, execute_pipe, cache, compute_tile_id, read_file):
+    if read_file:
+        tile_z, tile_x, tile_y, tile_data = read_tile(next_tile)
+    else:
+        tile_z, tile_x, tile_y, tile_data = next_tile
+
+    # Execute commands
+    if command_list:
+        found = False
+        if cache:
+            m = hashlib.md5()
+            m.update(tile_data)
+            input_id = m.hexdigest()
+
+            found, cached_tile_data = cache.get(input_id)
+            if found:
+                tile_data = cached_tile_data
+
+        if not found:
+            tile_data = execute_commands_on_tile(command_list, image_format, tile_data, tmp_dir, execute_pipe)
+            if cache:
+                cache.put(input_id, tile_data)
+
+        if tile_data is None:
+            return None
+
+    tile_id = None
+    if compute_tile_id:
+        m = hashlib.md5()
+        m.update(tile_data)
+        tile_id = m.hexdigest()
+
+    return (tile_z, tile_x, tile_y, tile_data, tile_id)
+
+
 def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
 
     auto_commit     = kwargs.get('auto_commit', False)
@@ -13,6 +176,7 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
 
     print_progress  = kwargs.get('progress', False)
     flip_tile_y     = kwargs.get('flip_y', False)
+    execute_pipe    = kwargs.get('execute_pipe', False)
 
     scale    = kwargs.get('tile_scale', None)
     zoom     = kwargs.get('zoom', -1)
@@ -49,10 +213,17 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
     logger.info("Importing path:'%s' --> %s (%s)" % (directory_path, prettify_connect_string(con.connect_string), zoom_level_string))
 
 
+    archive = None
+    if archive_type(directory_path):
+        archive = TileArchiveReader(directory_path, archive_type(directory_path))
+
     image_format = 'png'
     try:
 
-        metadata = json.load(open(os.path.join(directory_path, 'metadata.json'), 'r'))
+        if archive:
+            metadata = archive.metadata()
+        else:
+            metadata = json.load(open(os.path.join(directory_path, 'metadata.json'), 'r'))
         image_format = metadata.get('format', 'png')
 
         # Check that the old and new image formats are the same
@@ -82,77 +253,84 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
         sys.stdout.flush()
 
 
+    if con.begin_bulk_load(kwargs.get('bulk_load', False)):
+        logger.debug("Bulk loading, the indexes are built at the end")
+
     known_tile_ids = set()
 
+    cache = None
+    if kwargs.get('command_list'):
+        cache = open_transform_cache(**kwargs)
+
     tmp_images_list = []
     tmp_row_list = []
     tmp_tiles_list = []
 
-    for r1, zs, ignore in os.walk(os.path.join(directory_path, "tiles")):
-        for tile_z in zs:
-            if int(tile_z) < min_zoom or int(tile_z) > max_zoom:
-                continue
+    default_pool_size = kwargs.get('poolsize', -1)
+    if default_pool_size < 1:
+        default_pool_size = None
+        logger.debug("Using default pool size")
+    else:
+        logger.debug("Using pool size = %d" % (default_pool_size))
 
-            for r2, xs, ignore in os.walk(os.path.join(r1, tile_z)):
-                for tile_x in xs:
-                    for r2, ignore, ys in os.walk(os.path.join(r1, tile_z, tile_x)):
-                        for tile_y in ys:
-                            tile_y, extension = tile_y.split('.')
+    # Reading, executing commands and hashing all release the GIL, so threads are good enough
+    pool = ThreadPool(default_pool_size)
+    max_in_flight = (default_pool_size or multiprocessing.cpu_count()) * 8
 
-                            f = open(os.path.join(r1, tile_z, tile_x, tile_y) + '.' + extension, 'rb')
-                            tile_data = f.read()
-                            f.close()
+    process_tile = functools.partial(import_tile, command_list=kwargs.get('command_list'), image_format=image_format,
+        tmp_dir=tmp_dir, execute_pipe=execute_pipe, cache=cache, compute_tile_id=con.is_compacted(), read_file=(archive == None))
 
-                            if flip_tile_y:
-                                tile_y = str(flip_y(tile_z, tile_y))
+    # Archives are read sequentially by this thread
+    if archive:
+        tiles_to_import = archive.tiles(min_zoom, max_zoom)
+    else:
+        tiles_to_import = scan_tiles_directory(directory_path, min_zoom, max_zoom)
 
-                            # Execute commands
-                            if kwargs.get('command_list'):
-                                tile_data = execute_commands_on_tile(kwargs['command_list'], image_format, tile_data, tmp_dir)
+    for next_tile in pool_imap_unordered(pool, process_tile, tiles_to_import, max_in_flight):
+        if next_tile is None:
+            continue
 
-                            if con.is_compacted():
-                                m = hashlib.md5()
-                                m.update(tile_data)
-                                tile_id = m.hexdigest()
+        tile_z, tile_x, tile_y, tile_data, tile_id = next_tile
 
-                                if tile_id not in known_tile_ids:
-                                    tmp_images_list.append( (tile_id, tile_data) )
-                                    known_tile_ids.add(tile_id)
+        if flip_tile_y:
+            tile_y = flip_y(tile_z, tile_y)
 
-                                tmp_row_list.append( (tile_z, tile_x, tile_y, 1, tile_id, int(time.time())) )
-                            else:
-                                tmp_tiles_list.append( (tile_z, tile_x, tile_y, 1, tile_data, int(time.time())) )
+        if con.is_compacted():
+            if tile_id not in known_tile_ids:
+                tmp_images_list.append( (tile_id, tile_data) )
+                known_tile_ids.add(tile_id)
 
-                            count = count + 1
-                            if (count % 100) == 0:
-                                logger.debug("%d tiles imported (%.1f tiles/sec)" % (count, count / (time.time() - start_time)))
-                                if print_progress:
-                                    sys.stdout.write("\r%d tiles imported (%.1f tiles/sec)" % (count, count / (time.time() - start_time)))
-                                    sys.stdout.flush()
+            tmp_row_list.append( (tile_z, tile_x, tile_y, 1, tile_id, int(time.time())) )
+        else:
+            tmp_tiles_list.append( (tile_z, tile_x, tile_y, 1, tile_data, int(time.time())) )
 
-                            if len(tmp_images_list) > 250:
-                                con.insert_tiles_to_images(tmp_images_list)
-                                tmp_images_list = []
+        count = count + 1
+        if (count % 100) == 0:
+            logger.debug("%d tiles imported (%.1f tiles/sec)" % (count, count / (time.time() - start_time)))
+            if print_progress:
+                sys.stdout.write("\r%d tiles imported (%.1f tiles/sec)" % (count, count / (time.time() - start_time)))
+                sys.stdout.flush()
 
-                            if len(tmp_row_list) > 250:
-                                con.insert_tiles_to_map(tmp_row_list)
-                                tmp_row_list = []
+        flush_tiles(con, tmp_images_list, tmp_row_list)
 
-                            if len(tmp_tiles_list) > 250:
-                                con.insert_tiles(tmp_tiles_list)
-                                tmp_tiles_list = []
+        if len(tmp_tiles_list) > 250:
+            con.insert_tiles(tmp_tiles_list)
+            tmp_tiles_list = []
 
+    pool.close()
+    pool.join()
 
-    # Push the remaining rows to the database
-    if len(tmp_images_list) > 0:
-        con.insert_tiles_to_images(tmp_images_list)
+    if archive:
+        archive.close()
 
-    if len(tmp_row_list) > 0:
-        con.insert_tiles_to_map(tmp_row_list)
+    # Push the remaining rows to the database
+    flush_tiles(con, tmp_images_list, tmp_row_list, True)
 
     if len(tmp_tiles_list) > 0:
         con.insert_tiles(tmp_tiles_list)
 
+    con.end_bulk_load()
+
     if print_progress:
         sys.stdout.write('\n')
 
@@ -162,6 +340,9 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
         sys.stdout.flush()
 
 
+    if cache:
+        cache.close()
+
     con.optimize_database(kwargs.get('skip_analyze', False), kwargs.get('skip_vacuum', False))
 
     con.close()
@@ -1,30 +1,34 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing
+import sqlite3, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing
 
-from util import mbtiles_connect, execute_commands_on_tile, process_tile, flip_y, prettify_connect_string
+from util import mbtiles_connect, load_transform, transform_pool, execute_commands_on_tile, process_tile, process_tile_batch, tile_batches, uses_batch_commands, check_batch_commands, read_processed_tile, flip_y, flush_tiles, prettify_connect_string
 from util_check import check_mbtiles
-from multiprocessing import Pool
+from database import MBTilesSQLite
+from cache import open_transform_cache
 
 logger = logging.getLogger(__name__)
 
 
-def process_tiles(pool, tiles_to_process, con, count, total_tiles, start_time, print_progress, delete_vanished_tiles, known_tile_ids):
+def process_tiles(pool, tiles_to_process, con, count, total_tiles, start_time, print_progress, delete_vanished_tiles, known_tile_ids, batch_size, cache):
     tmp_row_list = []
 
     # Execute commands
-    processed_tiles = pool.map(process_tile, tiles_to_process)
+    if batch_size > 0:
+        processed_tiles = [next_tile
+            for tile_batch in pool.map(process_tile_batch, list(tile_batches(tiles_to_process, batch_size)))
+            for next_tile in tile_batch]
+    else:
+        processed_tiles = pool.map(process_tile, tiles_to_process)
 
     for next_tile in processed_tiles:
-        tile_data = None
-        tile_id, tile_file_path, original_size, tile_x, tile_y, tile_z, tile_scale = next_tile['tile_id'], next_tile['filename'], next_tile['size'], next_tile['tile_x'], next_tile['tile_y'], next_tile['tile_z'], next_tile['tile_scale']
+        tile_id, original_size, tile_x, tile_y, tile_z, tile_scale = next_tile['tile_id'], next_tile['size'], next_tile['tile_x'], next_tile['tile_y'], next_tile['tile_z'], next_tile['tile_scale']
 
-        if os.path.isfile(tile_file_path):
-            tmp_file = open(tile_file_path, "r")
-            tile_data = tmp_file.read()
-            tmp_file.close()
+        tile_data = read_processed_tile(next_tile)
 
-            os.remove(tile_file_path)
+        if cache and not next_tile.get('cached'):
+            cache.put(next_tile['input_id'], tile_data)
 
-            if tile_data and len(tile_data) > 0:
+        if tile_data is not None:
+            if len(tile_data) > 0:
                 m = hashlib.md5()
                 m.update(tile_data)
                 new_tile_id = m.hexdigest()
@@ -60,12 +64,15 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
     max_zoom      = kwargs.get('max_zoom', 18)
 
     tmp_dir         = kwargs.get('tmp_dir', None)
+    execute_pipe    = kwargs.get('execute_pipe', False)
+    transform       = kwargs.get('transform', None)
     auto_commit     = kwargs.get('auto_commit', False)
     journal_mode    = kwargs.get('journal_mode', 'wal')
     synchronous_off = kwargs.get('synchronous_off', False)
 
     min_timestamp = kwargs.get('min_timestamp', 0)
     max_timestamp = kwargs.get('max_timestamp', 0)
+    order         = kwargs.get('order', None)
 
     delete_after_export   = kwargs.get('delete_after_export', False)
     print_progress        = kwargs.get('progress', False)
@@ -73,6 +80,8 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
     flip_tile_y           = kwargs.get('flip_y', False)
     debug                 = kwargs.get('debug', False)
 
+    check_batch_commands(kwargs.get('command_list'), execute_pipe)
+
     if tmp_dir and not os.path.isdir(tmp_dir):
         os.mkdir(tmp_dir)
 
@@ -87,7 +96,7 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
 
 
     con1 = mbtiles_connect(mbtiles_file1, auto_commit, journal_mode, synchronous_off, False, False)
-    con2 = mbtiles_connect(mbtiles_file2, auto_commit, journal_mode, synchronous_off, False, True)
+    con2 = mbtiles_connect(mbtiles_file2, auto_commit, journal_mode, synchronous_off, False, True, kwargs.get('itersize'))
 
     con1.mbtiles_setup()
 
@@ -147,6 +156,10 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
     start_time = time.time()
     chunk = 1000
 
+    cache = None
+    if kwargs.get('command_list') or transform:
+        cache = open_transform_cache(**kwargs)
+
     total_tiles = 1
 
     if print_progress or debug:
@@ -165,9 +178,21 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
             sys.stdout.flush()
 
 
+    if con1.begin_bulk_load(kwargs.get('bulk_load', False)):
+        logger.debug("Bulk loading, the indexes are built at the end")
+
+
+    # merge two compacted SQLite databases within SQLite (--merge)
+    if isinstance(con1, MBTilesSQLite) and isinstance(con2, MBTilesSQLite) and \
+            con1.is_compacted() and con2.is_compacted() and con1.has_compact_keys() == con2.has_compact_keys() and \
+            not kwargs.get('command_list') and not transform and not flip_tile_y:
+        logger.debug("Merging with ATTACH DATABASE")
+
+        count = con1.merge_attached_database(con2, min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
+
 
     # merge and process (--merge --execute)
-    if con2.is_compacted() and kwargs['command_list']:
+    elif con2.is_compacted() and (kwargs.get('command_list') or transform):
         default_pool_size = kwargs.get('poolsize', -1)
         if default_pool_size < 1:
             default_pool_size = None
@@ -175,13 +200,19 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
         else:
             logger.debug("Using pool size = %d" % (default_pool_size))
 
-        pool = Pool(default_pool_size)
+        pool = transform_pool(default_pool_size, transform)
         multiprocessing.log_to_stderr(logger.level)
 
+        batch_size = 0
+        if uses_batch_commands(kwargs.get('command_list')):
+            batch_size = kwargs.get('execute_batch_size', 100)
+            chunk = max(chunk, batch_size * (default_pool_size or multiprocessing.cpu_count()) * 2)
+            logger.debug("Executing commands on batches of %d tiles" % (batch_size))
+
         tiles_to_process = []
         known_tile_ids = {}
 
-        for t in con2.tiles_with_tile_id(min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        for t in con2.tiles_with_tile_id(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order):
             tile_z = t[0]
             tile_x = t[1]
             tile_y = t[2]
@@ -194,22 +225,40 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
 
             new_tile_id = known_tile_ids.get(tile_id)
             if new_tile_id is None:
-                tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (new_format), prefix="tile_", dir=tmp_dir)
-                tmp_file = os.fdopen(tmp_file_fd, "w")
-                tmp_file.write(tile_data)
-                tmp_file.close()
-
-                tiles_to_process.append({
+                next_tile = {
                     'tile_id':tile_id,
-                    'filename':tmp_file_name,
                     'format':new_format,
                     'size':len(tile_data),
-                    'command_list':kwargs['command_list'],
+                    'command_list':kwargs.get('command_list'),
+                    'execute_pipe':execute_pipe,
                     'tile_x':tile_x,
                     'tile_y':tile_y,
                     'tile_z':tile_z,
                     'tile_scale':tile_scale
-                })
+                }
+
+                found = False
+                if cache:
+                    m = hashlib.md5()
+                    m.update(tile_data)
+                    next_tile['input_id'] = m.hexdigest()
+
+                    found, cached_tile_data = cache.get(next_tile['input_id'])
+
+                if found:
+                    next_tile['cached'] = True
+                    next_tile['tile_data'] = cached_tile_data
+                elif execute_pipe or not kwargs.get('command_list'):
+                    next_tile['tile_data'] = tile_data
+                else:
+                    tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (new_format), prefix="tile_", dir=tmp_dir)
+                    tmp_file = os.fdopen(tmp_file_fd, "w")
+                    tmp_file.write(tile_data)
+                    tmp_file.close()
+
+                    next_tile['filename'] = tmp_file_name
+
+                tiles_to_process.append(next_tile)
             else:
                 con1.insert_tile_to_map(tile_z, tile_x, tile_y, tile_scale, new_tile_id)
 
@@ -224,12 +273,12 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
             if len(tiles_to_process) < chunk:
                 continue
 
-            count = process_tiles(pool, tiles_to_process, con1, count, total_tiles, start_time, print_progress, delete_vanished_tiles, known_tile_ids)
+            count = process_tiles(pool, tiles_to_process, con1, count, total_tiles, start_time, print_progress, delete_vanished_tiles, known_tile_ids, batch_size, cache)
 
             tiles_to_process = []
 
         if len(tiles_to_process) > 0:
-            count = process_tiles(pool, tiles_to_process, con1, count, total_tiles, start_time, print_progress, delete_vanished_tiles, known_tile_ids)
+            count = process_tiles(pool, tiles_to_process, con1, count, total_tiles, start_time, print_progress, delete_vanished_tiles, known_tile_ids, batch_size, cache)
 
 
     # merge from a compacted database (--merge)
@@ -240,7 +289,7 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
         tmp_row_list = []
         tmp_tiles_list = []
 
-        for t in con2.tiles_with_tile_id(min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        for t in con2.tiles_with_tile_id(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order):
             tile_z = t[0]
             tile_x = t[1]
             tile_y = t[2]
@@ -267,24 +316,14 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
                     sys.stdout.write("\r%d tiles merged (%.1f%% @ %.1f tiles/sec)" % (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
                     sys.stdout.flush()
 
-            if len(tmp_images_list) > 250:
-                con1.insert_tiles_to_images(tmp_images_list)
-                tmp_images_list = []
-
-            if len(tmp_row_list) > 250:
-                con1.insert_tiles_to_map(tmp_row_list)
-                tmp_row_list = []
+            flush_tiles(con1, tmp_images_list, tmp_row_list)
 
             if len(tmp_tiles_list) > 250:
                 con1.insert_tiles(tmp_tiles_list)
                 tmp_tiles_list = []
 
         # Push the remaining rows to the database
-        if len(tmp_images_list) > 0:
-            con1.insert_tiles_to_images(tmp_images_list)
-
-        if len(tmp_row_list) > 0:
-            con1.insert_tiles_to_map(tmp_row_list)
+        flush_tiles(con1, tmp_images_list, tmp_row_list, True)
 
         if len(tmp_tiles_list) > 0:
             con1.insert_tiles(tmp_tiles_list)
@@ -293,12 +332,13 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
     # merge an uncompacted database (--merge)
     else:
         known_tile_ids = set()
+        transform_function = load_transform(transform)
 
         tmp_images_list = []
         tmp_row_list = []
         tmp_tiles_list = []
 
-        for t in con2.tiles(min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
+        for t in con2.tiles(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order):
             tile_z = t[0]
             tile_x = t[1]
             tile_y = t[2]
@@ -308,9 +348,29 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
             if flip_tile_y:
                 tile_y = flip_y(tile_z, tile_y)
 
-            # Execute commands
-            if kwargs.get('command_list'):
-                tile_data = execute_commands_on_tile(kwargs['command_list'], new_format, tile_data, tmp_dir)
+            found = False
+            if cache:
+                m = hashlib.md5()
+                m.update(tile_data)
+                input_id = m.hexdigest()
+
+                found, cached_tile_data = cache.get(input_id)
+                if found:
+                    tile_data = cached_tile_data
+
+            if not found:
+                if transform_function:
+                    tile_data = transform_function(tile_data)
+
+                # Execute commands
+                if kwargs.get('command_list'):
+                    tile_data = execute_commands_on_tile(kwargs['command_list'], new_format, tile_data, tmp_dir, execute_pipe)
+
+                if cache:
+                    cache.put(input_id, tile_data)
+
+            if tile_data is None:
+                continue
 
             if con1.is_compacted():
                 m = hashlib.md5()
@@ -332,28 +392,20 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
                     sys.stdout.write("\r%d tiles merged (%.1f%% @ %.1f tiles/sec)" % (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
                     sys.stdout.flush()
 
-            if len(tmp_images_list) > 250:
-                con1.insert_tiles_to_images(tmp_images_list)
-                tmp_images_list = []
-
-            if len(tmp_row_list) > 250:
-                con1.insert_tiles_to_map(tmp_row_list)
-                tmp_row_list = []
+            flush_tiles(con1, tmp_images_list, tmp_row_list)
 
             if len(tmp_tiles_list) > 250:
                 con1.insert_tiles(tmp_tiles_list)
                 tmp_tiles_list = []
 
         # Push the remaining rows to the database
-        if len(tmp_images_list) > 0:
-            con1.insert_tiles_to_images(tmp_images_list)
-
-        if len(tmp_row_list) > 0:
-            con1.insert_tiles_to_map(tmp_row_list)
+        flush_tiles(con1, tmp_images_list, tmp_row_list, True)
 
         if len(tmp_tiles_list) > 0:
             con1.insert_tiles(tmp_tiles_list)
 
+    con1.end_bulk_load()
+
     if print_progress:
         sys.stdout.write('\n')
 
@@ -370,5 +422,8 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
         con2.optimize_database(kwargs.get('skip_analyze', False), kwargs.get('skip_vacuum', False))
 
 
+    if cache:
+        cache.close()
+
     con1.close()
     con2.close()
@@ -1,34 +1,77 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing
+import sqlite3, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing
 
-from util import mbtiles_connect, process_tile, prettify_connect_string
-from multiprocessing import Pool
+from util import mbtiles_connect, transform_pool, process_tile, process_tile_batch, tile_batches, uses_batch_commands, check_batch_commands, read_processed_tile, pool_imap_unordered, prettify_connect_string
+from cache import open_transform_cache
 
 logger = logging.getLogger(__name__)
 
 
-def process_tiles(pool, tiles_to_process, con, count, total_tiles, start_time, print_progress, delete_vanished_tiles):
-    # Execute commands in parallel
-    # logger.debug("Starting multiprocessing...")
-    processed_tiles = pool.map(process_tile, tiles_to_process)
+def tiles_to_process(con, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order, image_format, command_list, tmp_dir, execute_pipe, cache):
+    # Every image is processed once, update_tile() then updates all tiles using it
+    for t in con.images_with_tile_id(min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order):
+        tile_data = str(t[0])
+        tile_id = t[1]
+
+        next_tile = {
+            'tile_id' : tile_id,
+            'format' : image_format,
+            'size' : len(tile_data),
+            'command_list' : command_list,
+            'execute_pipe' : execute_pipe
+        }
+
+        if cache:
+            m = hashlib.md5()
+            m.update(tile_data)
+            next_tile['input_id'] = m.hexdigest()
+
+            found, cached_tile_data = cache.get(next_tile['input_id'])
+            if found:
+                next_tile['cached'] = True
+                next_tile['tile_data'] = cached_tile_data
+                yield next_tile
+                continue
+
+        if execute_pipe or not command_list:
+            next_tile['tile_data'] = tile_data
+        else:
+            tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (image_format), prefix="tile_", dir=tmp_dir)
+            tmp_file = os.fdopen(tmp_file_fd, "w")
+            tmp_file.write(tile_data)
+            tmp_file.close()
+
+            next_tile['filename'] = tmp_file_name
+
+        yield next_tile
+
+
+def process_tiles(pool, tiles_to_process, con, total_images, start_time, print_progress, delete_vanished_tiles, max_in_flight, batch_size, cache):
+    count = 0
+    tmp_update_list = []
+
+    # Execute commands in parallel, the results are written back as soon as they arrive
+    if batch_size > 0:
+        processed_tiles = (next_tile
+            for tile_batch in pool_imap_unordered(pool, process_tile_batch, tile_batches(tiles_to_process, batch_size), max_in_flight)
+            for next_tile in tile_batch)
+    else:
+        processed_tiles = pool_imap_unordered(pool, process_tile, tiles_to_process, max_in_flight)
 
-    # logger.debug("Starting reimport...")
     for next_tile in processed_tiles:
-        tile_data = None
-        tile_id, tile_file_path, original_size = next_tile['tile_id'], next_tile['filename'], next_tile['size']
+        tile_id, original_size = next_tile['tile_id'], next_tile['size']
 
-        if os.path.isfile(tile_file_path):
-            tmp_file = open(tile_file_path, "r")
-            tile_data = tmp_file.read()
-            tmp_file.close()
+        tile_data = read_processed_tile(next_tile)
 
-            os.remove(tile_file_path)
+        if cache and not next_tile.get('cached'):
+            cache.put(next_tile['input_id'], tile_data)
 
-            if tile_data and len(tile_data) > 0:
+        if tile_data is not None:
+            if len(tile_data) > 0:
                 m = hashlib.md5()
                 m.update(tile_data)
                 new_tile_id = m.hexdigest()
 
-                con.update_tile(tile_id, new_tile_id, tile_data)
+                tmp_update_list.append( (tile_id, new_tile_id, tile_data) )
 
                 # logger.debug("Tile %s done\n" % (tile_id, ))
         else:
@@ -39,19 +82,27 @@ def process_tiles(pool, tiles_to_process, con, count, total_tiles, start_time, p
 
         count = count + 1
         if (count % 100) == 0:
-            logger.debug("%d tiles finished (%.1f%% @ %.1f tiles/sec)" %
-                (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
+            logger.debug("%d images finished (%.1f%% @ %.1f images/sec)" %
+                (count, (float(count) / float(total_images)) * 100.0, count / (time.time() - start_time)))
             if print_progress:
-                sys.stdout.write("\r%d tiles finished (%.1f%% @ %.1f tiles/sec)" %
-                    (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
+                sys.stdout.write("\r%d images finished (%.1f%% @ %.1f images/sec)" %
+                    (count, (float(count) / float(total_images)) * 100.0, count / (time.time() - start_time)))
                 sys.stdout.flush()
 
+        if len(tmp_update_list) > 250:
+            con.update_tiles(tmp_update_list)
+            tmp_update_list = []
+
+    # Push the remaining updates to the database
+    if len(tmp_update_list) > 0:
+        con.update_tiles(tmp_update_list)
+
     return count
 
 
 def execute_commands_on_mbtiles(mbtiles_file, **kwargs):
 
-    if kwargs.get('command_list') == None or len(kwargs['command_list']) == 0:
+    if (kwargs.get('command_list') == None or len(kwargs['command_list']) == 0) and kwargs.get('transform') == None:
         return
 
     auto_commit     = kwargs.get('auto_commit', False)
@@ -63,13 +114,19 @@ def execute_commands_on_mbtiles(mbtiles_file, **kwargs):
     min_zoom     = kwargs.get('min_zoom', 0)
     max_zoom     = kwargs.get('max_zoom', 18)
     tmp_dir      = kwargs.get('tmp_dir', None)
+    execute_pipe = kwargs.get('execute_pipe', False)
+    transform    = kwargs.get('transform', None)
 
     default_pool_size = kwargs.get('poolsize', -1)
     print_progress    = kwargs.get('progress', False)
     min_timestamp     = kwargs.get('min_timestamp', 0)
     max_timestamp     = kwargs.get('max_timestamp', 0)
+    order             = kwargs.get('order', None)
 
     delete_vanished_tiles = kwargs.get('delete_vanished_tiles', False)
+    keep_tile_id_index    = kwargs.get('keep_tile_id_index', False)
+
+    check_batch_commands(kwargs.get('command_list'), execute_pipe)
 
     if tmp_dir and not os.path.isdir(tmp_dir):
         os.mkdir(tmp_dir)
@@ -78,7 +135,7 @@ def execute_commands_on_mbtiles(mbtiles_file, **kwargs):
         min_zoom = max_zoom = zoom
 
 
-    con = mbtiles_connect(mbtiles_file, auto_commit, journal_mode, synchronous_off, False, True)
+    con = mbtiles_connect(mbtiles_file, auto_commit, journal_mode, synchronous_off, False, True, kwargs.get('itersize'))
 
     if not con.is_compacted():
         con.close()
@@ -104,17 +161,16 @@ def execute_commands_on_mbtiles(mbtiles_file, **kwargs):
         image_format = metadata['format']
 
 
-    count = 0
-    duplicates = 0
-    chunk = 1000
     start_time = time.time()
 
     total_tiles = con.tiles_count(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
+    total_images = con.images_count(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
+    duplicates = total_tiles - total_images
 
-    logger.debug("%d tiles to process" % (total_tiles))
+    logger.debug("%d tiles to process (%d images)" % (total_tiles, total_images))
     if print_progress:
-        sys.stdout.write("%d tiles to process\n" % (total_tiles))
-        sys.stdout.write("0 tiles finished (0% @ 0 tiles/sec)")
+        sys.stdout.write("%d tiles to process (%d images)\n" % (total_tiles, total_images))
+        sys.stdout.write("0 images finished (0% @ 0 images/sec)")
         sys.stdout.flush()
 
 
@@ -129,70 +185,45 @@ def execute_commands_on_mbtiles(mbtiles_file, **kwargs):
     else:
         logger.debug("Using pool size = %d" % (default_pool_size))
 
-    pool = Pool(default_pool_size)
+    pool = transform_pool(default_pool_size, transform)
     multiprocessing.log_to_stderr(logger.level)
 
 
-    tiles_to_process = []
-    processed_tile_ids = set()
-
-    for t in con.tiles_with_tile_id(min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
-        tile_z = t[0]
-        tile_x = t[1]
-        tile_y = t[2]
-        tile_scale = t[3]
-        tile_data = str(t[4])
-        tile_id = t[5]
-        # logging.debug("Working on tile (%d, %d, %d)" % (tile_z, tile_x, tile_y))
+    # Keep a few tiles per process queued, so no process has to wait for the others
+    max_in_flight = (default_pool_size or multiprocessing.cpu_count()) * 8
 
-        if tile_id in processed_tile_ids:
-            duplicates = duplicates + 1
-        else:
-            processed_tile_ids.add(tile_id)
+    cache = open_transform_cache(**kwargs)
 
-        tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (image_format), prefix="tile_", dir=tmp_dir)
-        tmp_file = os.fdopen(tmp_file_fd, "w")
-        tmp_file.write(tile_data)
-        tmp_file.close()
+    batch_size = 0
+    if uses_batch_commands(kwargs.get('command_list')):
+        batch_size = kwargs.get('execute_batch_size', 100)
+        max_in_flight = (default_pool_size or multiprocessing.cpu_count()) * 2
+        logger.debug("Executing commands on batches of %d tiles" % (batch_size))
 
-        tiles_to_process.append({
-            'tile_id' : tile_id,
-            'tile_x' : tile_x,
-            'tile_y' : tile_y,
-            'tile_z' : tile_z,
-            'filename' : tmp_file_name,
-            'format' : image_format,
-            'size' : len(tile_data),
-            'command_list' : kwargs.get('command_list', [])
-        })
-
-        if len(tiles_to_process) < chunk:
-            continue
-
-        count = process_tiles(pool, tiles_to_process, con, count, total_tiles, start_time, print_progress, delete_vanished_tiles)
-
-        tiles_to_process = []
-
-
-    if len(tiles_to_process) > 0:
-        count = process_tiles(pool, tiles_to_process, con, total_tiles, start_time, print_progress, count, delete_vanished_tiles)
+    count = process_tiles(pool,
+        tiles_to_process(con, min_zoom, max_zoom, min_timestamp, max_timestamp, scale, order, image_format, kwargs.get('command_list', []), tmp_dir, execute_pipe, cache),
+        con, total_images, start_time, print_progress, delete_vanished_tiles, max_in_flight, batch_size, cache)
 
     if print_progress:
         sys.stdout.write('\n')
 
-    logger.info("%d tiles finished, %d duplicates ignored (100.0%% @ %.1f tiles/sec)" %
+    logger.info("%d images finished, %d duplicates ignored (100.0%% @ %.1f images/sec)" %
         (count, duplicates, count / (time.time() - start_time)))
     if print_progress:
-        sys.stdout.write("%d tiles finished, %d duplicates ignored (100.0%% @ %.1f tiles/sec)\n" %
+        sys.stdout.write("%d images finished, %d duplicates ignored (100.0%% @ %.1f images/sec)\n" %
             (count, duplicates, count / (time.time() - start_time)))
         sys.stdout.flush()
 
 
     pool.close()
 
-    logger.debug("Dropping index for the tile_id column...")
-    con.drop_map_tile_index()
-    logger.debug("...done")
+    if cache:
+        cache.close()
+
+    if not keep_tile_id_index:
+        logger.debug("Dropping index for the tile_id column...")
+        con.drop_map_tile_index()
+        logger.debug("...done")
 
     con.optimize_database(kwargs.get('skip_analyze', False), kwargs.get('skip_vacuum', False))
     con.close()
@@ -1,29 +1,45 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing
+import sqlite3, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing, shlex, subprocess
 
-from util import mbtiles_connect, prettify_connect_string, flip_y
-from multiprocessing import Pool
+from util import mbtiles_connect, prettify_connect_string, flip_y, format_command, transform_pool, apply_transform, apply_transform_to_file
 
 logger = logging.getLogger(__name__)
 
 
 def test_tile(next_tile):
-    tile_file_path, command_list, revert_test = next_tile['filename'], next_tile['command_list'], next_tile['revert_test']
+    tile_file_path, command_list, revert_test = next_tile.get('filename'), next_tile['command_list'], next_tile['revert_test']
 
-    if command_list == None or tile_file_path == None or not os.path.isfile(tile_file_path):
-        return next_tile
-
-    command = command_list[0]
-    result  = 0
+    next_tile['result'] = None
+    result = 0
 
-    # logger.debug("Executing command: %s" % command)
-
-    # Common shortcuts
-    if command == "false" or command.startswith("false "):
-        result = 1
-    elif command == "true" or command.startswith("true "):
-        result = 0
+    # A tile fails the test if the transform makes it vanish
+    if next_tile.has_key('tile_data'):
+        tile_data = apply_transform(next_tile['tile_data'])
+        if tile_data == None:
+            result = 1
+    elif tile_file_path == None or not os.path.isfile(tile_file_path):
+        return next_tile
     else:
-        result = os.system(command % (tile_file_path))
+        apply_transform_to_file(tile_file_path)
+        if not os.path.isfile(tile_file_path):
+            result = 1
+
+    if result == 0 and command_list:
+        command = command_list[0]
+
+        # logger.debug("Executing command: %s" % command)
+
+        # Common shortcuts
+        if command == "false" or command.startswith("false "):
+            result = 1
+        elif command == "true" or command.startswith("true "):
+            result = 0
+        elif next_tile.get('execute_pipe'):
+            with open(os.devnull, "w") as devnull:
+                p = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=devnull)
+                p.communicate(tile_data)
+            result = p.returncode
+        else:
+            result = os.system(format_command(command, [tile_file_path]))
 
     if (revert_test == False and result != 0) or (revert_test == True and result == 0):
         next_tile['result'] = "/%s/%s/%s.%s\n" % (next_tile['tile_z'], next_tile['tile_x'], next_tile['tile_y'], next_tile['format'])
@@ -42,8 +58,9 @@ def process_tiles(pool, tiles_to_process):
         if next_tile['result']:
             sys.stderr.write(next_tile['result'])
 
-        tile_file_path = next_tile['filename']
-        os.remove(tile_file_path)
+        tile_file_path = next_tile.get('filename')
+        if tile_file_path and os.path.isfile(tile_file_path):
+            os.remove(tile_file_path)
 
 
 def test_mbtiles(mbtiles_file, **kwargs):
@@ -58,6 +75,8 @@ def test_mbtiles(mbtiles_file, **kwargs):
     min_timestamp    = kwargs.get('min_timestamp', 0)
     max_timestamp    = kwargs.get('max_timestamp', 0)
     revert_test     = kwargs.get('revert_test', False)
+    execute_pipe    = kwargs.get('execute_pipe', False)
+    transform       = kwargs.get('transform', None)
 
     auto_commit     = kwargs.get('auto_commit', False)
     journal_mode    = kwargs.get('journal_mode', 'wal')
@@ -95,7 +114,7 @@ def test_mbtiles(mbtiles_file, **kwargs):
     else:
         logger.debug("Using pool size = %d" % (default_pool_size))
 
-    pool = Pool(default_pool_size)
+    pool = transform_pool(default_pool_size, transform)
     multiprocessing.log_to_stderr(logger.level)
 
 
@@ -112,20 +131,27 @@ def test_mbtiles(mbtiles_file, **kwargs):
         if flip_tile_y:
             tile_y = flip_y(tile_z, tile_y)
 
-        tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (image_format), prefix="tile_", dir=tmp_dir)
-        tmp_file = os.fdopen(tmp_file_fd, "w")
-        tmp_file.write(tile_data)
-        tmp_file.close()
-
-        tiles_to_process.append({
+        next_tile = {
             'tile_x' : tile_x,
             'tile_y' : tile_y,
             'tile_z' : tile_z,
-            'filename' : tmp_file_name,
             'format' : image_format,
             'revert_test' : revert_test,
-            'command_list' : kwargs.get('command_list', [])
-        })
+            'command_list' : kwargs.get('command_list', []),
+            'execute_pipe' : execute_pipe
+        }
+
+        if execute_pipe or not kwargs.get('command_list'):
+            next_tile['tile_data'] = tile_data
+        else:
+            tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (image_format), prefix="tile_", dir=tmp_dir)
+            tmp_file = os.fdopen(tmp_file_fd, "w")
+            tmp_file.write(tile_data)
+            tmp_file.close()
+
+            next_tile['filename'] = tmp_file_name
+
+        tiles_to_process.append(next_tile)
 
         if len(tiles_to_process) < chunk:
             continue
@@ -1,4 +1,4 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+import sqlite3, sys, logging, time, os, json, zlib, hashlib, tempfile
 
 from util import mbtiles_connect, prettify_connect_string, flip_y
 from util_convert import convert_tile_to_bbox
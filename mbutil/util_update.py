@@ -1,6 +1,6 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib
+import sqlite3, sys, logging, time, os, json, zlib, hashlib
 
-from util import mbtiles_connect, flip_y, prettify_connect_string
+from util import mbtiles_connect, flip_y, flush_tiles, prettify_connect_string
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +21,7 @@ def update_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
 
 
     con1 = mbtiles_connect(mbtiles_file1, auto_commit, journal_mode, synchronous_off, False, False)
-    con2 = mbtiles_connect(mbtiles_file2, auto_commit, journal_mode, synchronous_off, False, True)
+    con2 = mbtiles_connect(mbtiles_file2, auto_commit, journal_mode, synchronous_off, False, True, kwargs.get('itersize'))
 
     con1.mbtiles_setup()
 
@@ -78,7 +78,7 @@ def update_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
     if min_timestamp is None: min_timestamp = 0
     max_timestamp = int(time.time())
 
-    total_tiles = con2.updates_count(min_zoom, max_zoom, min_timestamp, max_timestamp)
+    total_tiles = con2.updates_count(min_zoom, max_zoom, min_timestamp, max_timestamp, scale)
 
     if total_tiles == 0:
         con1.close()
@@ -99,7 +99,7 @@ def update_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
 
     deleted_tiles_count = 0
 
-    for t in con2.updates(min_zoom, max_zoom, min_timestamp, max_timestamp):
+    for t in con2.updates(min_zoom, max_zoom, min_timestamp, max_timestamp, scale):
         tile_z = t[0]
         tile_x = t[1]
         tile_y = t[2]
@@ -126,20 +126,10 @@ def update_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
                 sys.stdout.write("\r%d tiles merged (%.1f%% @ %.1f tiles/sec)" % (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
                 sys.stdout.flush()
 
-        if len(tmp_images_list) > 250:
-            con1.insert_tiles_to_images(tmp_images_list)
-            tmp_images_list = []
-
-        if len(tmp_row_list) > 250:
-            con1.insert_tiles_to_map(tmp_row_list)
-            tmp_row_list = []
+        flush_tiles(con1, tmp_images_list, tmp_row_list)
 
     # Push the remaining rows to the database
-    if len(tmp_images_list) > 0:
-        con1.insert_tiles_to_images(tmp_images_list)
-
-    if len(tmp_row_list) > 0:
-        con1.insert_tiles_to_map(tmp_row_list)
+    flush_tiles(con1, tmp_images_list, tmp_row_list, True)
 
 
     if print_progress:
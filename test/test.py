@@ -1,6 +1,6 @@
-import os, shutil
+import os, shutil, sqlite3, types
 from nose import with_setup
-from mbutil import mbtiles_to_disk, disk_to_mbtiles, fill_mbtiles
+from mbutil import mbtiles_to_disk, disk_to_mbtiles, mbtiles_create, fill_mbtiles, merge_mbtiles, execute_commands_on_mbtiles, expire_tiles_bbox, clean_mbtiles, mbtiles_connect, flush_tiles, TransformCache
 
 def clear_data():
     try:
@@ -106,3 +106,702 @@ def test_mbtiles_fill_min_max_flipy():
     assert not os.path.exists('test/output/tiles/2/2/1.png')
     assert not os.path.exists('test/output/tiles/2/1/1.png')
     assert not os.path.exists('test/output/tiles/2/0/0.png')
+
+
+@with_setup(clear_data, clear_data)
+def test_merge_mbtiles():
+    fill_mbtiles('test/output/fill1.mbtiles', 'test/data/tile.png', zoom=1, tile_bbox='0,0,0,0')
+    fill_mbtiles('test/output/fill2.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='0.1,0.1,180,90')
+    merge_mbtiles('test/output/fill1.mbtiles', 'test/output/fill2.mbtiles', max_zoom=1)
+    mbtiles_to_disk('test/output/fill1.mbtiles', 'test/output')
+    assert os.path.exists('test/output/tiles/1/0/0.png')
+    assert os.path.exists('test/output/tiles/1/1/0.png')
+    assert not os.path.exists('test/output/tiles/1/0/1.png')
+    assert not os.path.exists('test/output/tiles/1/1/1.png')
+    assert not os.path.exists('test/output/tiles/2/2/0.png')
+
+
+@with_setup(clear_data, clear_data)
+def test_process_mbtiles():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90')
+    execute_commands_on_mbtiles('test/output/fill.mbtiles', command_list=['echo processed > %s'])
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output')
+    assert open('test/output/tiles/1/0/0.png', 'rb').read() == 'processed\n'
+    assert open('test/output/tiles/2/3/3.png', 'rb').read() == 'processed\n'
+
+
+@with_setup(clear_data, clear_data)
+def test_process_mbtiles_once_per_image():
+    open('test/output/other.png', 'wb').write('other\n')
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', zoom=1, bbox='-180,-85,180,85', tile_scale=1)
+    fill_mbtiles('test/output/fill.mbtiles', 'test/output/other.png', zoom=2, bbox='-180,-85,180,85', tile_scale=1)
+    con = mbtiles_connect('test/output/fill.mbtiles')
+    total_tiles, total_images = con.tiles_count(0, 18, 0, 0, None), con.images_count(0, 18, 0, 0, None)
+    con.close()
+    assert (total_tiles, total_images) == (20, 2)
+    execute_commands_on_mbtiles('test/output/fill.mbtiles', command_list=['echo processed >> %s; echo executed >> test/output/executed'])
+    assert len(open('test/output/executed').readlines()) == total_images
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output')
+    assert open('test/output/tiles/2/3/3.png', 'rb').read() == 'other\nprocessed\n'
+
+
+@with_setup(clear_data, clear_data)
+def test_process_mbtiles_keep_tile_id_index():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', zoom=1, bbox='-180,-85,180,85', tile_scale=1)
+    index_sql = "SELECT count(*) FROM sqlite_master WHERE type='index' AND name='map_tile_id_index'"
+    execute_commands_on_mbtiles('test/output/fill.mbtiles', command_list=['echo processed > %s'], keep_tile_id_index=True)
+    con = sqlite3.connect('test/output/fill.mbtiles')
+    assert con.execute(index_sql).fetchone()[0] == 1
+    con.close()
+    execute_commands_on_mbtiles('test/output/fill.mbtiles', command_list=['echo again > %s'])
+    con = sqlite3.connect('test/output/fill.mbtiles')
+    assert con.execute(index_sql).fetchone()[0] == 0
+    con.close()
+
+
+@with_setup(clear_data, clear_data)
+def test_process_mbtiles_pipe():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90')
+    execute_commands_on_mbtiles('test/output/fill.mbtiles', command_list=['head -c 4'], execute_pipe=True)
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output')
+    assert open('test/output/tiles/2/3/3.png', 'rb').read() == open('test/data/tile.png', 'rb').read()[:4]
+
+
+@with_setup(clear_data, clear_data)
+def test_process_mbtiles_batch():
+    for x, y in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+        if not os.path.isdir('test/output/tiles/tiles/1/%d' % (x)):
+            os.makedirs('test/output/tiles/tiles/1/%d' % (x))
+        open('test/output/tiles/tiles/1/%d/%d.png' % (x, y), 'wb').write('tile 1/%d/%d\n' % (x, y))
+    disk_to_mbtiles('test/output/tiles', 'test/output/distinct.mbtiles')
+    # Appends the number of files of the command to every file
+    execute_commands_on_mbtiles('test/output/distinct.mbtiles', command_list=['set -- %files; for f; do echo $# >> "$f"; done'], execute_batch_size=2)
+    mbtiles_to_disk('test/output/distinct.mbtiles', 'test/output/export')
+    for x, y in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+        assert open('test/output/export/tiles/1/%d/%d.png' % (x, y), 'rb').read() == 'tile 1/%d/%d\n2\n' % (x, y)
+
+
+@with_setup(clear_data, clear_data)
+def test_process_mbtiles_batch_pipe():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', zoom=1, bbox='-180,-85,180,85', tile_scale=1)
+    try:
+        execute_commands_on_mbtiles('test/output/fill.mbtiles', command_list=['cat %files'], execute_pipe=True)
+        assert False
+    except SystemExit:
+        pass
+    try:
+        merge_mbtiles('test/output/merged.mbtiles', 'test/output/fill.mbtiles', command_list=['cat %files'], execute_pipe=True)
+        assert False
+    except SystemExit:
+        pass
+
+
+@with_setup(clear_data, clear_data)
+def test_process_mbtiles_transform():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90')
+    execute_commands_on_mbtiles('test/output/fill.mbtiles', transform='string:upper')
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output')
+    assert open('test/output/tiles/1/0/0.png', 'rb').read() == open('test/data/tile.png', 'rb').read().upper()
+
+
+@with_setup(clear_data, clear_data)
+def test_process_mbtiles_bad_transform():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', zoom=1, bbox='-180,-85,180,85', tile_scale=1)
+    try:
+        execute_commands_on_mbtiles('test/output/fill.mbtiles', transform='nosuchmodule:f')
+        assert False
+    except ImportError:
+        pass
+
+
+@with_setup(clear_data, clear_data)
+def test_process_mbtiles_cache():
+    fill_mbtiles('test/output/fill1.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90')
+    fill_mbtiles('test/output/fill2.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90')
+    execute_commands_on_mbtiles('test/output/fill1.mbtiles', command_list=['echo processed > %s; touch test/output/executed'], cache_file='test/output/cache.sqlite')
+    assert os.path.exists('test/output/executed')
+    os.remove('test/output/executed')
+    execute_commands_on_mbtiles('test/output/fill2.mbtiles', command_list=['echo processed > %s; touch test/output/executed'], cache_file='test/output/cache.sqlite')
+    assert not os.path.exists('test/output/executed')
+    mbtiles_to_disk('test/output/fill2.mbtiles', 'test/output')
+    assert open('test/output/tiles/1/0/0.png', 'rb').read() == 'processed\n'
+
+
+@with_setup(clear_data, clear_data)
+def test_transform_cache_eviction():
+    cache = TransformCache('test/output/cache.sqlite', 1, ['command'])
+    for i in range(30):
+        cache.put('input%d' % i, 'x' * 100 * 1024)
+        assert cache.size <= 1024 * 1024
+    assert cache.get('input0') == (False, None)
+    assert cache.get('input29')[0]
+    cache.close()
+
+
+@with_setup(clear_data, clear_data)
+def test_transform_cache_replace():
+    cache = TransformCache('test/output/cache.sqlite', 1, ['command'])
+    for i in range(30):
+        cache.put('input', 'x' * 100 * 1024)
+    assert cache.size == 100 * 1024
+    cache.put('input', None)
+    assert cache.size == 0
+    assert cache.evicted == 0
+    cache.close()
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_archive_and_back():
+    for archive in ['test/output/tiles.tar.gz', 'test/output/tiles.zip']:
+        mbtiles_to_disk('test/data/one_tile.mbtiles', archive)
+        disk_to_mbtiles(archive, archive + '.mbtiles')
+        mbtiles_to_disk(archive + '.mbtiles', archive + '.dir')
+        assert os.path.exists(archive + '.dir/tiles/0/0/0.png')
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_with_links():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90')
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/hardlinks', export_links='hardlink')
+    assert os.path.samefile('test/output/hardlinks/tiles/1/0/0.png', 'test/output/hardlinks/tiles/2/3/3.png')
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/symlinks', export_links='symlink')
+    assert open('test/output/symlinks/tiles/2/3/3.png', 'rb').read() == open('test/data/tile.png', 'rb').read()
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_incremental():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90')
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output', incremental=True)
+    assert os.path.exists('test/output/export-state.json')
+    assert os.path.exists('test/output/tiles/1/0/0.png')
+    expire_tiles_bbox('test/output/fill.mbtiles', zoom=1, tile_bbox='1/0/0')
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output', incremental=True)
+    assert not os.path.exists('test/output/tiles/1/0/0.png')
+    assert os.path.exists('test/output/tiles/2/3/3.png')
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_incremental_without_timestamps():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', zoom=1, bbox='-180,-85,180,85', tile_scale=1)
+    con = sqlite3.connect('test/output/fill.mbtiles')
+    con.execute("UPDATE map SET updated_at=NULL")
+    con.commit()
+    con.close()
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output', incremental=True)
+    assert os.path.exists('test/output/export-state.json')
+    assert os.path.exists('test/output/tiles/1/0/0.png')
+    assert os.path.exists('test/output/tiles/1/1/1.png')
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_incremental_with_scale():
+    open('test/output/retina.png', 'wb').write('retina\n')
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', zoom=1, bbox='-180,-85,180,85', tile_scale=1)
+    fill_mbtiles('test/output/fill.mbtiles', 'test/output/retina.png', zoom=1, bbox='-180,-85,180,85', tile_scale=2)
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/export', incremental=True, tile_scale=2)
+    con = sqlite3.connect('test/output/fill.mbtiles')
+    con.execute("UPDATE map SET updated_at=updated_at-100")
+    con.commit()
+    con.close()
+    open('test/output/export/export-state.json', 'w').write('{"exported_until": %d}' % (os.path.getmtime('test/output/fill.mbtiles') - 50))
+    # Only tiles of the other scale change
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', zoom=1, bbox='-180,-85,180,85', tile_scale=1)
+    expire_tiles_bbox('test/output/fill.mbtiles', zoom=1, tile_bbox='1/0/0', tile_scale=1)
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/export', incremental=True, tile_scale=2)
+    assert open('test/output/export/tiles/1/0/0.png', 'rb').read() == 'retina\n'
+    assert open('test/output/export/tiles/1/1/1.png', 'rb').read() == 'retina\n'
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_incremental_with_links():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', zoom=1, bbox='-180,-85,180,85', tile_scale=1)
+    try:
+        mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/export', incremental=True, export_links='symlink')
+        assert False
+    except SystemExit:
+        pass
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/export', incremental=True, export_links='hardlink')
+    con = sqlite3.connect('test/output/fill.mbtiles')
+    con.execute("UPDATE map SET updated_at=updated_at-100")
+    con.commit()
+    con.close()
+    os.makedirs('test/output/update/tiles/1/0')
+    open('test/output/update/tiles/1/0/0.png', 'wb').write('updated\n')
+    disk_to_mbtiles('test/output/update', 'test/output/fill.mbtiles')
+    open('test/output/export/export-state.json', 'w').write('{"exported_until": %d}' % (os.path.getmtime('test/output/fill.mbtiles') - 50))
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/export', incremental=True, export_links='hardlink')
+    assert open('test/output/export/tiles/1/0/0.png', 'rb').read() == 'updated\n'
+    assert open('test/output/export/tiles/1/1/1.png', 'rb').read() == open('test/data/tile.png', 'rb').read()
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_over_links():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', zoom=1, bbox='-180,-85,180,85', tile_scale=1)
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/export', export_links='hardlink')
+    os.makedirs('test/output/update/tiles/1/0')
+    open('test/output/update/tiles/1/0/0.png', 'wb').write('updated\n')
+    disk_to_mbtiles('test/output/update', 'test/output/fill.mbtiles')
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/export')
+    assert open('test/output/export/tiles/1/0/0.png', 'rb').read() == 'updated\n'
+    assert open('test/output/export/tiles/1/1/1.png', 'rb').read() == open('test/data/tile.png', 'rb').read()
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_ordered():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90')
+    execute_commands_on_mbtiles('test/output/fill.mbtiles', command_list=['echo processed > %s'], order='zxy')
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output', order='morton')
+    assert open('test/output/tiles/1/0/0.png', 'rb').read() == 'processed\n'
+    assert open('test/output/tiles/2/3/3.png', 'rb').read() == 'processed\n'
+    con = mbtiles_connect('test/output/fill.mbtiles')
+    assert [t[:3] for t in con.tiles(1, 1, 0, 0, None, 'zxy')] == [(1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)]
+    assert [t[:3] for t in con.tiles(1, 1, 0, 0, None, 'morton')] == [(1, 0, 0), (1, 1, 0), (1, 0, 1), (1, 1, 1)]
+    con.close()
+    mbtiles_create('test/output/ordered.mbtiles')
+    con = mbtiles_connect('test/output/ordered.mbtiles')
+    con.insert_tiles_to_images([('a' * 32, 'a'), ('b' * 32, 'b'), ('c' * 32, 'c')])
+    con.insert_tiles_to_map([(1, 1, 1, 1, 'a' * 32, 1), (1, 0, 0, 1, 'b' * 32, 1), (1, 1, 0, 1, 'c' * 32, 1), (1, 0, 1, 1, 'a' * 32, 1)])
+    assert [t[1] for t in con.images_with_tile_id(1, 1, 0, 0, None, 'morton')] == ['b' * 32, 'c' * 32, 'a' * 32]
+    assert [t[1] for t in con.images_with_tile_id(1, 1, 0, 0, None, 'zxy')] == ['b' * 32, 'a' * 32, 'c' * 32]
+    con.close()
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_morton_order_above_zoom_18():
+    for compact_keys in (False, True):
+        mbtiles_create('test/output/deep%d.mbtiles' % (compact_keys), compact_keys=compact_keys)
+        con = mbtiles_connect('test/output/deep%d.mbtiles' % (compact_keys))
+        con.insert_tiles_to_images([('a' * 32, 'tile')])
+        con.insert_tiles_to_map([(20, 0, 1 << 19, 1, 'a' * 32, 1), (20, 1 << 19, 0, 1, 'a' * 32, 1), (20, 1, 0, 1, 'a' * 32, 1)])
+        assert [(t[1], t[2]) for t in con.tiles(0, 18, 0, 0, None, 'morton')] == [(1, 0), (1 << 19, 0), (0, 1 << 19)]
+        con.close()
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_compact_keys():
+    mbtiles_create('test/output/compact.mbtiles', compact_keys=True)
+    fill_mbtiles('test/output/compact.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90')
+    execute_commands_on_mbtiles('test/output/compact.mbtiles', command_list=['echo processed > %s'])
+    merge_mbtiles('test/output/merged.mbtiles', 'test/output/compact.mbtiles')
+    mbtiles_to_disk('test/output/merged.mbtiles', 'test/output', zoom=2)
+    assert not os.path.exists('test/output/tiles/1/0/0.png')
+    assert open('test/output/tiles/2/3/3.png', 'rb').read() == 'processed\n'
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_bulk_load():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=1, bbox='-180,-90,180,90', tile_scale=1)
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/tiles')
+    open('test/output/tiles/tiles/1/0/0.png', 'wb').write('changed\n')
+    disk_to_mbtiles('test/output/tiles', 'test/output/fill.mbtiles', bulk_load=True)
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90', tile_scale=1, bulk_load=True)
+    con = sqlite3.connect('test/output/fill.mbtiles')
+    assert con.execute("SELECT count(*) FROM map").fetchone()[0] == 4 + 16
+    assert con.execute("SELECT count(*) FROM images").fetchone()[0] == 2
+    assert con.execute("SELECT count(*) FROM sqlite_master WHERE type='index' AND name IN ('map_index', 'images_id')").fetchone()[0] == 2
+    con.close()
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/export')
+    assert open('test/output/export/tiles/1/0/0.png', 'rb').read() == 'changed\n'
+    assert os.path.exists('test/output/export/tiles/2/3/3.png')
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_refcounts():
+    mbtiles_create('test/output/fill.mbtiles', refcounts=True)
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=2, bbox='-180,-90,180,90', tile_scale=1)
+    expire_tiles_bbox('test/output/fill.mbtiles', zoom=1, tile_bbox='1/0/0')
+    con = sqlite3.connect('test/output/fill.mbtiles')
+    assert con.execute("SELECT refcount FROM images").fetchall() == [(16,)]
+    con.execute("INSERT INTO images (tile_id, tile_data) VALUES ('unused', 'unused')")
+    con.commit()
+    con.close()
+    clean_mbtiles('test/output/fill.mbtiles')
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output')
+    assert not os.path.exists('test/output/tiles/1/0/0.png')
+    assert os.path.exists('test/output/tiles/2/3/3.png')
+    con = sqlite3.connect('test/output/fill.mbtiles')
+    assert con.execute("SELECT count(*) FROM images").fetchone()[0] == 1
+    con.close()
+
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_refcounts_many_duplicates():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=0, max_zoom=4, bbox='-180,-85,180,85', tile_scale=1)
+    mbtiles_to_disk('test/output/fill.mbtiles', 'test/output/tiles')
+    for root, dirs, files in os.walk('test/output/tiles/tiles'):
+        for name in files:
+            open(os.path.join(root, name), 'wb').write('duplicate\n')
+    mbtiles_create('test/output/refcounts.mbtiles', refcounts=True)
+    fill_mbtiles('test/output/refcounts.mbtiles', 'test/data/tile.png', zoom=5, tile_bbox='0,0,0,0', tile_scale=1)
+    disk_to_mbtiles('test/output/tiles', 'test/output/refcounts.mbtiles')
+    clean_mbtiles('test/output/refcounts.mbtiles')
+    con = sqlite3.connect('test/output/refcounts.mbtiles')
+    assert con.execute("SELECT refcount FROM images WHERE cast(tile_data AS text)='duplicate\n'").fetchall() == [(341,)]
+    con.close()
+
+
+class RecordingConnection(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def insert_tiles_to_images(self, tile_list):
+        self.calls.append(("images", len(tile_list)))
+
+    def insert_tiles_to_map(self, tile_list):
+        self.calls.append(("map", len(tile_list)))
+
+
+def test_flush_tiles():
+    con = RecordingConnection()
+    images, rows = [("id", "data")] * 10, [(1, 0, 0, 1, "id", 0)] * 251
+    flush_tiles(con, images, rows)
+    assert con.calls == [("images", 10), ("map", 251)]
+    assert images == [] and rows == []
+    rows.append((1, 0, 0, 1, "id", 0))
+    flush_tiles(con, images, rows)
+    assert len(con.calls) == 2
+    flush_tiles(con, images, rows, True)
+    assert con.calls[2:] == [("map", 1)]
+
+
+# Tiles 0 and 1 share image a, b and c are used by one tile each. b is replaced by
+# c, which is itself replaced by d in the same batch and must be kept for tile 2.
+def check_update_tiles(refcounts):
+    mbtiles_create('test/output/update.mbtiles', refcounts=refcounts)
+    con = mbtiles_connect('test/output/update.mbtiles')
+    con.insert_tiles_to_images([('a', 'a'), ('b', 'b'), ('c', 'c')])
+    con.insert_tiles_to_map([(2, 0, 0, 1, 'a', 0), (2, 1, 0, 1, 'a', 0), (2, 2, 0, 1, 'b', 0), (2, 3, 0, 1, 'c', 0)])
+    con.update_tiles([('a', 'a2', 'a2'), ('b', 'c', 'c'), ('c', 'd', 'd')])
+    con.close()
+    con = sqlite3.connect('test/output/update.mbtiles')
+    assert con.execute("SELECT tile_column, tile_id FROM map ORDER BY tile_column").fetchall() == [(0, 'a2'), (1, 'a2'), (2, 'c'), (3, 'd')]
+    assert [str(r[0]) for r in con.execute("SELECT tile_id FROM images ORDER BY tile_id")] == ['a2', 'c', 'd']
+    assert con.execute("SELECT count(*) FROM map WHERE updated_at=0").fetchone()[0] == 0
+    con.close()
+
+
+@with_setup(clear_data, clear_data)
+def test_update_tiles():
+    check_update_tiles(False)
+
+
+@with_setup(clear_data, clear_data)
+def test_update_tiles_with_refcounts():
+    check_update_tiles(True)
+
+
+@with_setup(clear_data, clear_data)
+def test_expire_tiles_bbox():
+    fill_mbtiles('test/output/fill.mbtiles', 'test/data/tile.png', min_zoom=1, max_zoom=3, bbox='-180,-85,180,85', tile_scale=1)
+    expire_tiles_bbox('test/output/fill.mbtiles', min_zoom=1, max_zoom=3, bbox='0.1,0.1,179,84')
+    con = sqlite3.connect('test/output/fill.mbtiles')
+    assert con.execute("SELECT count(*) FROM map WHERE tile_id IS NULL").fetchone()[0] == 1 + 4 + 16
+    assert con.execute("SELECT count(*) FROM map WHERE tile_id IS NOT NULL").fetchone()[0] == 3 + 12 + 48
+    con.close()
+
+
+# Zoom levels 0-2 and one tile at zoom level 19, compacted databases have every tile
+# in scales 1 and 2, updated at 100 * (tile_column + 1). Uncompacted databases have
+# a plain tiles table without scales and timestamps.
+def create_query_database(path, compacted, compact_keys=False):
+    positions = [(z, x, y) for z in range(3) for x in range(2 ** z) for y in range(2 ** z)] + [(19, 0, 0)]
+
+    if not compacted:
+        con = sqlite3.connect(path)
+        con.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+        con.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        con.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", [(z, x, y, sqlite3.Binary('%d/%d/%d' % (z, x, y))) for z, x, y in positions])
+        con.commit()
+        con.close()
+        return
+
+    mbtiles_create(path, compact_keys=compact_keys)
+    con = mbtiles_connect(path)
+    tile_ids = ['%d/%d/%d@%d' % (z, x, y, s) for z, x, y in positions for s in (1, 2)]
+    con.insert_tiles_to_images([(tile_id, tile_id) for tile_id in tile_ids])
+    con.insert_tiles_to_map([(z, x, y, s, '%d/%d/%d@%d' % (z, x, y, s), 100 * (x + 1)) for z, x, y in positions for s in (1, 2)])
+    con.close()
+
+
+def check_tile_queries(compacted, compact_keys=False):
+    create_query_database('test/output/query.mbtiles', compacted, compact_keys)
+    con = mbtiles_connect('test/output/query.mbtiles')
+    assert con.is_compacted() == compacted
+    scales = 2 if compacted else 1
+
+    # Zoom levels 0 and 18 don't limit the count
+    assert con.tiles_count(0, 18, 0, 0, None) == 22 * scales
+    assert con.tiles_count(1, 18, 0, 0, None) == 21 * scales
+    assert con.tiles_count(0, 1, 0, 0, None) == 5 * scales
+    assert con.tiles_count(1, 2, 0, 0, 2) == 20
+    if compacted:
+        assert con.tiles_count(0, 1, 150, 0, 1) == 2
+        assert con.tiles_count(2, 2, 150, 350, 2) == 8
+
+    assert con.bounding_box_for_zoom_level(2, 2) == (0, 3, 0, 3)
+    assert con.bounding_box_for_zoom_level(19, 1) == (0, 0, 0, 0)
+    assert con.bounding_box_for_zoom_level(3, 1) == (None, None, None, None)
+    assert con.columns_for_zoom_level_and_row(2, 1, 2) == set([0, 1, 2, 3])
+    assert con.columns_for_zoom_level_and_row(1, 3, 1) == set()
+
+    # Only the scale 2 tiles of zoom level 2 in columns 0 and 1 of compacted databases
+    con.delete_tiles(2, 2, 0, 250, 2)
+    assert con.tiles_count(2, 2, 0, 0, None) == (24 if compacted else 0)
+    assert con.columns_for_zoom_level_and_row(2, 1, 2) == (set([2, 3]) if compacted else set())
+    if compacted:
+        assert con.tiles_count(2, 2, 0, 0, 1) == 16
+        assert con.images_count(0, 18, 0, 0, None) == 36
+
+    con.expire_tile(1, 1, 1, 1)
+    assert con.columns_for_zoom_level_and_row(1, 1, 1) == set([0])
+    assert con.columns_for_zoom_level_and_row(1, 1, 2) == (set([0, 1]) if compacted else set([0]))
+
+    con.expire_tiles(1, 1, 150, 0, 2)
+    assert con.columns_for_zoom_level_and_row(1, 0, 2) == (set([0]) if compacted else set())
+
+    # Unlike the counts, deleting from zoom levels 0 to 18 keeps zoom level 19
+    con.delete_tiles(0, 18, 0, 0, None)
+    assert con.tiles_count(0, 18, 0, 0, None) == scales
+    assert con.bounding_box_for_zoom_level(19, None) == (0, 0, 0, 0)
+
+    con.close()
+
+
+@with_setup(clear_data, clear_data)
+def test_tile_queries_compacted():
+    check_tile_queries(True)
+
+
+@with_setup(clear_data, clear_data)
+def test_tile_queries_compact_keys():
+    check_tile_queries(True, True)
+
+
+@with_setup(clear_data, clear_data)
+def test_tile_queries_uncompacted():
+    check_tile_queries(False)
+
+
+# Just enough of a pymongo collection for the MongoDB backend, the tests have no server
+class FakeMongoCursor(object):
+
+    def __init__(self, documents, projection):
+        self.documents  = documents
+        self.projection = projection
+
+    def batch_size(self, size):
+        return self
+
+    def sort(self, field, direction):
+        self.documents.sort(key=lambda d: d.get(field), reverse=(direction < 0))
+        return self
+
+    def limit(self, count):
+        self.documents = self.documents[:count]
+        return self
+
+    def count(self):
+        return len(self.documents)
+
+    def distinct(self, field):
+        return list(set(d[field] for d in self.documents if field in d))
+
+    def __iter__(self):
+        for d in self.documents:
+            if self.projection:
+                fields = [f for f, v in self.projection.items() if v] + ([] if self.projection.get("_id", 1) == 0 else ["_id"])
+                d = dict((f, d[f]) for f in fields if f in d)
+            yield d
+
+
+class FakeMongoCollection(object):
+
+    def __init__(self):
+        self.documents = {}
+        self.indexes   = []
+
+    def create_index(self, keys):
+        if keys not in self.indexes:
+            self.indexes.append(keys)
+
+    def matches(self, document, query):
+        operators = {"$gt" : lambda a, b: a is not None and a > b, "$gte" : lambda a, b: a is not None and a >= b,
+            "$lt" : lambda a, b: a is not None and a < b, "$lte" : lambda a, b: a is not None and a <= b,
+            "$ne" : lambda a, b: a != b, "$in" : lambda a, b: a in b}
+
+        for key, condition in query.items():
+            if isinstance(condition, dict):
+                if not all(operators[op](document.get(key), operand) for op, operand in condition.items()):
+                    return False
+            elif document.get(key) != condition:
+                return False
+        return True
+
+    def find(self, query={}, projection=None):
+        return FakeMongoCursor([dict(d) for d in self.documents.values() if self.matches(d, query)], projection)
+
+    def find_one(self, query={}, projection=None):
+        for d in self.find(query, projection):
+            return d
+        return None
+
+    # Documents without $set replace the matching document
+    def update(self, query, document, upsert=False, multi=False):
+        for d in self.documents.values():
+            if self.matches(d, query):
+                if "$set" in document:
+                    d.update(document["$set"])
+                else:
+                    self.documents[d["_id"]] = dict(document, _id=d["_id"])
+                if not multi:
+                    return
+        if upsert:
+            _id = query.get("_id", len(self.documents))
+            self.documents[_id] = dict(document.get("$set", document), _id=_id)
+
+    def remove(self, query):
+        for d in self.documents.values():
+            if self.matches(d, query):
+                del self.documents[d["_id"]]
+
+    def initialize_unordered_bulk_op(self):
+        return FakeMongoBulk(self)
+
+
+class FakeMongoBulk(object):
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.operations = []
+        self.query      = None
+        self.is_upsert  = False
+
+    def find(self, query):
+        self.query, self.is_upsert = query, False
+        return self
+
+    def upsert(self):
+        self.is_upsert = True
+        return self
+
+    def update(self, document):
+        self.operations.append((self.query, document, self.is_upsert))
+
+    # Unordered, so the operations are applied in reverse
+    def execute(self):
+        for query, document, upsert in reversed(self.operations):
+            self.collection.update(query, document, upsert)
+
+
+class FakeMongoDatabase(object):
+
+    def __init__(self):
+        self.tiles    = FakeMongoCollection()
+        self.metadata = FakeMongoCollection()
+
+
+class FakeOperationFailure(Exception):
+    pass
+
+
+# A collection of a user who may only read the database
+class ReadOnlyMongoCollection(FakeMongoCollection):
+
+    def create_index(self, keys):
+        raise FakeOperationFailure("not authorized")
+
+    def update(self, query, document, upsert=False, multi=False):
+        raise FakeOperationFailure("not authorized")
+
+
+# The backend only uses the sort directions and the OperationFailure of pymongo and the Binary type of bson
+def fake_mongodb():
+    pymongo = types.ModuleType("pymongo")
+    pymongo.ASCENDING  = 1
+    pymongo.DESCENDING = -1
+    pymongo.errors = types.ModuleType("pymongo.errors")
+    pymongo.errors.OperationFailure = FakeOperationFailure
+
+    bson = types.ModuleType("bson")
+    bson.binary = types.ModuleType("bson.binary")
+    bson.binary.Binary = str
+
+    import mbutil.database
+    mbutil.database.pymongo = pymongo
+    mbutil.database.bson    = bson
+
+    con = types.InstanceType(mbutil.database.MBTilesMongoDB)
+    con.cur = FakeMongoDatabase()
+    return con
+
+
+def test_mongodb_legacy_documents():
+    con = fake_mongodb()
+    con.cur.tiles.documents["2/1/3/1"] = {"_id" : "2/1/3/1", "z" : 2, "t" : 1, "d" : "legacy"}
+    con.insert_tiles([(2, 2, 0, 1, "new", 2), (2, 3, 3, 2, "retina", 2)])
+    con.mbtiles_setup()
+    assert sorted([t[0], t[1], t[2], t[3], str(t[4])] for t in con.tiles(2, 2, 0, 0, 1)) == [[2, 1, 3, 1, "legacy"], [2, 2, 0, 1, "new"]]
+    assert list(con.bounding_box_for_zoom_level(2, 1)) == [1, 2, 0, 3]
+    assert con.columns_for_zoom_level_and_row(2, 3, None) == set([1, 3])
+    assert sorted(con.columns_and_rows_for_zoom_level(2, None)) == [(1, 3), (2, 0), (3, 3)]
+    assert con.zoom_levels(None) == [2]
+
+
+def test_mongodb_read_only_legacy_documents():
+    con = fake_mongodb()
+    con.cur.tiles = ReadOnlyMongoCollection()
+    con.cur.tiles.documents["2/1/3/1"] = {"_id" : "2/1/3/1", "z" : 2, "t" : 1, "d" : "legacy"}
+    con.try_upgrade_legacy_tiles()
+    assert [[t[0], t[1], t[2], t[3], str(t[4])] for t in con.tiles(2, 2, 0, 0, None)] == [[2, 1, 3, 1, "legacy"]]
+    try:
+        con.mbtiles_setup()
+        assert False
+    except FakeOperationFailure:
+        pass
+
+
+def test_mongodb_duplicate_tiles_in_batch():
+    con = fake_mongodb()
+    con.insert_tiles([(1, 0, 0, 1, "first", 1), (1, 1, 1, 1, "other", 1), (1, 0, 0, 1, "second", 2)])
+    assert sorted([t[0], t[1], t[2], str(t[4])] for t in con.tiles(1, 1, 0, 0, 1)) == [[1, 0, 0, "second"], [1, 1, 1, "other"]]
+
+
+def test_mongodb_expire_tile_ranges():
+    con = fake_mongodb()
+    con.cur.tiles.documents["3/1/1/1"] = {"_id" : "3/1/1/1", "z" : 3, "t" : 1, "d" : "legacy"}
+    con.cur.tiles.documents["3/5/1/1"] = {"_id" : "3/5/1/1", "z" : 3, "t" : 1, "d" : "legacy"}
+    con.insert_tiles([(3, 2, 2, 1, "new", 2), (3, 2, 5, 1, "new", 2)])
+    con.mbtiles_setup()
+    assert [[k[0] for k in index] for index in con.cur.tiles.indexes] == [["z", "x", "y", "s"], ["t"]]
+    con.expire_tile_ranges([(3, 0, 2, 0, 2)], None)
+    assert sorted(t[:3] for t in con.tiles(3, 3, 0, 0, None)) == [[3, 2, 5], [3, 5, 1]]
+    assert sorted(t[:3] for t in con.updates(3, 3, 0, 0, None) if t[4] is None) == [[3, 1, 1], [3, 2, 2]]
+
+
+def test_mongodb_tile_queries():
+    con = fake_mongodb()
+    con.mbtiles_setup()
+    con.insert_tiles([(z, x, y, s, "%d/%d/%d@%d" % (z, x, y, s), 100 * (x + 1)) for z in range(3) for x in range(2 ** z) for y in range(2 ** z) for s in (1, 2)])
+    con.insert_tile(19, 0, 0, 1, "19/0/0@1")
+    assert con.tiles_count(0, 18, 0, 0, None) == 43
+    assert con.tiles_count(1, 2, 0, 0, 2) == 20
+    assert con.tiles_count(2, 2, 150, 350, 2) == 8
+    assert sorted(con.zoom_levels(2)) == [0, 1, 2]
+    assert con.max_timestamp() > 400
+    assert sorted(str(t[4]) for t in con.tiles_with_tile_id(1, 1, 150, 0, 1)) == ["1/1/0@1", "1/1/1@1"]
+    con.delete_tiles(2, 2, 0, 250, 2)
+    assert con.tiles_count(2, 2, 0, 0, None) == 24
+    assert con.columns_for_zoom_level_and_row(2, 1, 2) == set([2, 3])
+    con.expire_tile(1, 1, 1, 1)
+    con.expire_tiles(0, 0, 0, 0, None)
+    assert con.tiles_count(0, 1, 0, 0, None) == 7
+    assert sorted(t[:4] for t in con.updates(0, 1, 400, 0, None) if t[4] is None) == [[0, 0, 0, 1], [0, 0, 0, 2], [1, 1, 1, 1]]
+    assert con.updates_count(0, 1, 400, 0, None) == 3
+    assert con.updates_count(0, 1, 400, 0, 1) == 2
+    # Deleting from zoom levels 0 to 18 keeps zoom level 19 and also removes expired tiles
+    con.delete_tiles(0, 18, 0, 0, None)
+    assert [t[:4] for t in con.updates(0, 30, 0, 0, None)] == [[19, 0, 0, 1]]
+    con.update_metadata("format", "png")
+    con.update_metadata("format", "jpg")
+    assert con.metadata() == {"format" : "jpg"}